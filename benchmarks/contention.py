@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""Contention of Counter.inc() on one child, from 1 to N threads.
+
+Compares the mutex and sharded value backends. Each thread increments the
+same counter, and the total rate of increments is printed for each number
+of threads.
+
+Usage: PYTHONPATH=. python benchmarks/contention.py [max threads] [increments per thread]
+"""
+from __future__ import print_function, unicode_literals
+
+import sys
+import threading
+from timeit import default_timer
+
+from prometheus_client.core import CollectorRegistry, Counter
+
+
+def run(backend, threads, increments):
+    """Returns how many increments per second the threads made together."""
+    counter = Counter('c', 'help', registry=CollectorRegistry(), value_backend=backend)
+    start = threading.Event()
+
+    def work():
+        start.wait()
+        inc = counter.inc
+        for _ in range(increments):
+            inc()
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    for w in workers:
+        w.start()
+    began = default_timer()
+    start.set()
+    for w in workers:
+        w.join()
+    elapsed = default_timer() - began
+    assert counter._value.get() == threads * increments
+    return threads * increments / elapsed
+
+
+def main():
+    max_threads = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    increments = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    counts = [1]
+    while counts[-1] * 2 <= max_threads:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != max_threads:
+        counts.append(max_threads)
+    print('{0:>8} {1:>16} {2:>16}'.format('threads', 'mutex inc/s', 'sharded inc/s'))
+    for threads in counts:
+        print('{0:>8} {1:>16.0f} {2:>16.0f}'.format(
+            threads, run('mutex', threads, increments), run('sharded', threads, increments)))
+
+
+if __name__ == '__main__':
+    main()
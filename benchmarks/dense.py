@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+"""Collection from files of the default format against the dense format.
+
+Writes the same counter files as scrape.py in each format, and times the
+first and later scrapes of MultiProcessCollector.collect() for both. The
+files of the default format are then converted with migrate_to_dense(), and
+the conversion is timed too. Values are summed with numpy if it's installed.
+
+Usage: PYTHONPATH=. python benchmarks/dense.py [workers] [series]
+"""
+from __future__ import print_function, unicode_literals
+
+import shutil
+import sys
+import tempfile
+from timeit import default_timer
+
+from prometheus_client.multiprocess import MultiProcessCollector, migrate_to_dense, numpy
+
+from scrape import scrape, write_files
+
+
+def main():
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    series = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    print('{0} workers x {1} series, numpy {2}'.format(workers, series, 'used' if numpy is not None else 'not installed'))
+    print('{0:>8} {1:>10} {2:>10}'.format('format', 'first s', 'later s'))
+    migration = None
+    for backend in ('files', 'dense'):
+        path = tempfile.mkdtemp()
+        try:
+            write_files(path, workers, series, backend)
+            collector = MultiProcessCollector(None, path)
+            first = scrape(collector)
+            later = min(scrape(collector) for _ in range(5))
+            print('{0:>8} {1:>10.3f} {2:>10.3f}'.format(backend, first, later))
+            if backend == 'files':
+                start = default_timer()
+                migrate_to_dense(path)
+                migration = default_timer() - start
+        finally:
+            shutil.rmtree(path)
+    print('migrate_to_dense: {0:.3f} s'.format(migration))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""Cost of Counter.labels(), when the child exists, when it doesn't, and under contention.
+
+A hit looks up an existing child, which doesn't take the lock. A miss
+creates a new child each time. The cost of incrementing a child prepared
+with prepare_labels() is printed for comparison. Contention is the total
+rate of hits made by 1 to N threads together, on the same counter.
+
+Usage: PYTHONPATH=. python benchmarks/labels.py [max threads] [calls per thread]
+"""
+from __future__ import print_function, unicode_literals
+
+import sys
+import threading
+import timeit
+from timeit import default_timer
+
+from prometheus_client.core import Counter
+
+
+def single(calls):
+    counter = Counter('c', 'help', ['method', 'endpoint'], registry=None)
+    labels = counter.labels
+    labels('get', '/')
+    elapsed = timeit.timeit(lambda: labels('get', '/'), number=calls)
+    print('hit, positional: {0:.2f} us'.format(elapsed / calls * 1e6))
+    elapsed = timeit.timeit(lambda: labels(method='get', endpoint='/'), number=calls)
+    print('hit, keywords: {0:.2f} us'.format(elapsed / calls * 1e6))
+    endpoints = ['/{0}'.format(i) for i in range(calls)]
+    elapsed = timeit.timeit(lambda: [labels('post', e) for e in endpoints], number=1)
+    print('miss: {0:.2f} us'.format(elapsed / calls * 1e6))
+    child = counter.prepare_labels([('get', '/')])[0]
+    elapsed = timeit.timeit(lambda: labels('get', '/').inc(), number=calls)
+    print('labels().inc(): {0:.2f} us'.format(elapsed / calls * 1e6))
+    elapsed = timeit.timeit(child.inc, number=calls)
+    print('prepared child inc(): {0:.2f} us'.format(elapsed / calls * 1e6))
+
+
+def contended(threads, calls):
+    """Returns how many hits per second the threads made together."""
+    counter = Counter('c', 'help', ['method', 'endpoint'], registry=None)
+    counter.labels('get', '/')
+    start = threading.Event()
+
+    def work():
+        start.wait()
+        labels = counter.labels
+        for _ in range(calls):
+            labels('get', '/')
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    for w in workers:
+        w.start()
+    began = default_timer()
+    start.set()
+    for w in workers:
+        w.join()
+    return threads * calls / (default_timer() - began)
+
+
+def main():
+    max_threads = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    calls = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    single(calls)
+    print('{0:>8} {1:>16}'.format('threads', 'hits/s'))
+    threads = 1
+    while threads <= max_threads:
+        print('{0:>8} {1:>16.0f}'.format(threads, contended(threads, calls)))
+        threads *= 2
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+"""Memory used per series of labelled metrics, as traced by tracemalloc.
+
+Creates a metric of each type with two labels and the given number of
+children, and updates each child once. Rendering the samples once is
+included, as the label dicts of samples are cached. Needs Python 3.4 or later.
+
+Usage: PYTHONPATH=. python benchmarks/memory.py [series]
+"""
+from __future__ import print_function, unicode_literals
+
+import gc
+import sys
+import tracemalloc
+
+from prometheus_client.core import Counter, Gauge, Histogram, Summary
+
+METRICS = (
+    ('counter', Counter, lambda child: child.inc()),
+    ('gauge', Gauge, lambda child: child.set(1)),
+    ('summary', Summary, lambda child: child.observe(1)),
+    ('histogram', Histogram, lambda child: child.observe(1)),
+)
+
+
+def bytes_per_series(cls, update, series):
+    gc.collect()
+    tracemalloc.start()
+    metric = cls('m', 'help', ['tenant', 'method'], registry=None)
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(series):
+        # Label values are built for each call, as they would be from requests.
+        update(metric.labels('tenant-{0}'.format(i % 1000), 'method-{0}'.format(i // 1000)))
+    list(metric._samples())
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / float(series)
+
+
+def main():
+    series = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    for name, cls, update in METRICS:
+        print('{0:>10}: {1:.0f} bytes per series'.format(name, bytes_per_series(cls, update, series)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""Throughput of Counter.inc() with the ring backend, against mmapped files.
+
+Increments the children of a labelled counter in turn, with the value class
+of the files backend, which writes each update to its mmapped file, and
+of the ring backend, which appends it to the ring buffer. The ring is drained
+after every chunk of updates, as a collection or start_ring_aggregator would,
+and the time spent draining is printed separately, per update.
+
+Usage: PYTHONPATH=. python benchmarks/ring.py [updates] [series]
+"""
+from __future__ import print_function, unicode_literals
+
+import os
+import shutil
+import sys
+import tempfile
+from timeit import default_timer
+
+from prometheus_client import core
+from prometheus_client.core import CollectorRegistry, Counter
+from prometheus_client.multiprocess import MultiProcessCollector, _ring_aggregator
+
+# Fewer updates than a ring holds, so that it never fills up.
+CHUNK = 10000
+
+
+def run(backend, updates, series):
+    """Returns the updates per second, and the seconds spent draining per update."""
+    path = tempfile.mkdtemp()
+    os.environ['prometheus_multiproc_dir'] = path
+    core._ValueClass = core._MultiProcessValue(backend=backend)
+    try:
+        counter = Counter('c', 'help', ['l'], registry=None)
+        children = [counter.labels(str(i)) for i in range(series)]
+        writing = draining = 0.0
+        for start in range(0, updates, CHUNK):
+            chunk = [children[i % series].inc for i in range(start, min(start + CHUNK, updates))]
+            began = default_timer()
+            for inc in chunk:
+                inc()
+            writing += default_timer() - began
+            if backend == 'ring':
+                began = default_timer()
+                _ring_aggregator(path).drain()
+                draining += default_timer() - began
+        registry = CollectorRegistry()
+        MultiProcessCollector(registry, path)
+        assert sum(s[2] for s in list(registry.collect())[0].samples) == updates
+        return updates / writing, draining / updates
+    finally:
+        core._ValueClass = core._MutexValue
+        del os.environ['prometheus_multiproc_dir']
+        shutil.rmtree(path)
+
+
+def main():
+    updates = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    series = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    print('{0} updates over {1} series'.format(updates, series))
+    print('{0:>8} {1:>16} {2:>16}'.format('backend', 'inc/s', 'drain us/inc'))
+    for backend in ('files', 'ring'):
+        rate, drain = run(backend, updates, series)
+        print('{0:>8} {1:>16.0f} {2:>16.2f}'.format(backend, rate, drain * 1e6))
+
+
+if __name__ == '__main__':
+    main()
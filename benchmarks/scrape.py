@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""Latency of a multiprocess scrape, for many workers with many series each.
+
+Writes a counter file for each worker into a temporary directory, and then
+times MultiProcessCollector.collect(). The first scrape reads every file from
+the start. Later scrapes reuse the cached state of the files, and only reread
+their values.
+
+The backend is files or dense. 1000 workers with 10000 series each makes
+about 1GB of files, and takes a few minutes to write.
+
+Usage: PYTHONPATH=. python benchmarks/scrape.py [workers] [series] [backend]
+"""
+from __future__ import print_function, unicode_literals
+
+import os
+import shutil
+import sys
+import tempfile
+from timeit import default_timer
+
+from prometheus_client import core
+from prometheus_client.multiprocess import MultiProcessCollector
+
+
+def write_files(path, workers, series, backend):
+    dict_class = core._MmapedDict if backend == 'files' else core._DenseMmapedDict
+    for pid in range(workers):
+        d = dict_class(os.path.join(path, 'counter_{0}.db'.format(pid)))
+        for i in range(series):
+            d.write_value(('c', 'c', ('l', ), ('value {0}'.format(i), )), pid)
+        d.close()
+
+
+def scrape(collector):
+    """Returns how long a collection took, in seconds."""
+    start = default_timer()
+    list(collector.collect())
+    return default_timer() - start
+
+
+def main():
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    series = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    backend = sys.argv[3] if len(sys.argv) > 3 else 'files'
+    path = tempfile.mkdtemp()
+    try:
+        write_files(path, workers, series, backend)
+        collector = MultiProcessCollector(None, path)
+        print('{0} workers x {1} series, {2} backend'.format(workers, series, backend))
+        print('first scrape: {0:.3f} s'.format(scrape(collector)))
+        print('later scrapes: {0:.3f} s'.format(min(scrape(collector) for _ in range(5))))
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
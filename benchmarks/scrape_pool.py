@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""Latency of a multiprocess scrape against the number of cores used.
+
+Writes the same files as scrape.py, and times MultiProcessCollector.collect()
+without a pool, and then with a multiprocessing.Pool of 1, 2, 4 and so on up
+to the number of cores. Each pool is scraped once to warm the cached file
+states of its workers, and the fastest of the next scrapes is printed.
+
+Usage: PYTHONPATH=. python benchmarks/scrape_pool.py [workers] [series] [backend]
+"""
+from __future__ import print_function, unicode_literals
+
+import multiprocessing
+import shutil
+import sys
+import tempfile
+
+from prometheus_client.multiprocess import MultiProcessCollector
+
+from scrape import scrape, write_files
+
+
+def latency(path, pool):
+    collector = MultiProcessCollector(None, path, pool=pool)
+    scrape(collector)
+    return min(scrape(collector) for _ in range(5))
+
+
+def main():
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    series = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    backend = sys.argv[3] if len(sys.argv) > 3 else 'files'
+    path = tempfile.mkdtemp()
+    try:
+        write_files(path, workers, series, backend)
+        print('{0} workers x {1} series, {2} backend'.format(workers, series, backend))
+        print('{0:>8} {1:>10}'.format('cores', 'scrape s'))
+        print('{0:>8} {1:>10.3f}'.format('no pool', latency(path, None)))
+        cores = 1
+        while cores <= multiprocessing.cpu_count():
+            pool = multiprocessing.Pool(cores)
+            try:
+                print('{0:>8} {1:>10.3f}'.format(cores, latency(path, pool)))
+            finally:
+                pool.terminate()
+            cores *= 2
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""Cost of sample lookups with RegistrySnapshot, against get_sample_value.
+
+Registers a labelled counter and histogram with the given number of
+children, and looks up random counter samples. get_sample_value collects
+and scans every sample on each lookup, while a snapshot collects once and
+then looks up samples in its index. Building the snapshot is timed
+separately, as are label subset and prefix queries with select().
+
+Usage: PYTHONPATH=. python benchmarks/snapshot.py [series] [lookups]
+"""
+from __future__ import print_function, unicode_literals
+
+import random
+import sys
+import timeit
+
+from prometheus_client.core import CollectorRegistry, Counter, Histogram
+
+
+def main():
+    series = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    registry = CollectorRegistry()
+    counter = Counter('c', 'help', ['tenant', 'method'], registry=registry)
+    histogram = Histogram('h', 'help', ['tenant'], registry=registry)
+    for i in range(series):
+        counter.labels('tenant-{0}'.format(i % 100), 'method-{0}'.format(i // 100)).inc(i)
+        histogram.labels('tenant-{0}'.format(i)).observe(i)
+    wanted = [{'tenant': 'tenant-{0}'.format(i % 100), 'method': 'method-{0}'.format(i // 100)}
+              for i in (random.randrange(series) for _ in range(lookups))]
+    print('{0} series per metric, {1} lookups'.format(series, lookups))
+
+    # The scan is slow, so a sample of the lookups is timed.
+    scanned = wanted[:max(1, lookups // 100)]
+    elapsed = timeit.timeit(lambda: [registry.get_sample_value('c', l) for l in scanned], number=1)
+    print('get_sample_value: {0:.1f} us per lookup'.format(elapsed / len(scanned) * 1e6))
+
+    elapsed = min(timeit.repeat(registry.snapshot, number=1, repeat=5))
+    print('snapshot(): {0:.1f} ms'.format(elapsed * 1e3))
+    snapshot = registry.snapshot()
+    get = snapshot.get
+    elapsed = min(timeit.repeat(lambda: [get('c', l) for l in wanted], number=1, repeat=5))
+    print('snapshot.get: {0:.2f} us per lookup'.format(elapsed / lookups * 1e6))
+    elapsed = min(timeit.repeat(lambda: snapshot.select(labels={'tenant': 'tenant-1'}), number=100, repeat=5))
+    print('snapshot.select, one label: {0:.1f} us'.format(elapsed / 100 * 1e6))
+    elapsed = min(timeit.repeat(lambda: snapshot.select('h_'), number=100, repeat=5))
+    print('snapshot.select, name prefix: {0:.1f} us'.format(elapsed / 100 * 1e6))
+
+
+if __name__ == '__main__':
+    main()
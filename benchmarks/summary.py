@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""Cost of Summary.observe() with quantiles, and memory per child.
+
+The observe cost is measured for a Summary without quantiles, and with
+p50/p90/p99 objectives. Memory is the traced allocation per child of a
+labelled Summary, once each child has had observations. It needs
+tracemalloc, so Python 3.4 or later.
+
+Usage: PYTHONPATH=. python benchmarks/summary.py [observations] [children]
+"""
+from __future__ import print_function, unicode_literals
+
+import gc
+import random
+import sys
+import timeit
+
+from prometheus_client.core import Summary
+
+QUANTILES = ((0.5, 0.05), (0.9, 0.01), (0.99, 0.001))
+
+
+def observe_cost(observations):
+    amounts = [random.expovariate(10) for _ in range(observations)]
+    for name, quantiles in (('no quantiles', ()), ('p50/p90/p99', QUANTILES)):
+        summary = Summary('s', 'help', registry=None, quantiles=quantiles)
+        observe = summary.observe
+        elapsed = timeit.timeit(lambda: [observe(a) for a in amounts], number=1)
+        print('observe, {0}: {1:.2f} us'.format(name, elapsed / observations * 1e6))
+
+
+def memory_per_child(children):
+    try:
+        import tracemalloc
+    except ImportError:
+        print('memory per child: needs tracemalloc')
+        return
+    for name, quantiles in (('no quantiles', ()), ('p50/p90/p99', QUANTILES)):
+        gc.collect()
+        tracemalloc.start()
+        summary = Summary('s', 'help', ['l'], registry=None, quantiles=quantiles)
+        before = tracemalloc.get_traced_memory()[0]
+        for i in range(children):
+            child = summary.labels(str(i))
+            for _ in range(100):
+                child.observe(random.expovariate(10))
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print('memory per child, {0}: {1:.0f} bytes'.format(name, (after - before) / float(children)))
+
+
+def main():
+    observations = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    children = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    observe_cost(observations)
+    memory_per_child(children)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,17 +4,20 @@ from . import core
 from . import exposition
 from . import process_collector
 
-__all__ = ['Counter', 'Gauge', 'Summary', 'Histogram']
+__all__ = ['Counter', 'Gauge', 'Summary', 'Histogram', 'ExponentialHistogram']
 # http://stackoverflow.com/questions/19913653/no-unicode-in-all-for-a-packages-init
 __all__ = [n.encode('ascii') for n in __all__]
 
 CollectorRegistry = core.CollectorRegistry
+CachedCollector = core.CachedCollector
 REGISTRY = core.REGISTRY
 Metric = core.Metric
 Counter = core.Counter
 Gauge = core.Gauge
 Summary = core.Summary
 Histogram = core.Histogram
+ExponentialHistogram = core.ExponentialHistogram
+register_value_backend = core.register_value_backend
 
 CONTENT_TYPE_LATEST = exposition.CONTENT_TYPE_LATEST
 generate_latest = exposition.generate_latest
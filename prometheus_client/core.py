@@ -2,15 +2,19 @@
 
 from __future__ import unicode_literals
 
+import atexit
+import bisect
 import copy
 import json
+import logging
 import math
 import mmap
 import os
 import re
 import struct
+import sys
 import time
-import types
+import weakref
 
 try:
     from BaseHTTPServer import BaseHTTPRequestHandler
@@ -18,11 +22,41 @@ except ImportError:
     # Python 3
     unicode = str
 
-from threading import Lock
+if hasattr(sys, 'intern'):
+    def _intern(string):
+        # Subclasses of str can't be interned.
+        if type(string) is str:
+            return sys.intern(string)
+        return string
+else:
+    # Python 2, where intern() only takes byte strings.
+    def _intern(string):
+        return string
+
+try:
+    from thread import get_ident
+except ImportError:
+    # Python 3
+    from threading import get_ident
+
+from array import array
+from contextlib import contextmanager
+from threading import Condition, Lock, Thread
 from timeit import default_timer
 
 from .decorator import decorate
 
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 _METRIC_NAME_RE = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*$')
 _METRIC_LABEL_NAME_RE = re.compile(r'^[a-zA-Z_][a-zA-Z0-9_]*$')
 _RESERVED_METRIC_LABEL_NAME_RE = re.compile(r'^__.*$')
@@ -37,11 +71,28 @@ class CollectorRegistry(object):
     Collectors must have a no-argument method 'collect' that returns a list of
     Metric objects. The returned metrics should be consistent with the Prometheus
     exposition formats.
+
+    value_backend is the default value backend of metrics created with this
+    registry, see register_value_backend.
+
+    If a pool such as multiprocessing.pool.ThreadPool is given, collectors are
+    run on it in parallel. If timeout is also given, a collection waits at most
+    that many seconds for them. A collector which is not done in time is left
+    running, and its metrics from its last completed run are returned instead,
+    if there are any. The metrics are in the same order either way, and how long
+    each collector last took is returned by collector_durations().
     '''
-    def __init__(self, auto_describe=False):
+    def __init__(self, auto_describe=False, value_backend=None, pool=None, timeout=None):
         self._collector_to_names = {}
         self._names_to_collectors = {}
         self._auto_describe = auto_describe
+        self.value_backend = value_backend
+        self._pool = pool
+        self._timeout = timeout
+        # Per collector, its run on the pool, its last metrics, and how long they took.
+        self._running = {}
+        self._last_metrics = {}
+        self._durations = {}
         self._lock = Lock()
 
     def register(self, collector):
@@ -62,6 +113,9 @@ class CollectorRegistry(object):
             for name in self._collector_to_names[collector]:
                 del self._names_to_collectors[name]
             del self._collector_to_names[collector]
+            self._running.pop(collector, None)
+            self._last_metrics.pop(collector, None)
+            self._durations.pop(collector, None)
 
     def _get_names(self, collector):
         '''Get names of timeseries the collector produces.'''
@@ -93,10 +147,63 @@ class CollectorRegistry(object):
         collectors = None
         with self._lock:
             collectors = copy.copy(self._collector_to_names)
-        for collector in collectors:
-            for metric in collector.collect():
+        if self._pool is None:
+            for collector in collectors:
+                for metric in collector.collect():
+                    yield metric
+            return
+        for metrics in self._collect_parallel(collectors):
+            for metric in metrics:
                 yield metric
 
+    def _timed_collect(self, collector):
+        start = default_timer()
+        metrics = list(collector.collect())
+        duration = default_timer() - start
+        with self._lock:
+            if collector in self._collector_to_names:
+                self._last_metrics[collector] = metrics
+                self._durations[collector] = duration
+        return metrics
+
+    def _collect_parallel(self, collectors):
+        '''Returns the metrics of each collector, run on the pool.'''
+        deadline = None
+        if self._timeout is not None:
+            deadline = default_timer() + self._timeout
+        runs = []
+        with self._lock:
+            for collector in collectors:
+                run = self._running.get(collector)
+                # A collector still running from an earlier collection isn't started again.
+                if run is None or run.ready():
+                    run = self._pool.apply_async(self._timed_collect, (collector, ))
+                    self._running[collector] = run
+                runs.append((collector, run))
+        result = []
+        for collector, run in runs:
+            if deadline is not None:
+                run.wait(max(0, deadline - default_timer()))
+            if deadline is None or run.ready():
+                result.append(run.get())
+                continue
+            with self._lock:
+                metrics = self._last_metrics.get(collector)
+            if metrics is None:
+                logging.warning('Collector %r timed out, skipping it', collector)
+            else:
+                logging.warning('Collector %r timed out, returning its previous metrics', collector)
+                result.append(metrics)
+        return result
+
+    def collector_durations(self):
+        '''Returns how many seconds the last completed run of each collector took.
+
+        Only runs on the pool are timed.
+        '''
+        with self._lock:
+            return dict(self._durations)
+
     def restricted_registry(self, names):
         '''Returns object that only collects some metrics.
 
@@ -106,30 +213,46 @@ class CollectorRegistry(object):
         Intended usage is:
             generate_latest(REGISTRY.restricted_registry(['a_timeseries']))
 
+        Only the collectors of the given names are collected, and metrics
+        created by this library only produce the samples asked for.
+
         Experimental.'''
         names = set(names)
-        collectors = set()
+        registry = self
+        class RestrictedRegistry(object):
+            def collect(self):
+                return registry._restricted_collect(names)
+        return RestrictedRegistry()
+
+    def _restricted_collect(self, names):
         with self._lock:
-            for name in names:
-                if name in self._names_to_collectors:
-                    collectors.add(self._names_to_collectors[name])
+            found = set([self._names_to_collectors[n] for n in names if n in self._names_to_collectors])
+            # In the order of a full collection.
+            collectors = [c for c in self._collector_to_names if c in found]
         metrics = []
         for collector in collectors:
-            for metric in collector.collect():
+            collect_names = getattr(collector, '_collect_names', None)
+            if collect_names is not None:
+                collected = collect_names(names)
+            else:
+                collected = collector.collect()
+            for metric in collected:
                 samples = [s for s in metric.samples if s[0] in names]
                 if samples:
                     m = Metric(metric.name, metric.documentation, metric.type)
                     m.samples = samples
                     metrics.append(m)
-        class RestrictedRegistry(object):
-            def collect(self):
-                return metrics
-        return RestrictedRegistry()
+        return metrics
+
+    def snapshot(self):
+        '''Collects once, and returns a RegistrySnapshot for looking up samples.'''
+        return RegistrySnapshot(self.collect())
 
     def get_sample_value(self, name, labels=None):
         '''Returns the sample value, or None if not found.
 
         This is inefficient, and intended only for use in unittests.
+        For many lookups, use snapshot() instead.
         '''
         if labels is None:
             labels = {}
@@ -140,12 +263,167 @@ class CollectorRegistry(object):
         return None
 
 
+class CachedCollector(object):
+    '''Returns the metrics of another collector, collecting them at most once every ttl seconds.
+
+    Intended for expensive collectors scraped by several servers:
+
+        REGISTRY.register(CachedCollector(MyCollector(), 30))
+
+    Concurrent collections while the metrics are being collected wait for,
+    and share, that one collection. With stale_while_revalidate, collections
+    after the ttl has passed return the previous metrics straight away, while
+    they are collected again in a background thread.
+    '''
+    def __init__(self, collector, ttl, stale_while_revalidate=False):
+        self._collector = collector
+        self._ttl = ttl
+        self._stale_while_revalidate = stale_while_revalidate
+        self._metrics = None
+        self._expires = 0
+        self._refreshing = False
+        self._condition = Condition(Lock())
+        if hasattr(collector, 'describe'):
+            self.describe = collector.describe
+
+    def collect(self):
+        with self._condition:
+            while True:
+                if self._metrics is not None and default_timer() < self._expires:
+                    return self._metrics
+                if not self._refreshing:
+                    break
+                if self._stale_while_revalidate and self._metrics is not None:
+                    return self._metrics
+                self._condition.wait()
+            self._refreshing = True
+            stale = self._metrics
+        if self._stale_while_revalidate and stale is not None:
+            t = Thread(target=self._refresh_in_background)
+            t.daemon = True
+            t.start()
+            return stale
+        return self._refresh()
+
+    def _refresh(self):
+        try:
+            metrics = list(self._collector.collect())
+        except Exception:
+            with self._condition:
+                self._refreshing = False
+                self._condition.notify_all()
+            raise
+        with self._condition:
+            self._metrics = metrics
+            self._expires = default_timer() + self._ttl
+            self._refreshing = False
+            self._condition.notify_all()
+        return metrics
+
+    def _refresh_in_background(self):
+        try:
+            self._refresh()
+        except Exception:
+            logging.exception('Collector %r failed', self._collector)
+
+
+class RegistrySnapshot(object):
+    '''The samples of a collection, indexed for lookups.
+
+    Unlike CollectorRegistry.get_sample_value, lookups don't collect or
+    scan all samples, so many can be done cheaply:
+
+        snapshot = REGISTRY.snapshot()
+        snapshot.get('my_requests_total', {'method': 'get'})
+    '''
+    def __init__(self, metrics):
+        self._values = {}
+        self._samples = []
+        # Sample names in sorted order, and the indexes of their samples.
+        self._names = []
+        self._by_name = {}
+        # The indexes of the samples with each label pair.
+        self._by_label = {}
+        for metric in metrics:
+            for name, labels, value in metric.samples:
+                i = len(self._samples)
+                self._samples.append((name, labels, value))
+                self._values[(name, frozenset(labels.items()))] = value
+                self._by_name.setdefault(name, []).append(i)
+                for pair in labels.items():
+                    self._by_label.setdefault(pair, []).append(i)
+        self._names = sorted(self._by_name)
+
+    def get(self, name, labels=None):
+        '''Returns the value of the sample, or None if not found.'''
+        if labels is None:
+            labels = {}
+        return self._values.get((name, frozenset(labels.items())))
+
+    def select(self, prefix='', labels=None):
+        '''Returns the samples whose names start with prefix, and which have all the given labels.
+
+        Samples are (name, labels, value) tuples, in the order they were collected.
+        '''
+        indexes = None
+        if labels:
+            for pair in labels.items():
+                found = self._by_label.get(pair)
+                if not found:
+                    return []
+                indexes = set(found) if indexes is None else indexes.intersection(found)
+        if prefix:
+            start = bisect.bisect_left(self._names, prefix)
+            with_prefix = set()
+            for name in self._names[start:]:
+                if not name.startswith(prefix):
+                    break
+                with_prefix.update(self._by_name[name])
+            indexes = with_prefix if indexes is None else indexes.intersection(with_prefix)
+        if indexes is None:
+            return list(self._samples)
+        return [self._samples[i] for i in sorted(indexes)]
+
+
 REGISTRY = CollectorRegistry(auto_describe=True)
 '''The default registry.'''
 
 _METRIC_TYPES = ('counter', 'gauge', 'summary', 'histogram', 'untyped')
 
 
+def _render_labels(labels):
+    '''Returns the labels as they are written in the text format, such as {a="b"}.'''
+    if not labels:
+        return ''
+    return '{{{0}}}'.format(','.join(
+        ['{0}="{1}"'.format(
+         k, v.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"'))
+         for k, v in sorted(labels.items())]))
+
+
+class _LabelDict(dict):
+    '''The labels of a sample, which are read-only, with their rendering cached.
+
+    Metrics reuse these across collections, so that the labels of their samples
+    are only built and rendered once.
+    '''
+    __slots__ = ('rendered', )
+
+    def __init__(self, *args):
+        dict.__init__(self, *args)
+        self.rendered = _render_labels(self)
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('Sample labels are read-only')
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):
+        return (_LabelDict, (dict(self), ))
+
+
+_NO_LABELS = _LabelDict()
+
+
 class Metric(object):
     '''A single metric family and its samples.
 
@@ -154,6 +432,8 @@ class Metric(object):
     Custom collectors should use GaugeMetricFamily, CounterMetricFamily
     and SummaryMetricFamily instead.
     '''
+    __slots__ = ('name', 'documentation', 'type', 'samples')
+
     def __init__(self, name, documentation, typ):
         self.name = name
         self.documentation = documentation
@@ -181,6 +461,8 @@ class CounterMetricFamily(Metric):
 
     For use by custom collectors.
     '''
+    __slots__ = ('_labelnames', )
+
     def __init__(self, name, documentation, value=None, labels=None):
         Metric.__init__(self, name, documentation, 'counter')
         if labels is not None and value is not None:
@@ -206,6 +488,8 @@ class GaugeMetricFamily(Metric):
 
     For use by custom collectors.
     '''
+    __slots__ = ('_labelnames', )
+
     def __init__(self, name, documentation, value=None, labels=None):
         Metric.__init__(self, name, documentation, 'gauge')
         if labels is not None and value is not None:
@@ -231,6 +515,8 @@ class SummaryMetricFamily(Metric):
 
     For use by custom collectors.
     '''
+    __slots__ = ('_labelnames', )
+
     def __init__(self, name, documentation, count_value=None, sum_value=None, labels=None):
         Metric.__init__(self, name, documentation, 'summary')
         if (sum_value is None) != (count_value is None):
@@ -260,6 +546,8 @@ class HistogramMetricFamily(Metric):
 
     For use by custom collectors.
     '''
+    __slots__ = ('_labelnames', )
+
     def __init__(self, name, documentation, buckets=None, sum_value=None, labels=None):
         Metric.__init__(self, name, documentation, 'histogram')
         if (sum_value is None) != (buckets is None):
@@ -292,6 +580,7 @@ class _MutexValue(object):
     '''A float protected by a mutex.'''
 
     _multiprocess = False
+    __slots__ = ('_value', '_lock')
 
     def __init__(self, typ, metric_name, name, labelnames, labelvalues, **kwargs):
       self._value = 0.0
@@ -309,14 +598,159 @@ class _MutexValue(object):
       with self._lock:
           return self._value
 
+
+class _ShardedValue(object):
+    '''A float striped across per-thread cells, summed when read.
+
+    Each thread only ever writes to its own cell, so inc() does not need
+    to take a lock once the thread has a cell. Cells are keyed by thread id,
+    so a new thread reuses the cell of a finished thread with the same id.
+    '''
+
+    _multiprocess = False
+    __slots__ = ('_base', '_cells', '_lock')
+
+    def __init__(self, typ, metric_name, name, labelnames, labelvalues, **kwargs):
+      self._base = 0.0
+      self._cells = {}
+      self._lock = Lock()
+
+    def _new_cell(self, ident):
+      cell = [0.0]
+      with self._lock:
+          self._cells[ident] = cell
+      return cell
+
+    def inc(self, amount):
+      ident = get_ident()
+      cell = self._cells.get(ident)
+      if cell is None:
+          cell = self._new_cell(ident)
+      cell[0] += amount
+
+    def set(self, value):
+      with self._lock:
+          self._base = value - sum([c[0] for c in self._cells.values()])
+
+    def get(self):
+      with self._lock:
+          return self._base + sum([c[0] for c in self._cells.values()])
+
+
+_INTERNED_STRING = b'\x00'
+_COMPACT_KEY = b'\x01'
+
+
+def _encode_varint(n, out):
+    """Append n to the bytearray out as an unsigned LEB128 varint."""
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _decode_varint(data, pos):
+    """Returns the varint in the bytearray data at pos, and the position after it."""
+    n = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+def _decode_key(encoded, strings):
+    """Decode a key of a _MmapedDict, given the strings interned before it."""
+    if encoded[:1] != _COMPACT_KEY:
+        return encoded.decode('utf-8')
+    data = bytearray(encoded)
+    num_labels, pos = _decode_varint(data, 1)
+    parts = []
+    while pos < len(data):
+        i, pos = _decode_varint(data, pos)
+        parts.append(strings[i])
+    start = len(parts) - 2 * num_labels
+    return tuple(parts[:start]) + (tuple(parts[start:start + num_labels]), tuple(parts[start + num_labels:]))
+
+
+def _encode_compact_key(key, intern):
+    """Encode a tuple key whose last two items are labelnames and labelvalues.
+
+    intern is called with each string, and returns its index in the string table.
+    """
+    labelnames, labelvalues = key[-2:]
+    encoded = bytearray(_COMPACT_KEY)
+    _encode_varint(len(labelnames), encoded)
+    for string in key[:-2] + labelnames + labelvalues:
+        _encode_varint(intern(string), encoded)
+    return bytes(encoded)
+
+
+def _read_mmaped_entries(data, pos, used, strings, value_size=8):
+    """Yield (key, pos) for the entries of a _MmapedDict file from pos up to used.
+
+    pos is where the value of the entry is. Interned strings are appended
+    to strings as they are read, rather than being yielded. Entries of a
+    _DenseMmapedDict have no value, which is read with a value_size of 0.
+    """
+    while pos < used:
+        encoded_len = struct.unpack_from(b'i', data, pos)[0]
+        pos += 4
+        encoded = struct.unpack_from('{0}s'.format(encoded_len).encode(), data, pos)[0]
+        padded_len = encoded_len + (8 - (encoded_len + 4) % 8)
+        pos += padded_len
+        if encoded[:1] == _INTERNED_STRING:
+            strings.append(encoded[1:].decode('utf-8'))
+        else:
+            yield _decode_key(encoded, strings), pos
+        pos += value_size
+
+
+class _StructSlot(object):
+    """A double at pos in data, for Pythons whose memoryviews can't be cast."""
+    def __init__(self, data, pos):
+        self._data = data
+        self._pos = pos
+
+    def __getitem__(self, i):
+        return struct.unpack_from(b'd', self._data, self._pos)[0]
+
+    def __setitem__(self, i, value):
+        struct.pack_into(b'd', self._data, self._pos, value)
+
+
+def _slot_view(data, pos):
+    """Returns a view of the 8 byte aligned double at pos in the mmap data.
+
+    It's read and written as view[0], which we assume to be atomic. Views keep
+    the mmap open, which is fine as the mmaps of values files are never closed.
+    """
+    try:
+        return memoryview(data)[pos:pos + 8].cast('d')
+    except (AttributeError, NameError, TypeError):
+        # Python 2, which has no memoryview before 2.7.
+        return _StructSlot(data, pos)
+
+
 class _MmapedDict(object):
     """A dict of doubles, backed by an mmapped file.
 
     The file starts with a 4 byte int, indicating how much of it is used.
     Then 4 bytes of padding.
     There's then a number of entries, consisting of a 4 byte int which is the
-    side of the next field, a utf-8 encoded string key, padding to a 8 byte
-    alignment, and then a 8 byte float which is the value.
+    side of the next field, a key, padding to a 8 byte alignment, and then a
+    8 byte float which is the value.
+
+    Keys can be strings, which are stored utf-8 encoded, or tuples of
+    (metric_name, name, labelnames, labelvalues), which are stored compactly.
+    For tuples, each distinct string is written to the file once, as an entry
+    whose key is _INTERNED_STRING followed by the utf-8 encoded string. The
+    tuple is then stored as _COMPACT_KEY followed by varints, which are the
+    number of labels and the indexes of the strings in the order they were
+    interned. The value of an interned string entry is unused.
     """
     def __init__(self, filename):
         self._lock = Lock()
@@ -326,18 +760,26 @@ class _MmapedDict(object):
         self._capacity = os.fstat(self._f.fileno()).st_size
         self._m = mmap.mmap(self._f.fileno(), self._capacity)
 
+        if self._m[:8] == _DENSE_MAGIC:
+            raise ValueError('File is in the dense format: ' + filename)
+
         self._positions = {}
+        self._strings = []
         self._used = struct.unpack_from(b'i', self._m, 0)[0]
         if self._used == 0:
             self._used = 8
             struct.pack_into(b'i', self._m, 0, self._used)
         else:
-            for key, _, pos in self._read_all_values():
+            for key, _, pos in self._read_all_values(self._strings):
                 self._positions[key] = pos
+        self._string_ids = dict((string, i) for i, string in enumerate(self._strings))
 
     def _init_value(self, key):
         """Initilize a value. Lock must be held by caller."""
-        encoded = key.encode('utf-8')
+        self._positions[key] = self._append(self._encode_key(key))
+
+    def _append(self, encoded):
+        """Append an entry, returning the position of its value. Lock must be held by caller."""
         # Pad to be 8-byte aligned.
         padded = encoded + (b' ' * (8 - (len(encoded) + 4) % 8))
         value = struct.pack('i{0}sd'.format(len(padded)).encode(), len(encoded), padded, 0.0)
@@ -350,20 +792,31 @@ class _MmapedDict(object):
         # Update how much space we've used.
         self._used += len(value)
         struct.pack_into(b'i', self._m, 0, self._used)
-        self._positions[key] = self._used - 8
-
-    def _read_all_values(self):
-        """Yield (key, value, pos). No locking is performed."""
-        pos = 8
-        while pos < self._used:
-            encoded_len = struct.unpack_from(b'i', self._m, pos)[0]
-            pos += 4
-            encoded = struct.unpack_from('{0}s'.format(encoded_len).encode(), self._m, pos)[0]
-            padded_len = encoded_len + (8 - (encoded_len + 4) % 8)
-            pos += padded_len
-            value = struct.unpack_from(b'd', self._m, pos)[0]
-            yield encoded.decode('utf-8'), value, pos
-            pos += 8
+        return self._used - 8
+
+    def _encode_key(self, key):
+        """Encode a key, interning its strings if needed. Lock must be held by caller."""
+        if not isinstance(key, tuple):
+            return key.encode('utf-8')
+        return _encode_compact_key(key, self._intern)
+
+    def _intern(self, string):
+        """Returns the index of string, appending it if needed. Lock must be held by caller."""
+        if string not in self._string_ids:
+            self._append(_INTERNED_STRING + string.encode('utf-8'))
+            self._string_ids[string] = len(self._strings)
+            self._strings.append(string)
+        return self._string_ids[string]
+
+    def _read_all_values(self, strings=None):
+        """Yield (key, value, pos). No locking is performed.
+
+        Interned strings are appended to strings as they are read.
+        """
+        if strings is None:
+            strings = []
+        for key, pos in _read_mmaped_entries(self._m, 8, self._used, strings):
+            yield key, struct.unpack_from(b'd', self._m, pos)[0], pos
 
     def read_all_values(self):
         """Yield (key, value, pos). No locking is performed."""
@@ -386,51 +839,743 @@ class _MmapedDict(object):
         # We assume that writing to an 8 byte aligned value is atomic
         struct.pack_into(b'd', self._m, pos, value)
 
+    def slot(self, key):
+        """Returns a _slot_view of the value of key, initialising it if needed."""
+        with self._lock:
+            if key not in self._positions:
+                self._init_value(key)
+            return _slot_view(self._m, self._positions[key])
+
     def close(self):
         if self._f:
             self._f.close()
             self._f = None
 
 
-def _MultiProcessValue(__pid=os.getpid()):
-    pid = __pid
+# Bytes 4 to 8 of a _MmapedDict file are always zero, so this can't be one.
+_DENSE_MAGIC = b'PROMDNS1'
+_DENSE_HEADER_SIZE = 64
+_DENSE_CHUNK_SIZE = 64 * 1024
+_DENSE_SLOTS = 1024
+_DENSE_KEYS_START = 8 + _DENSE_SLOTS * 8
+
+
+def _dense_entry(encoded):
+    """Returns the bytes of an entry in a _DenseMmapedDict chunk."""
+    # Pad to be 8-byte aligned.
+    padded = encoded + (b' ' * (8 - (len(encoded) + 4) % 8))
+    return struct.pack('i{0}s'.format(len(padded)).encode(), len(encoded), padded)
+
+
+class _DenseMmapedDict(object):
+    """A dict of doubles, backed by an mmapped file whose values are contiguous.
+
+    The file starts with _DENSE_MAGIC and the number of chunks as an 8 byte
+    int, padded to _DENSE_HEADER_SIZE. Chunks of _DENSE_CHUNK_SIZE bytes
+    follow. Each starts with an 8 byte int of where its keys end, then has
+    _DENSE_SLOTS 8 byte float values, and then from _DENSE_KEYS_START the
+    entries of _MmapedDict without their values. The value of the nth key
+    entry in a chunk is its nth value, so the values of a chunk can be read
+    all at once.
+
+    An entry is written, along with its value, before the end of keys is
+    moved past it. Files in the format of _MmapedDict are converted when
+    opened, see _migrate.
+    """
+    def __init__(self, filename):
+        self._lock = Lock()
+        self._filename = filename
+        self._f = open(filename, 'a+b')
+        size = os.fstat(self._f.fileno()).st_size
+        if size == 0:
+            self._f.truncate(_DENSE_HEADER_SIZE + _DENSE_CHUNK_SIZE)
+            self._m = mmap.mmap(self._f.fileno(), 0)
+            self._init_chunk(0)
+            struct.pack_into(b'q', self._m, 8, 1)
+            self._m[:8] = _DENSE_MAGIC
+        else:
+            self._m = mmap.mmap(self._f.fileno(), 0)
+            if self._m[:8] != _DENSE_MAGIC:
+                self._migrate()
+
+        self._positions = {}
+        self._strings = []
+        self._chunks = struct.unpack_from(b'q', self._m, 8)[0]
+        for chunk in range(self._chunks):
+            start = self._chunk_start(chunk)
+            self._count = 0
+            self._keys_end = struct.unpack_from(b'q', self._m, start)[0]
+            for key, _ in _read_mmaped_entries(self._m, start + _DENSE_KEYS_START, start + self._keys_end,
+                                               self._strings, 0):
+                self._positions[key] = start + 8 + self._count * 8
+                self._count += 1
+        self._string_ids = dict((string, i) for i, string in enumerate(self._strings))
+
+    @staticmethod
+    def _chunk_start(chunk):
+        return _DENSE_HEADER_SIZE + chunk * _DENSE_CHUNK_SIZE
+
+    def _init_chunk(self, chunk):
+        struct.pack_into(b'q', self._m, self._chunk_start(chunk), _DENSE_KEYS_START)
+
+    def _migrate(self):
+        """Convert a file in the format of _MmapedDict, replacing it atomically."""
+        old = _MmapedDict(self._filename)
+        values = list(old._read_all_values())
+        old.close()
+        tmp = self._filename + '.migrating'
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        new = _DenseMmapedDict(tmp)
+        for key, value, _ in values:
+            new.write_value(key, value)
+        new.close()
+        os.rename(tmp, self._filename)
+        self._f.close()
+        self._f = open(self._filename, 'a+b')
+        self._m = mmap.mmap(self._f.fileno(), 0)
+
+    def _append(self, encoded, has_value):
+        """Append an entry, returning the position of its value. Lock must be held by caller."""
+        entry = _dense_entry(encoded)
+        if _DENSE_KEYS_START + len(entry) > _DENSE_CHUNK_SIZE:
+            raise ValueError('Key too long')
+        if (self._keys_end + len(entry) > _DENSE_CHUNK_SIZE or
+                (has_value and self._count == _DENSE_SLOTS)):
+            self._f.truncate(self._chunk_start(self._chunks + 1))
+            self._m = mmap.mmap(self._f.fileno(), 0)
+            self._init_chunk(self._chunks)
+            self._chunks += 1
+            struct.pack_into(b'q', self._m, 8, self._chunks)
+            self._count = 0
+            self._keys_end = _DENSE_KEYS_START
+        start = self._chunk_start(self._chunks - 1)
+        self._m[start + self._keys_end:start + self._keys_end + len(entry)] = entry
+        pos = None
+        if has_value:
+            pos = start + 8 + self._count * 8
+            struct.pack_into(b'd', self._m, pos, 0.0)
+            self._count += 1
+        self._keys_end += len(entry)
+        struct.pack_into(b'q', self._m, start, self._keys_end)
+        return pos
+
+    def _intern(self, string):
+        """Returns the index of string, appending it if needed. Lock must be held by caller."""
+        if string not in self._string_ids:
+            self._append(_INTERNED_STRING + string.encode('utf-8'), False)
+            self._string_ids[string] = len(self._strings)
+            self._strings.append(string)
+        return self._string_ids[string]
+
+    def _init_value(self, key):
+        """Initilize a value. Lock must be held by caller."""
+        if isinstance(key, tuple):
+            encoded = _encode_compact_key(key, self._intern)
+        else:
+            encoded = key.encode('utf-8')
+        self._positions[key] = self._append(encoded, True)
+
+    def read_value(self, key):
+        with self._lock:
+            if key not in self._positions:
+                self._init_value(key)
+        # We assume that reading from an 8 byte aligned value is atomic
+        return struct.unpack_from(b'd', self._m, self._positions[key])[0]
+
+    def write_value(self, key, value):
+        with self._lock:
+            if key not in self._positions:
+                self._init_value(key)
+        # We assume that writing to an 8 byte aligned value is atomic
+        struct.pack_into(b'd', self._m, self._positions[key], value)
+
+    def slot(self, key):
+        """Returns a _slot_view of the value of key, initialising it if needed."""
+        with self._lock:
+            if key not in self._positions:
+                self._init_value(key)
+            return _slot_view(self._m, self._positions[key])
+
+    def close(self):
+        if self._f:
+            self._f.close()
+            self._f = None
+
+
+_ARENA_FILENAME = 'metrics.arena'
+_ARENA_MAGIC = b'PROMAREN'
+_ARENA_SEGMENT_SIZE = max(64 * 1024, mmap.ALLOCATIONGRANULARITY)
+_ARENA_HEADER_SIZE = 32
+_ARENA_SLOTS = (_ARENA_SEGMENT_SIZE - _ARENA_HEADER_SIZE) // 8
+_ARENA_INDEX = 1
+_ARENA_VALUES = 2
+_ARENA_FREE = 3
+# The pid of values segments holding the values of compacted processes.
+_ARENA_AGGREGATE_PID = 0
+# A NaN that arithmetic never produces, marking value slots a process hasn't used.
+_ARENA_UNSET = struct.pack(b'Q', 0x7ff4000000000bad)
+
+
+class _Arena(object):
+    """The values of all processes, in one shared file.
+
+    The file is made of segments of _ARENA_SEGMENT_SIZE bytes, so each can be
+    mmapped on its own. The first holds _ARENA_MAGIC and then the number of
+    segments as an 8 byte int. Every other segment starts with 4 byte ints of
+    its kind, pid, first, used and dead, padded to _ARENA_HEADER_SIZE.
+
+    Index segments hold the keys of all series as _MmapedDict entries up to
+    used, whose values are unused. Series are numbered in the order of their
+    keys across index segments. Values segments hold the values of a process
+    for _ARENA_SLOTS series starting at first, with _ARENA_UNSET for those
+    the process hasn't used. dead is set by mark_process_dead.
+
+    When a dead process is compacted, its values are moved into values
+    segments of _ARENA_AGGREGATE_PID and its segments become free segments,
+    which are reused for the values of new processes. Index segments are only
+    ever appended, so that processes find them by reading the new segments.
+
+    Segments and keys are only added under an exclusive flock on the file.
+    Values are written without locking, as only their process writes them.
+    """
+    def __init__(self, filename, pid):
+        if fcntl is None:
+            raise ValueError('The arena backend requires fcntl')
+        self._pid = pid
+        self._lock = Lock()
+        self._fd = os.open(filename, os.O_RDWR | os.O_CREAT)
+        self._segments = {}
+        self._known = 1
+        self._index = []
+        self._read_to = {}
+        self._strings = []
+        self._string_ids = {}
+        self._ids = {}
+        self._values = {}
+        self._slots = {}
+        with self._file_lock():
+            if os.fstat(self._fd).st_size == 0:
+                os.ftruncate(self._fd, _ARENA_SEGMENT_SIZE)
+                self._segment(0)[:8] = _ARENA_MAGIC
+                struct.pack_into(b'q', self._segment(0), 8, 1)
+            elif self._segment(0)[:8] != _ARENA_MAGIC:
+                raise ValueError('Not a metrics arena: ' + filename)
+
+    @contextmanager
+    def _file_lock(self):
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _segment(self, n):
+        m = self._segments.get(n)
+        if m is None:
+            m = self._segments[n] = mmap.mmap(self._fd, _ARENA_SEGMENT_SIZE, offset=n * _ARENA_SEGMENT_SIZE)
+        return m
+
+    def _catch_up(self):
+        """Read the segments and keys added by other processes. File lock must be held."""
+        count = struct.unpack_from(b'q', self._segment(0), 8)[0]
+        for n in range(self._known, count):
+            if struct.unpack_from(b'i', self._segment(n), 0)[0] == _ARENA_INDEX:
+                self._index.append(n)
+                self._read_to[n] = _ARENA_HEADER_SIZE
+        self._known = count
+        num_strings = len(self._strings)
+        for n in self._index:
+            m = self._segment(n)
+            used = struct.unpack_from(b'i', m, 12)[0]
+            for key, _ in _read_mmaped_entries(m, self._read_to[n], used, self._strings):
+                self._ids[key] = len(self._ids)
+            self._read_to[n] = used
+        for i in range(num_strings, len(self._strings)):
+            self._string_ids[self._strings[i]] = i
+
+    def _free_segment(self):
+        """Returns the number of a free segment, or None. File lock must be held, and caught up."""
+        for n in range(1, self._known):
+            if struct.unpack_from(b'i', self._segment(n), 0)[0] == _ARENA_FREE:
+                return n
+        return None
+
+    def _allocate(self, kind, first):
+        """Add a segment, returning its number. File lock must be held, and caught up."""
+        n = self._free_segment() if kind == _ARENA_VALUES else None
+        if n is None:
+            n = self._known
+            os.ftruncate(self._fd, (n + 1) * _ARENA_SEGMENT_SIZE)
+        m = self._segment(n)
+        if kind == _ARENA_VALUES:
+            m[_ARENA_HEADER_SIZE:] = _ARENA_UNSET * _ARENA_SLOTS
+        # Readers skip a reused segment until its header is written.
+        struct.pack_into(b'5i', m, 0, kind, self._pid, first, _ARENA_HEADER_SIZE, 0)
+        if n == self._known:
+            self._known = n + 1
+            struct.pack_into(b'q', self._segment(0), 8, self._known)
+        return n
+
+    def _append(self, encoded):
+        """Append an index entry. File lock must be held, and caught up."""
+        # Pad to be 8-byte aligned.
+        padded = encoded + (b' ' * (8 - (len(encoded) + 4) % 8))
+        value = struct.pack('i{0}sd'.format(len(padded)).encode(), len(encoded), padded, 0.0)
+        if len(value) > _ARENA_SEGMENT_SIZE - _ARENA_HEADER_SIZE:
+            raise ValueError('Key too long for the arena')
+        n = self._index[-1] if self._index else None
+        if n is None or self._read_to[n] + len(value) > _ARENA_SEGMENT_SIZE:
+            n = self._allocate(_ARENA_INDEX, 0)
+            self._index.append(n)
+            self._read_to[n] = _ARENA_HEADER_SIZE
+        m = self._segment(n)
+        used = self._read_to[n]
+        m[used:used + len(value)] = value
+        self._read_to[n] = used + len(value)
+        struct.pack_into(b'i', m, 12, self._read_to[n])
+
+    def _intern(self, string):
+        """Returns the index of string, appending it if needed. File lock must be held."""
+        if string not in self._string_ids:
+            self._append(_INTERNED_STRING + string.encode('utf-8'))
+            self._string_ids[string] = len(self._strings)
+            self._strings.append(string)
+        return self._string_ids[string]
+
+    def slot(self, key):
+        """Returns a _slot_view of the value of key for this process."""
+        slot = self._slots.get(key)
+        if slot is not None:
+            return slot
+        with self._lock:
+            series = self._ids.get(key)
+            if series is None or series // _ARENA_SLOTS not in self._values:
+                with self._file_lock():
+                    self._catch_up()
+                    series = self._ids.get(key)
+                    if series is None:
+                        self._append(_encode_compact_key(key, self._intern))
+                        series = self._ids[key] = len(self._ids)
+                    chunk = series // _ARENA_SLOTS
+                    if chunk not in self._values:
+                        self._values[chunk] = self._allocate(_ARENA_VALUES, chunk * _ARENA_SLOTS)
+            m = self._segment(self._values[series // _ARENA_SLOTS])
+            pos = _ARENA_HEADER_SIZE + series % _ARENA_SLOTS * 8
+            if m[pos:pos + 8] == _ARENA_UNSET:
+                struct.pack_into(b'd', m, pos, 0.0)
+            slot = self._slots[key] = _slot_view(m, pos)
+            return slot
+
+    def read_value(self, key):
+        return self.slot(key)[0]
+
+    def write_value(self, key, value):
+        self.slot(key)[0] = value
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+_RING_MAGIC = b'PROMRING'
+_RING_HEADER_SIZE = 64
+_RING_CAPACITY = 1 << 16
+# Records are an 8 byte tag, which is the series id shifted left by 2 plus
+# the kind of the record, and a double.
+_RING_RECORD = struct.Struct(b'qd')
+# The record holds the new value of the series.
+_RING_VALUE = 0
+# A process started writing to the ring, so values start again from 0.
+_RING_START = 2
+
+
+class _StructArray(object):
+    """The 8 byte items of data, for Pythons whose memoryviews can't be cast."""
+    def __init__(self, data, fmt):
+        self._data = data
+        self._fmt = fmt
+
+    def __getitem__(self, i):
+        return struct.unpack_from(self._fmt, self._data, i * 8)[0]
+
+    def __setitem__(self, i, value):
+        struct.pack_into(self._fmt, self._data, i * 8, value)
+
+
+def _array_view(data, fmt):
+    """Returns a view of the mmap data as an array of 8 byte items of type fmt."""
+    try:
+        return memoryview(data).cast(fmt)
+    except (AttributeError, NameError, TypeError):
+        # Python 2.
+        return _StructArray(data, fmt.encode())
+
+
+class _RingBuffer(object):
+    """A ring of records from one process, to be read by an aggregator.
+
+    The file starts with _RING_MAGIC, and then 8 byte ints of the capacity in
+    records, the write index, the read index, the number of writes which were
+    queued as the ring was full, whether the process was marked as dead, and
+    the token of the aggregator which last drained the ring.
+    The records start at _RING_HEADER_SIZE. Indexes only ever increase, and
+    the record of an index is at index modulo capacity.
+
+    The keys of the series are appended to a .keys file next to the ring, one
+    JSON encoded [series id, key] per line, before any value of the series is
+    written. They are kept out of the ring so that an aggregator which starts
+    after they were written can still read them. A process reusing the pid
+    of an earlier one carries on with its series ids.
+
+    Only this process moves the write index, and only the aggregator draining
+    the ring moves the read index, so neither needs a lock. A write index is only moved once the
+    records before it are written. When the ring is full, the latest value of
+    each series is kept in memory, and written once there's space again.
+    """
+    def __init__(self, filename, capacity=_RING_CAPACITY):
+        self._lock = Lock()
+        self._f = open(filename, 'a+b')
+        if os.fstat(self._f.fileno()).st_size == 0:
+            self._f.truncate(_RING_HEADER_SIZE + capacity * _RING_RECORD.size)
+            self._m = mmap.mmap(self._f.fileno(), 0)
+            struct.pack_into(b'q', self._m, 8, capacity)
+            # Readers ignore the ring until the magic is there.
+            self._m[:8] = _RING_MAGIC
+        else:
+            # A process with the same pid wrote to this ring before.
+            self._m = mmap.mmap(self._f.fileno(), 0)
+            struct.pack_into(b'q', self._m, 40, 0)
+        keys_filename = filename[:-len('.ring')] + '.keys'
+        self._slots = {}
+        # The series ids of earlier processes with the same pid.
+        self._earlier_ids = {}
+        if os.path.exists(keys_filename):
+            with open(keys_filename, 'rb') as f:
+                for line in f:
+                    if line.endswith(b'\n'):
+                        series, key = json.loads(line.decode('utf-8'))
+                        self._earlier_ids[_ring_key(key)] = series
+        self._next_series = max(self._earlier_ids.values()) + 1 if self._earlier_ids else 0
+        self._keys_fd = os.open(keys_filename, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        # Writes go through views of the 8 byte words of the file, which are
+        # much cheaper than struct calls.
+        self._words = _array_view(self._m, 'q')
+        self._doubles = _array_view(self._m, 'd')
+        self._capacity = self._words[1]
+        # Only this process moves the write index, so it can be kept here.
+        # The read index is reread when the ring seems to be full.
+        self._write_index = self._words[2]
+        self._read_index = self._words[3]
+        # Groups of records which have to be written before any others.
+        self._backlog = []
+        # Series id to the value still to be written.
+        self._pending = {}
+        with self._lock:
+            self._write([(_RING_START, 0.0)])
+
+    def _fits(self, n):
+        """Returns whether n more records fit. Lock must be held by caller."""
+        if self._write_index + n - self._read_index > self._capacity:
+            self._read_index = self._words[3]
+        return self._write_index + n - self._read_index <= self._capacity
+
+    def _put(self, records):
+        """Write the (tag, value) records if they all fit. Lock must be held by caller."""
+        if not self._fits(len(records)):
+            return False
+        for tag, value in records:
+            i = (_RING_HEADER_SIZE // 8) + self._write_index % self._capacity * 2
+            self._words[i] = tag
+            self._doubles[i + 1] = value
+            self._write_index += 1
+        self._words[2] = self._write_index
+        return True
+
+    def _write(self, records):
+        """Write a group of records, or queue it if there's no space. Lock must be held by caller."""
+        if self._backlog or self._pending or not self._put(records):
+            self._backlog.append(records)
+            self._queued()
+
+    def _queued(self):
+        """Count a write being queued, and write what was queued if there's space now."""
+        self._words[4] += 1
+        read = self._words[3]
+        if read == self._read_index:
+            # Nothing was read since the ring was last full.
+            return
+        self._read_index = read
+        while self._backlog and self._put(self._backlog[0]):
+            self._backlog.pop(0)
+        if self._backlog:
+            return
+        while self._pending:
+            series, value = self._pending.popitem()
+            if not self._put([(series << 2 | _RING_VALUE, value)]):
+                self._pending[series] = value
+                return
+
+    def write_value(self, series, value):
+        with self._lock:
+            if not (self._backlog or self._pending) and (
+                    self._write_index - self._read_index < self._capacity or self._fits(1)):
+                i = (_RING_HEADER_SIZE // 8) + self._write_index % self._capacity * 2
+                self._words[i] = series << 2 | _RING_VALUE
+                self._doubles[i + 1] = value
+                self._write_index += 1
+                self._words[2] = self._write_index
+                return
+            self._pending[series] = value
+            self._queued()
+
+    def slot(self, key):
+        """Returns the _RingSlot of key, registering the series if needed.
+
+        The slot holds the last value written, so the same one is returned
+        every time, as a value that is created again carries on from it.
+        """
+        with self._lock:
+            slot = self._slots.get(key)
+            if slot is None:
+                series = self._earlier_ids.pop(key, None)
+                if series is None:
+                    series = self._next_series
+                    self._next_series += 1
+                    # One write, so that readers never see part of a line.
+                    os.write(self._keys_fd, json.dumps([series, key]).encode('utf-8') + b'\n')
+                slot = self._slots[key] = _RingSlot(self, series)
+                # The series is reported from when it's created, as with the other backends.
+                self._write([(series << 2 | _RING_VALUE, 0.0)])
+            return slot
+
+
+def _ring_key(key):
+    '''Returns the key of a series from its JSON decoded form.'''
+    file_prefix, metric_name, name, labelnames, labelvalues = key
+    return (file_prefix, metric_name, name, tuple(labelnames), tuple(labelvalues))
+
+
+class _RingSlot(object):
+    """Writes the values of a series to a _RingBuffer, with the interface of _slot_view."""
+    def __init__(self, ring, series):
+        self._ring = ring
+        self._series = series
+        self._value = 0.0
+
+    def __getitem__(self, i):
+        return self._value
+
+    def __setitem__(self, i, value):
+        self._value = value
+        self._ring.write_value(self._series, value)
+
+
+class _PrefixedDict(object):
+    """The slots of one file prefix in a store shared by all file prefixes of a process."""
+    def __init__(self, store, file_prefix):
+        self._store = store
+        self._prefix = (file_prefix, )
+
+    def slot(self, key):
+        return self._store.slot(self._prefix + key)
+
+
+_MULTIPROCESS_BACKENDS = ('files', 'dense', 'arena', 'ring')
+
+
+if hasattr(os, 'register_at_fork'):
+    # The value classes of _MultiProcessValue told about forks. Hooks can't be
+    # unregistered, so one is registered for all of them, and a class is
+    # dropped from here once nothing uses it.
+    _fork_value_classes = weakref.WeakSet()
+    # The classes locked before the current fork.
+    _forking = []
+
+    def _before_fork():
+        for value_class in list(_fork_value_classes):
+            value_class._before_fork()
+            _forking.append(value_class)
+
+    def _after_fork_in_parent():
+        while _forking:
+            _forking.pop()._after_fork_in_parent()
+
+    def _after_fork_in_child():
+        while _forking:
+            _forking.pop()._after_fork_in_child()
+
+    os.register_at_fork(
+        before=_before_fork, after_in_parent=_after_fork_in_parent, after_in_child=_after_fork_in_child)
+
+
+def _MultiProcessValue(_pidFunc=os.getpid, backend='files', flush_interval=None, flush_batch=100):
+    """Returns a value class for multi-process mode.
+
+    The backend is 'files' for a _MmapedDict per process and file prefix,
+    'dense' for a _DenseMmapedDict instead, 'arena' for an _Arena shared by
+    all processes, or 'ring' for a _RingBuffer per process.
+
+    Files are named after the pid returned by _pidFunc. After a fork, values
+    are rebound to the files of the new process the next time they're used,
+    starting from what is in those files. Where os.register_at_fork is
+    available, forks are noticed without calling _pidFunc on every update.
+
+    If flush_interval is given, values are written behind: updates only change
+    the value in memory, and are written to the file by a daemon thread every
+    flush_interval seconds, when a value has had flush_batch updates since it
+    was last written, and when the process exits.
+    """
+    if backend not in _MULTIPROCESS_BACKENDS:
+        raise ValueError('Unknown multiprocess backend: ' + backend)
+    # The pid that files holds the files of. A list, so that it can be updated.
+    pid = [_pidFunc()]
     files = {}
     files_lock = Lock()
+    dirty = set()
+    dirty_lock = Lock()
+    flusher = []
+
+    def forked(current):
+        """Forget the files and pending writes of the parent process."""
+        files.clear()
+        dirty.clear()
+        del flusher[:]
+        pid[0] = current
+
+    at_fork = hasattr(os, 'register_at_fork') and _pidFunc is os.getpid
+    if at_fork:
+        def before():
+            files_lock.acquire()
+            dirty_lock.acquire()
+
+        def after_in_parent():
+            dirty_lock.release()
+            files_lock.release()
+
+        def after_in_child():
+            after_in_parent()
+            forked(os.getpid())
+
+    def open_file(file_prefix):
+        """Returns the _MmapedDict or _PrefixedDict for file_prefix. files_lock must be held."""
+        path = os.environ['prometheus_multiproc_dir']
+        if backend in ('files', 'dense'):
+            dict_class = _MmapedDict if backend == 'files' else _DenseMmapedDict
+            return dict_class(os.path.join(path, '{0}_{1}.db'.format(file_prefix, pid[0])))
+        if None not in files:
+            if backend == 'arena':
+                files[None] = _Arena(os.path.join(path, _ARENA_FILENAME), pid[0])
+            else:
+                files[None] = _RingBuffer(os.path.join(path, 'ring_{0}.ring'.format(pid[0])))
+        return _PrefixedDict(files[None], file_prefix)
+
+    def flush():
+        """Write all values that have been updated since they were last written."""
+        with dirty_lock:
+            values = list(dirty)
+            dirty.clear()
+        for value in values:
+            value._flush()
+
+    def run_flusher():
+        while True:
+            time.sleep(flush_interval)
+            flush()
+
+    if flush_interval is not None:
+        atexit.register(flush)
+
+    def mark_dirty(value):
+        """Queue a value to be written by the flusher. The lock of the value must be held."""
+        with dirty_lock:
+            dirty.add(value)
+            if not flusher:
+                flusher.append(Thread(target=run_flusher))
+                flusher[0].daemon = True
+                flusher[0].start()
 
     class _MmapedValue(object):
         '''A float protected by a mutex backed by a per-process mmaped file.'''
 
         _multiprocess = True
+        __slots__ = ('_file_prefix', '_key', '_pid', '_slot', '_value', '_pending', '_lock')
 
         def __init__(self, typ, metric_name, name, labelnames, labelvalues, multiprocess_mode='', **kwargs):
             if typ == 'gauge':
-                file_prefix = typ + '_' +  multiprocess_mode
+                self._file_prefix = typ + '_' +  multiprocess_mode
             else:
-                file_prefix = typ
+                self._file_prefix = typ
+            self._key = (metric_name, name, tuple(labelnames), tuple(labelvalues))
+            self._pid = None
+            self._bind()
+
+        def _bind(self):
+            """Bind to the slot of the value in the file of the current process."""
+            current = pid[0] if at_fork else _pidFunc()
             with files_lock:
-                if file_prefix not in files:
-                    filename = os.path.join(
-                            os.environ['prometheus_multiproc_dir'], '{0}_{1}.db'.format(file_prefix, pid))
-                    files[file_prefix] = _MmapedDict(filename)
-            self._file = files[file_prefix]
-            self._key = json.dumps((metric_name, name, labelnames, labelvalues))
-            self._value = self._file.read_value(self._key)
-            self._lock = Lock()
+                if self._pid == current:
+                    # Another thread got here first.
+                    return
+                if pid[0] != current:
+                    forked(current)
+                if self._file_prefix not in files:
+                    files[self._file_prefix] = open_file(self._file_prefix)
+                # Writes go straight to the slot of the value, without any lookups.
+                self._slot = files[self._file_prefix].slot(self._key)
+                self._value = self._slot[0]
+                self._pending = 0
+                # The lock may have been held by another thread of the parent.
+                self._lock = Lock()
+                self._pid = current
+
+        def _write_behind(self):
+            """Queue the value to be written, or write it if enough updates are pending. Lock must be held by caller."""
+            self._pending += 1
+            if self._pending == 1:
+                mark_dirty(self)
+            elif self._pending >= flush_batch:
+                self._slot[0] = self._value
+                self._pending = 0
+
+        def _flush(self):
+            with self._lock:
+                self._slot[0] = self._value
+                self._pending = 0
 
         def inc(self, amount):
+            if self._pid != (pid[0] if at_fork else _pidFunc()):
+                self._bind()
             with self._lock:
                 self._value += amount
-                self._file.write_value(self._key, self._value)
+                if flush_interval is None:
+                    self._slot[0] = self._value
+                else:
+                    self._write_behind()
 
         def set(self, value):
+            if self._pid != (pid[0] if at_fork else _pidFunc()):
+                self._bind()
             with self._lock:
                 self._value = value
-                self._file.write_value(self._key, self._value)
+                if flush_interval is None:
+                    self._slot[0] = self._value
+                else:
+                    self._write_behind()
 
         def get(self):
+            if self._pid != (pid[0] if at_fork else _pidFunc()):
+                self._bind()
             with self._lock:
                 return self._value
 
+    _MmapedValue.flush = staticmethod(flush)
+    if at_fork:
+        _MmapedValue._before_fork = staticmethod(before)
+        _MmapedValue._after_fork_in_parent = staticmethod(after_in_parent)
+        _MmapedValue._after_fork_in_child = staticmethod(after_in_child)
+        _fork_value_classes.add(_MmapedValue)
     return _MmapedValue
 
 
@@ -438,15 +1583,99 @@ def _MultiProcessValue(__pid=os.getpid()):
 # This needs to be chosen before the first metric is constructed,
 # and as that may be in some arbitrary library the user/admin has
 # no control over we use an enviroment variable.
+# The same goes for sharded values, which trade slower reads for
+# uncontended increments from many threads.
+# Multi-process mode keeps a file per process and metric type, unless
+# prometheus_multiproc_backend selects another backend of _MultiProcessValue.
+# Setting prometheus_multiproc_flush_interval to a number of seconds
+# writes values behind, see _MultiProcessValue.
 if 'prometheus_multiproc_dir' in os.environ:
-    _ValueClass = _MultiProcessValue()
+    _ValueClass = _MultiProcessValue(
+        backend=os.environ.get('prometheus_multiproc_backend', 'files'),
+        flush_interval=float(os.environ['prometheus_multiproc_flush_interval'])
+            if 'prometheus_multiproc_flush_interval' in os.environ else None,
+        flush_batch=int(os.environ.get('prometheus_multiproc_flush_batch', 100)))
+elif 'prometheus_sharded_values' in os.environ:
+    _ValueClass = _ShardedValue
 else:
     _ValueClass = _MutexValue
 
+_OVERFLOW_LABEL_VALUE = '__overflow__'
+
+_VALUE_BACKENDS = {
+    'mutex': _MutexValue,
+    'sharded': _ShardedValue,
+}
+if _ValueClass._multiprocess:
+    _VALUE_BACKENDS['multiprocess'] = _ValueClass
+
+
+def register_value_backend(name, value_class):
+    '''Make a value backend available to metrics by name.
+
+    Metrics and registries take a value_backend argument, which is either
+    the name of a registered backend or a value class itself. A value class
+    is called with the type of the metric, the metric name, the sample name,
+    the label names and the label values, and gauge options as keyword arguments,
+    and has inc(amount), set(value) and get() methods. Its _multiprocess
+    attribute says whether its values are collected by MultiProcessCollector.
+
+    'mutex' and 'sharded' are always registered, and 'multiprocess' is
+    when prometheus_multiproc_dir is set.
+    '''
+    if not hasattr(value_class, '_multiprocess'):
+        raise ValueError('Value class has no _multiprocess attribute: ' + repr(value_class))
+    _VALUE_BACKENDS[name] = value_class
+
+
+def _value_class(value_backend):
+    '''Returns the value class of a backend, or the process default for None.'''
+    if value_backend is None:
+        return _ValueClass
+    if isinstance(value_backend, (str, unicode)):
+        try:
+            return _VALUE_BACKENDS[value_backend]
+        except KeyError:
+            raise ValueError('Unknown value backend: ' + value_backend)
+    return value_backend
+
+
+# Set by _MetricWrapper on metrics without labels, which are their own collector.
+_METRIC_SLOTS = ('describe', 'collect', '_collect_names')
+
+# Sample labels and bucket bounds shared by all children with the same ones.
+_SHARED_LABELS = {}
+_SHARED_BOUNDS = {}
+
+
+def _shared_labels(name, bounds):
+    '''Returns the sample labels for the given le or quantile bounds.'''
+    key = (name, tuple(bounds))
+    labels = _SHARED_LABELS.get(key)
+    if labels is None:
+        labels = _SHARED_LABELS.setdefault(
+            key, tuple([_LabelDict({name: _floatToGoString(b)}) for b in bounds]))
+    return labels
+
 
 class _LabelWrapper(object):
-    '''Handles labels for the wrapped metric.'''
-    def __init__(self, wrappedClass, name, labelnames, **kwargs):
+    '''Handles labels for the wrapped metric.
+
+    If expire_after is set, children which have been idle for that many
+    seconds are removed. A child is idle if it hasn't been returned by
+    labels() and its samples haven't changed. Children are checked when
+    the metric is collected, and when a child is created, at most once
+    every expire_after seconds. Changes are only seen when children are
+    checked, so a child may have been idle for up to twice expire_after
+    by the time it is removed. In multiprocess mode the values of removed
+    children stay in the files, so they are still collected.
+
+    If max_series is set, once there are that many children labels()
+    returns a single overflow child, with all labels set to __overflow__,
+    for labelsets it doesn't have a child for yet. Each time this happens
+    it is counted in prometheus_client_label_sets_rejected_total.
+    '''
+    def __init__(self, wrappedClass, name, labelnames, expire_after=None, max_series=None, **kwargs):
         self._wrappedClass = wrappedClass
         self._type = wrappedClass._type
         self._name = name
@@ -454,6 +1683,27 @@ class _LabelWrapper(object):
         self._kwargs = kwargs
         self._lock = Lock()
         self._metrics = {}
+        # Per child, the labels of its samples when last collected, and those
+        # labels combined with the labels of the child.
+        self._sample_labels = {}
+        self._expire_after = expire_after
+        # Keys of children returned by labels() since they were last checked.
+        self._touched = None
+        # Per child, its sample values when last checked and when it was last active.
+        self._activity = {}
+        self._next_expiry = 0
+        self._expiry_lock = Lock()
+        self._timer = default_timer
+        if expire_after is not None:
+            if expire_after <= 0:
+                raise ValueError('expire_after must be positive')
+            self._touched = set()
+        self._max_series = max_series
+        self._overflow_key = (_OVERFLOW_LABEL_VALUE, ) * len(labelnames)
+        # Set by _MetricWrapper, which knows the full name of the metric.
+        self._rejected = None
+        if max_series is not None and max_series < 1:
+            raise ValueError('max_series must be at least 1')
 
         for l in labelnames:
             if l.startswith('__'):
@@ -479,9 +1729,32 @@ class _LabelWrapper(object):
             c.labels({'method': 'get', 'endpoint': '/'}).inc()
             c.labels({'method': 'post', 'endpoint': '/submit'}).inc()
 
+        The child returned can be kept and used directly, which saves
+        looking it up on every update:
+
+            get_root = c.labels('get', '/')
+            get_root.inc()
+
         See the best practices on [naming](http://prometheus.io/docs/practices/naming/)
         and [labels](http://prometheus.io/docs/practices/instrumentation/#use-labels).
         '''
+        # Children are never replaced, so an existing one can be found
+        # without the lock, and without converting values that are already strings.
+        try:
+            if not labelkwargs:
+                key = labelvalues
+            elif not labelvalues and len(labelkwargs) == len(self._labelnames):
+                key = tuple([labelkwargs[l] for l in self._labelnames])
+            else:
+                key = None
+            metric = self._metrics.get(key)
+        except (KeyError, TypeError):
+            metric = None
+        if metric is not None:
+            if self._touched is not None:
+                # Equal to the key of the child, so it works as one.
+                self._touched.add(key)
+            return metric
         if labelvalues and labelkwargs:
             raise ValueError("Can't pass both *args and **kwargs")
 
@@ -493,10 +1766,50 @@ class _LabelWrapper(object):
             if len(labelvalues) != len(self._labelnames):
                 raise ValueError('Incorrect label count')
             labelvalues = tuple([unicode(l) for l in labelvalues])
-        with self._lock:
-            if labelvalues not in self._metrics:
-                self._metrics[labelvalues] = self._wrappedClass(self._name, self._labelnames, labelvalues, **self._kwargs)
-            return self._metrics[labelvalues]
+        metric = self._metrics.get(labelvalues)
+        if metric is None:
+            # Many children share label values, so only keep one copy of each.
+            labelvalues = tuple([_intern(l) for l in labelvalues])
+            if self._expire_after is not None and self._timer() >= self._next_expiry:
+                self._expire()
+            with self._lock:
+                metric = self._metrics.get(labelvalues)
+                if metric is None and self._max_series is not None:
+                    series = len(self._metrics)
+                    if self._overflow_key in self._metrics:
+                        series -= 1
+                    if series >= self._max_series:
+                        if self._rejected is not None:
+                            self._rejected.inc()
+                        labelvalues = self._overflow_key
+                        metric = self._metrics.get(labelvalues)
+                if metric is None:
+                    metric = self._wrappedClass(self._name, self._labelnames, labelvalues, **self._kwargs)
+                    self._metrics[labelvalues] = metric
+                    if self._expire_after is not None:
+                        self._activity[labelvalues] = (
+                            tuple([value for _, _, value in metric._samples()]), self._timer())
+        if self._touched is not None:
+            self._touched.add(labelvalues)
+        return metric
+
+    def prepare_labels(self, labelsets):
+        '''Create the children for the given labelsets up front, and return them.
+
+        Each labelset is a sequence of label values or a dict, as taken by
+        labels(). This is intended for label spaces known at startup:
+
+            c = Counter('my_requests_total', 'HTTP Failures', ['method'])
+            get, post = c.prepare_labels([('get',), ('post',)])
+            get.inc()
+        '''
+        children = []
+        for labelset in labelsets:
+            if isinstance(labelset, dict):
+                children.append(self.labels(**labelset))
+            else:
+                children.append(self.labels(*labelset))
+        return children
 
     def remove(self, *labelvalues):
         '''Remove the given labelset from the metric.'''
@@ -505,19 +1818,76 @@ class _LabelWrapper(object):
         labelvalues = tuple([unicode(l) for l in labelvalues])
         with self._lock:
             del self._metrics[labelvalues]
+            self._activity.pop(labelvalues, None)
+            self._sample_labels.pop(labelvalues, None)
 
-    def _samples(self):
+    def _expire(self):
+        '''Remove idle children, and return the samples of the others by their labels.'''
+        with self._expiry_lock:
+            return self._expire_locked()
+
+    def _expire_locked(self):
+        now = self._timer()
         with self._lock:
             metrics = self._metrics.copy()
+            self._next_expiry = now + self._expire_after
+        touched, self._touched = self._touched, set()
+        samples = {}
+        expired = []
         for labels, metric in metrics.items():
-            series_labels = list(dict(zip(self._labelnames, labels)).items())
-            for suffix, sample_labels, value in metric._samples():
-                yield (suffix, dict(series_labels + list(sample_labels.items())), value)
+            samples[labels] = metric._samples()
+            values = tuple([value for _, _, value in samples[labels]])
+            last_values, last_active = self._activity.get(labels, (None, now))
+            if labels in touched or values != last_values:
+                last_active = now
+            elif now - last_active >= self._expire_after:
+                expired.append((labels, metric))
+                del samples[labels]
+                continue
+            self._activity[labels] = (values, last_active)
+        if expired:
+            with self._lock:
+                for labels, metric in expired:
+                    # Unless it was removed or recreated in the meantime.
+                    if self._metrics.get(labels) is metric:
+                        del self._metrics[labels]
+                        del self._activity[labels]
+                        self._sample_labels.pop(labels, None)
+            # In multiprocess mode the values of removed children stay in the
+            # files, so that they are picked up again if they are recreated.
+            # Make sure any written behind are there by then.
+            flush = getattr(self._kwargs.get('value_class'), 'flush', None)
+            if flush is not None:
+                flush()
+        return samples
+
+    def _samples(self, suffixes=None):
+        '''Yields the samples of all children, only those with the given suffixes if any.'''
+        if self._expire_after is not None:
+            children = self._expire().items()
+        else:
+            with self._lock:
+                metrics = self._metrics.copy()
+            children = [(labels, metric._samples()) for labels, metric in metrics.items()]
+        for labels, metric_samples in children:
+            sample_labels = [s[1] for s in metric_samples]
+            cached = self._sample_labels.get(labels)
+            if cached is None or cached[0] != sample_labels:
+                series_labels = list(zip(self._labelnames, labels))
+                cached = (sample_labels, [_LabelDict(series_labels + list(l.items())) for l in sample_labels])
+                self._sample_labels[labels] = cached
+            for (suffix, _, value), combined in zip(metric_samples, cached[1]):
+                if suffixes is None or suffix in suffixes:
+                    yield (suffix, combined, value)
 
 
 def _MetricWrapper(cls):
     '''Provides common functionality for metrics.'''
-    def init(name, documentation, labelnames=(), namespace='', subsystem='', registry=REGISTRY, **kwargs):
+    def init(name, documentation, labelnames=(), namespace='', subsystem='', registry=REGISTRY,
+             value_backend=None, **kwargs):
+        if value_backend is None and registry:
+            value_backend = getattr(registry, 'value_backend', None)
+        kwargs['value_class'] = _value_class(value_backend)
         full_name = ''
         if namespace:
             full_name += namespace + '_'
@@ -526,7 +1896,7 @@ def _MetricWrapper(cls):
         full_name += name
 
         if labelnames:
-            labelnames = tuple(labelnames)
+            labelnames = tuple([_intern(l) for l in labelnames])
             for l in labelnames:
                 if not _METRIC_LABEL_NAME_RE.match(l):
                     raise ValueError('Invalid label metric name: ' + l)
@@ -536,6 +1906,9 @@ def _MetricWrapper(cls):
                     raise ValueError('Reserved label metric name: ' + l)
             collector = _LabelWrapper(cls, name, labelnames, **kwargs)
         else:
+            for option in ('expire_after', 'max_series'):
+                if option in kwargs:
+                    raise ValueError(option + ' is only supported for metrics with labels')
             collector = cls(name, labelnames, (), **kwargs)
 
         if not _METRIC_NAME_RE.match(full_name):
@@ -552,8 +1925,32 @@ def _MetricWrapper(cls):
             return [metric]
         collector.collect = collect
 
+        def collect_names(names):
+            '''Like collect, but only with the samples of the given names.'''
+            suffixes = set([n[len(full_name):] for n in names if n.startswith(full_name)])
+            metric = Metric(full_name, documentation, cls._type)
+            if labelnames:
+                samples = collector._samples(suffixes)
+            else:
+                samples = [s for s in collector._samples() if s[0] in suffixes]
+            for suffix, labels, value in samples:
+                metric.add_sample(full_name + suffix, labels, value)
+            return [metric]
+        collector._collect_names = collect_names
+
         if registry:
             registry.register(collector)
+        if kwargs.get('max_series') is not None:
+            collector._rejected = LABEL_SETS_REJECTED.labels(full_name)
+            if registry:
+                with registry._lock:
+                    registered = LABEL_SETS_REJECTED in registry._collector_to_names
+                if not registered:
+                    try:
+                        registry.register(LABEL_SETS_REJECTED)
+                    except ValueError:
+                        # Registered concurrently.
+                        pass
         return collector
 
     return init
@@ -594,9 +1991,10 @@ class Counter(object):
     '''
     _type = 'counter'
     _reserved_labelnames = []
+    __slots__ = ('_value', ) + _METRIC_SLOTS
 
-    def __init__(self, name, labelnames, labelvalues):
-        self._value = _ValueClass(self._type, name, name, labelnames, labelvalues)
+    def __init__(self, name, labelnames, labelvalues, value_class=None):
+        self._value = value_class(self._type, name, name, labelnames, labelvalues)
 
     def inc(self, amount=1):
         '''Increment counter by the given amount.'''
@@ -604,6 +2002,25 @@ class Counter(object):
             raise ValueError('Counters can only be incremented by non-negative amounts.')
         self._value.inc(amount)
 
+    def inc_many(self, amounts):
+        '''Increment counter by each of the given amounts.
+
+        The amounts can be any iterable, including a NumPy array.
+        They are added up and applied in a single increment.
+        '''
+        if numpy is not None:
+            amounts = _float_array(amounts)
+            if (amounts < 0).any():
+                raise ValueError('Counters can only be incremented by non-negative amounts.')
+            total = float(amounts.sum())
+        else:
+            total = 0.0
+            for amount in amounts:
+                if amount < 0:
+                    raise ValueError('Counters can only be incremented by non-negative amounts.')
+                total += amount
+        self._value.inc(total)
+
     def count_exceptions(self, exception=Exception):
         '''Count exceptions in a block of code or function.
 
@@ -614,7 +2031,13 @@ class Counter(object):
         return _ExceptionCounter(self, exception)
 
     def _samples(self):
-        return (('', {}, self._value.get()), )
+        return (('', _NO_LABELS, self._value.get()), )
+
+
+LABEL_SETS_REJECTED = Counter('prometheus_client_label_sets_rejected_total',
+        'Labelsets given to metrics with max_series that got the overflow series.',
+        ['metric'], registry=None)
+'''Registered with the registries of metrics which use max_series.'''
 
 
 @_MetricWrapper
@@ -657,13 +2080,15 @@ class Gauge(object):
     '''
     _type = 'gauge'
     _reserved_labelnames = []
+    __slots__ = ('_value', '_function') + _METRIC_SLOTS
 
-    def __init__(self, name, labelnames, labelvalues, multiprocess_mode='all'):
-        if (_ValueClass._multiprocess
+    def __init__(self, name, labelnames, labelvalues, multiprocess_mode='all', value_class=None):
+        if (value_class._multiprocess
                 and multiprocess_mode not in ['min', 'max', 'livesum', 'liveall', 'all']):
             raise ValueError('Invalid multiprocess mode: ' + multiprocess_mode)
-        self._value = _ValueClass(self._type, name, name, labelnames,
+        self._value = value_class(self._type, name, name, labelnames,
                 labelvalues, multiprocess_mode=multiprocess_mode)
+        self._function = None
 
     def inc(self, amount=1):
         '''Increment gauge by the given amount.'''
@@ -703,12 +2128,12 @@ class Gauge(object):
         The function must return a float, and may be called from
         multiple threads. All other methods of the Gauge become NOOPs.
         '''
-        def samples(self):
-            return (('', {}, float(f())), )
-        self._samples = types.MethodType(samples, self)
+        self._function = f
 
     def _samples(self):
-        return (('', {}, self._value.get()), )
+        if self._function is not None:
+            return (('', _NO_LABELS, float(self._function())), )
+        return (('', _NO_LABELS, self._value.get()), )
 
 
 @_MetricWrapper
@@ -741,18 +2166,66 @@ class Summary(object):
 
         with REQUEST_TIME.time():
             pass  # Logic to be timed
+
+    A Summary can also estimate quantiles over a sliding time window.
+    Each quantile is given with the rank error allowed in its estimate:
+
+        s = Summary('request_size_bytes', 'Request size (bytes)',
+                    quantiles=((0.5, 0.05), (0.99, 0.001)))
+
+    By default the window covers the last 10 minutes, and moves forward in
+    2 minute steps. This can be changed with `max_age_seconds` and `age_buckets`.
+    Quantiles cannot be aggregated across processes, so they are not
+    available in multiprocess mode.
     '''
     _type = 'summary'
     _reserved_labelnames = ['quantile']
-
-    def __init__(self, name, labelnames, labelvalues):
-        self._count = _ValueClass(self._type, name, name + '_count', labelnames, labelvalues)
-        self._sum = _ValueClass(self._type, name, name + '_sum', labelnames, labelvalues)
+    __slots__ = ('_count', '_sum', '_quantiles', '_quantile_labels') + _METRIC_SLOTS
+
+    def __init__(self, name, labelnames, labelvalues, quantiles=(), max_age_seconds=600, age_buckets=5,
+                 value_class=None):
+        self._count = value_class(self._type, name, name + '_count', labelnames, labelvalues)
+        self._sum = value_class(self._type, name, name + '_sum', labelnames, labelvalues)
+        self._quantiles = None
+        if quantiles:
+            if value_class._multiprocess:
+                raise ValueError('Quantiles are not supported in multiprocess mode')
+            quantiles = [(float(q), float(e)) for q, e in quantiles]
+            for q, e in quantiles:
+                if not 0 < q < 1:
+                    raise ValueError('Quantile must be between 0 and 1: ' + repr(q))
+                if not 0 < e < 1:
+                    raise ValueError('Quantile error must be between 0 and 1: ' + repr(e))
+            if max_age_seconds <= 0:
+                raise ValueError('max_age_seconds must be positive')
+            if age_buckets < 1:
+                raise ValueError('Must have at least one age bucket')
+            self._quantiles = _TimeWindowQuantiles(quantiles, max_age_seconds, age_buckets)
+            self._quantile_labels = _shared_labels('quantile', [q for q, _ in quantiles])
 
     def observe(self, amount):
         '''Observe the given amount.'''
         self._count.inc(1)
         self._sum.inc(amount)
+        if self._quantiles is not None:
+            self._quantiles.insert(amount)
+
+    def observe_many(self, amounts):
+        '''Observe each of the given amounts.
+
+        The amounts can be any iterable, including a NumPy array.
+        '''
+        if numpy is not None:
+            amounts = _float_array(amounts)
+            count, total = len(amounts), float(amounts.sum())
+        else:
+            amounts = list(amounts)
+            count, total = len(amounts), float(sum(amounts))
+        if count:
+            self._count.inc(count)
+            self._sum.inc(total)
+            if self._quantiles is not None:
+                self._quantiles.insert_many(amounts)
 
     def time(self):
         '''Time a block of code or function, and observe the duration in seconds.
@@ -762,9 +2235,169 @@ class Summary(object):
         return _SummaryTimer(self)
 
     def _samples(self):
-        return (
-            ('_count', {}, self._count.get()),
-            ('_sum', {}, self._sum.get()))
+        samples = []
+        if self._quantiles is not None:
+            for (q, value), labels in zip(self._quantiles.query(), self._quantile_labels):
+                samples.append(('', labels, value))
+        samples.append(('_count', _NO_LABELS, self._count.get()))
+        samples.append(('_sum', _NO_LABELS, self._sum.get()))
+        return tuple(samples)
+
+
+class _CKMSQuantiles(object):
+    '''Streaming quantile estimates with bounded rank error.
+
+    This is the targeted quantiles algorithm from Cormode, Korn, Muthukrishnan
+    and Srivastava, "Effective Computation of Biased Quantiles over Data Streams".
+    Observations are buffered and merged into a sorted list of samples in
+    batches, and the list is then compressed as far as the error targets allow.
+    Each sample is a list of [value, g, delta].
+    '''
+    _BUFFER_SIZE = 500
+
+    def __init__(self, quantiles):
+        self._quantiles = quantiles
+        self._count = 0
+        self._samples = []
+        self._buffer = []
+
+    def insert(self, value):
+        self._buffer.append(value)
+        if len(self._buffer) >= self._BUFFER_SIZE:
+            self._flush()
+
+    def insert_many(self, values):
+        self._buffer.extend(values)
+        if len(self._buffer) >= self._BUFFER_SIZE:
+            self._flush()
+
+    def query(self, quantile):
+        self._flush()
+        if not self._samples:
+            return float('nan')
+        desired = quantile * self._count
+        bound = desired + self._allowable_error(desired) / 2
+        rank = 0
+        prev = self._samples[0]
+        for cur in self._samples[1:]:
+            rank += prev[1]
+            if rank + cur[1] + cur[2] > bound:
+                return prev[0]
+            prev = cur
+        return prev[0]
+
+    def _allowable_error(self, rank, upto=None):
+        '''Returns the error allowed at a rank, or the least allowed at any rank up to upto.'''
+        size = self._count
+        error = size + 1
+        for q, e in self._quantiles:
+            # The error allowed for a target is least at its own rank.
+            r = rank if upto is None else min(max(q * size, rank), upto)
+            if r <= q * size:
+                error = min(error, 2 * e * (size - r) / (1 - q))
+            else:
+                error = min(error, 2 * e * r / q)
+        return error
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        self._buffer.sort()
+        samples = self._samples
+        i = 0
+        rank = 0
+        for value in self._buffer:
+            while i < len(samples) and samples[i][0] <= value:
+                rank += samples[i][1]
+                i += 1
+            self._count += 1
+            if i == 0 or i == len(samples):
+                # The minimum and maximum are always known exactly.
+                delta = 0
+            else:
+                # The true rank is at most that of the next sample, which
+                # is often much tighter than the error allowed at this rank.
+                following = samples[i]
+                delta = min(following[1] + following[2] - 1,
+                            max(int(math.floor(self._allowable_error(rank))) - 1, 0))
+            samples.insert(i, [value, 1, delta])
+            rank += 1
+            i += 1
+        self._buffer = []
+        self._compress()
+
+    def _compress(self):
+        '''Fold samples into the ones after them where the error allows, from the largest down.
+
+        The minimum is never folded, so that it stays known exactly.
+        '''
+        samples = self._samples
+        if len(samples) < 3:
+            return
+        cur = samples[-1]
+        # The rank of the sample before cur.
+        rank = self._count - cur[1]
+        compressed = [cur]
+        for i in range(len(samples) - 2, 0, -1):
+            prev = samples[i]
+            rank -= prev[1]
+            width = prev[1] + cur[1] + cur[2]
+            if width <= self._allowable_error(rank, rank + width):
+                cur[1] += prev[1]
+            else:
+                compressed.append(prev)
+                cur = prev
+        compressed.append(samples[0])
+        compressed.reverse()
+        self._samples = compressed
+
+
+class _TimeWindowQuantiles(object):
+    '''Quantile estimates over a sliding time window.
+
+    Observations go into several overlapping streams. The oldest stream
+    is reset every max_age_seconds / age_buckets, and queries are answered
+    from the oldest stream, which covers at most the last max_age_seconds.
+    '''
+    def __init__(self, quantiles, max_age_seconds, age_buckets, _timer=default_timer):
+        self._quantiles = quantiles
+        self._streams = [_CKMSQuantiles(quantiles) for i in range(age_buckets)]
+        self._head = 0
+        self._rotate_every = float(max_age_seconds) / age_buckets
+        self._timer = _timer
+        self._last_rotation = _timer()
+        self._lock = Lock()
+
+    def insert(self, value):
+        with self._lock:
+            self._rotate()
+            for stream in self._streams:
+                stream.insert(value)
+
+    def insert_many(self, values):
+        if numpy is not None and isinstance(values, numpy.ndarray):
+            values = values.tolist()
+        with self._lock:
+            self._rotate()
+            for stream in self._streams:
+                stream.insert_many(values)
+
+    def query(self):
+        '''Returns a list of (quantile, estimate) pairs.'''
+        with self._lock:
+            self._rotate()
+            stream = self._streams[self._head]
+            return [(q, stream.query(q)) for q, _ in self._quantiles]
+
+    def _rotate(self):
+        rotations = int((self._timer() - self._last_rotation) // self._rotate_every)
+        if rotations <= 0:
+            return
+        # Past a full window, every stream is reset.
+        for i in range(min(rotations, len(self._streams))):
+            self._streams[self._head] = _CKMSQuantiles(self._quantiles)
+            self._head = (self._head + 1) % len(self._streams)
+        self._last_rotation += rotations * self._rotate_every
 
 
 def _floatToGoString(d):
@@ -818,9 +2451,10 @@ class Histogram(object):
     '''
     _type = 'histogram'
     _reserved_labelnames = ['histogram']
+    __slots__ = ('_upper_bounds', '_bucket_labels', '_values') + _METRIC_SLOTS
 
-    def __init__(self, name, labelnames, labelvalues, buckets=(.005, .01, .025, .05, .075, .1, .25, .5, .75, 1.0, 2.5, 5.0, 7.5, 10.0, _INF)):
-        self._sum = _ValueClass(self._type, name, name + '_sum', labelnames, labelvalues)
+    def __init__(self, name, labelnames, labelvalues, buckets=(.005, .01, .025, .05, .075, .1, .25, .5, .75, 1.0, 2.5, 5.0, 7.5, 10.0, _INF),
+                 value_class=None):
         buckets = [float(b) for b in buckets]
         if buckets != sorted(buckets):
             # This is probably an error on the part of the user,
@@ -830,19 +2464,189 @@ class Histogram(object):
             buckets.append(_INF)
         if len(buckets) < 2:
             raise ValueError('Must have at least two buckets')
-        self._upper_bounds = buckets
+        self._bucket_labels = _shared_labels('le', buckets)
+        # The same for all children with these buckets.
+        self._upper_bounds = _SHARED_BOUNDS.setdefault(tuple(buckets), buckets)
+        if value_class is _MutexValue:
+            self._values = _ArrayHistogramValues(buckets)
+        else:
+            self._values = _HistogramValues(name, labelnames, labelvalues, buckets, value_class)
+
+    def observe(self, amount):
+        '''Observe the given amount.'''
+        bucket = bisect.bisect_left(self._upper_bounds, amount)
+        if not amount <= self._upper_bounds[bucket]:
+            # NaN doesn't fall into any bucket.
+            bucket = None
+        self._values.observe(bucket, amount)
+
+    def observe_many(self, amounts):
+        '''Observe each of the given amounts.
+
+        The amounts can be any iterable, including a NumPy array.
+        They are bucketed first, and then applied to the histogram in one update.
+        '''
+        counts, total = _bucket_counts(self._upper_bounds, amounts)
+        self._values.observe_many(counts, total)
+
+    def time(self):
+        '''Time a block of code or function, and observe the duration in seconds.
+
+        Can be used as a function decorator or context manager.
+        '''
+        return _HistogramTimer(self)
+
+    def _samples(self):
+        values = self._values.get()
+        samples = []
+        acc = 0
+        for i, labels in enumerate(self._bucket_labels):
+            acc += values[i]
+            samples.append(('_bucket', labels, acc))
+        samples.append(('_count', _NO_LABELS, acc))
+        samples.append(('_sum', _NO_LABELS, values[-1]))
+        return tuple(samples)
+
+
+_INF_BUCKET_LABELS = _LabelDict({'le': '+Inf'})
+
+
+def _float_array(amounts):
+    '''Returns the amounts as a NumPy array of floats.'''
+    if isinstance(amounts, numpy.ndarray):
+        return amounts.astype(float, copy=False)
+    return numpy.fromiter(amounts, float)
+
+
+def _bucket_counts(upper_bounds, amounts):
+    '''Returns how many of the amounts fall into each bucket, and their sum.'''
+    if numpy is not None:
+        amounts = _float_array(amounts)
+        # NaN sorts after +Inf, into the extra bucket that is dropped.
+        buckets = numpy.searchsorted(upper_bounds, amounts, side='left')
+        counts = numpy.bincount(buckets, minlength=len(upper_bounds) + 1)
+        return counts[:len(upper_bounds)].tolist(), float(amounts.sum())
+
+    counts = [0] * len(upper_bounds)
+    total = 0.0
+    for amount in amounts:
+        total += amount
+        bucket = bisect.bisect_left(upper_bounds, amount)
+        if amount <= upper_bounds[bucket]:
+            counts[bucket] += 1
+    return counts, total
+
+
+class _HistogramValues(object):
+    '''The bucket counts and sum of a Histogram, each in its own value.
+
+    Used with any value backend other than the mutex one, for example in
+    multiprocess mode where every sample needs its own slot.
+    '''
+    __slots__ = ('_sum', '_buckets')
+
+    def __init__(self, name, labelnames, labelvalues, upper_bounds, value_class):
+        self._sum = value_class('histogram', name, name + '_sum', labelnames, labelvalues)
         self._buckets = []
         bucket_labelnames = labelnames + ('le',)
-        for b in buckets:
-          self._buckets.append(_ValueClass(self._type, name, name + '_bucket', bucket_labelnames, labelvalues + (_floatToGoString(b),)))
+        for b in upper_bounds:
+            self._buckets.append(value_class('histogram', name, name + '_bucket',
+                bucket_labelnames, labelvalues + (_floatToGoString(b),)))
+
+    def observe(self, bucket, amount):
+        self._sum.inc(amount)
+        if bucket is not None:
+            self._buckets[bucket].inc(1)
+
+    def observe_many(self, counts, total):
+        self._sum.inc(total)
+        for bucket, count in enumerate(counts):
+            if count:
+                self._buckets[bucket].inc(count)
+
+    def get(self):
+        '''Returns the bucket counts followed by the sum.'''
+        return [b.get() for b in self._buckets] + [self._sum.get()]
+
+
+class _ArrayHistogramValues(object):
+    '''The bucket counts and sum of a Histogram in one array, under one lock.'''
+    __slots__ = ('_values', '_lock')
+
+    def __init__(self, upper_bounds):
+        # Bucket counts, followed by the sum.
+        self._values = array('d', [0.0]) * (len(upper_bounds) + 1)
+        self._lock = Lock()
+
+    def observe(self, bucket, amount):
+        with self._lock:
+            if bucket is not None:
+                self._values[bucket] += 1
+            self._values[-1] += amount
+
+    def observe_many(self, counts, total):
+        with self._lock:
+            for bucket, count in enumerate(counts):
+                self._values[bucket] += count
+            self._values[-1] += total
+
+    def get(self):
+        '''Returns the bucket counts followed by the sum.'''
+        with self._lock:
+            return self._values.tolist()
+
+
+@_MetricWrapper
+class ExponentialHistogram(object):
+    '''A Histogram with exponentially growing buckets, which need not be chosen up front.
+
+    Bucket boundaries are powers of 2 ** (2 ** -schema), so a higher schema gives
+    finer buckets. Only buckets that have had observations are stored, and
+    they are exposed as the usual cumulative `_bucket` series.
+
+    Example for an ExponentialHistogram:
+
+        from prometheus_client import ExponentialHistogram
+
+        h = ExponentialHistogram('request_latency_seconds', 'Request latency (seconds)')
+        h.observe(0.0042)
+
+    `schema` can range from -4 to 8, and defaults to 3 which gives buckets that
+    each cover around 9% more than the previous one. Observations no further
+    from zero than `zero_threshold` are counted in a single zero bucket.
+
+    If `max_buckets` is set, the schema is lowered whenever there are more
+    buckets than that, merging neighbouring buckets in pairs. This is only
+    available with the default mutex value backend, and not in multiprocess
+    mode, where the schema is fixed.
+    '''
+    _type = 'histogram'
+    _reserved_labelnames = ['le']
+    __slots__ = ('_values', ) + _METRIC_SLOTS
+
+    def __init__(self, name, labelnames, labelvalues, schema=3, zero_threshold=2.0 ** -128, max_buckets=0,
+                 value_class=None):
+        if not -4 <= schema <= 8:
+            raise ValueError('Schema must be between -4 and 8')
+        if zero_threshold < 0:
+            raise ValueError('Zero threshold must not be negative')
+        if value_class is _MutexValue:
+            self._values = _DictHistogramValues(schema, float(zero_threshold), max_buckets)
+        else:
+            if max_buckets:
+                if value_class._multiprocess:
+                    raise ValueError('max_buckets is not supported in multiprocess mode')
+                raise ValueError('max_buckets is only supported with the mutex value backend')
+            self._values = _SparseHistogramValues(name, labelnames, labelvalues, schema, float(zero_threshold),
+                                                  value_class)
 
     def observe(self, amount):
         '''Observe the given amount.'''
-        self._sum.inc(amount)
-        for i, bound in enumerate(self._upper_bounds):
-            if amount <= bound:
-                self._buckets[i].inc(1)
-                break
+        self._values.observe(amount)
+
+    def observe_many(self, amounts):
+        '''Observe each of the given amounts.'''
+        self._values.observe_many(amounts)
 
     def time(self):
         '''Time a block of code or function, and observe the duration in seconds.
@@ -852,16 +2656,171 @@ class Histogram(object):
         return _HistogramTimer(self)
 
     def _samples(self):
+        buckets, total = self._values.get()
         samples = []
-        acc = 0
-        for i, bound in enumerate(self._upper_bounds):
-            acc += self._buckets[i].get()
-            samples.append(('_bucket', {'le': _floatToGoString(bound)}, acc))
-        samples.append(('_count', {}, acc))
-        samples.append(('_sum', {}, self._sum.get()))
+        acc = 0.0
+        for bound, count in sorted(buckets):
+            acc += count
+            if bound != _INF:
+                samples.append(('_bucket', {'le': _floatToGoString(bound)}, acc))
+        samples.append(('_bucket', _INF_BUCKET_LABELS, acc))
+        samples.append(('_count', _NO_LABELS, acc))
+        samples.append(('_sum', _NO_LABELS, total))
         return tuple(samples)
 
 
+# Bucket boundaries within [0.5, 1) for each positive schema.
+_EXPONENTIAL_BOUNDS = dict((schema, [2 ** (i / 2.0 ** schema) / 2 for i in range(2 ** schema)])
+                           for schema in range(1, 9))
+
+
+def _exponential_bucket(schema, zero_threshold, amount):
+    '''Returns the key of the bucket the amount falls into.
+
+    Keys are (sign, index) pairs. Positive bucket index i holds amounts greater
+    than 2 ** ((i - 1) * 2 ** -schema) and at most 2 ** (i * 2 ** -schema).
+    Negative bucket index i holds amounts greater than -2 ** (i * 2 ** -schema)
+    and at most -2 ** ((i - 1) * 2 ** -schema), so upper bounds stay inclusive.
+    The zero bucket is (0, 0), and the infinities are (2, 0) and (-2, 0).
+    NaN doesn't fall into any bucket, and None is returned.
+    '''
+    if abs(amount) <= zero_threshold:
+        return (0, 0)
+    if amount == _INF:
+        return (2, 0)
+    if amount == _MINUS_INF:
+        return (-2, 0)
+    if math.isnan(amount):
+        return None
+    sign = 1 if amount > 0 else -1
+    frac, exp = math.frexp(abs(amount))
+    if schema > 0:
+        bounds = _EXPONENTIAL_BOUNDS[schema]
+        # Exact bounds belong to the bucket they are the upper bound of, which
+        # for negative amounts is the bucket above.
+        search = bisect.bisect_left if sign > 0 else bisect.bisect_right
+        return (sign, search(bounds, frac) + (exp - 1) * len(bounds))
+    if sign < 0:
+        return (sign, ((exp - 1) >> -schema) + 1)
+    if frac == 0.5:
+        # Exact powers of two are the upper bound of the previous bucket.
+        exp -= 1
+    return (sign, (exp + (1 << -schema) - 1) >> -schema)
+
+
+def _exponential_bucket_bound(schema, zero_threshold, key):
+    '''Returns the inclusive upper bound of the given bucket.'''
+    sign, index = key
+    if sign == 0:
+        return zero_threshold
+    if sign == 1:
+        return 2 ** (index * 2.0 ** -schema)
+    if sign == -1:
+        return -2 ** ((index - 1) * 2.0 ** -schema)
+    return _INF if sign == 2 else _MINUS_INF
+
+
+class _DictHistogramValues(object):
+    '''The populated bucket counts and sum of an ExponentialHistogram, under one lock.'''
+    __slots__ = ('_schema', '_zero_threshold', '_max_buckets', '_counts', '_sum', '_lock')
+
+    def __init__(self, schema, zero_threshold, max_buckets):
+        self._schema = schema
+        self._zero_threshold = zero_threshold
+        self._max_buckets = max_buckets
+        self._counts = {}
+        self._sum = 0.0
+        self._lock = Lock()
+
+    def observe(self, amount):
+        with self._lock:
+            self._observe(amount)
+            self._limit_buckets()
+
+    def observe_many(self, amounts):
+        with self._lock:
+            for amount in amounts:
+                self._observe(amount)
+            self._limit_buckets()
+
+    def _observe(self, amount):
+        key = _exponential_bucket(self._schema, self._zero_threshold, amount)
+        if key is not None:
+            self._counts[key] = self._counts.get(key, 0.0) + 1
+        self._sum += amount
+
+    def _limit_buckets(self):
+        while (self._max_buckets and len(self._counts) > self._max_buckets
+               and self._schema > -4):
+            # Halve the resolution. New bucket j covers old buckets 2j-1 and 2j.
+            self._schema -= 1
+            counts = {}
+            for (sign, index), count in self._counts.items():
+                if sign in (1, -1):
+                    index = (index + 1) // 2
+                key = (sign, index)
+                counts[key] = counts.get(key, 0.0) + count
+            self._counts = counts
+
+    def get(self):
+        '''Returns a list of (upper bound, count) pairs and the sum.'''
+        with self._lock:
+            return ([(_exponential_bucket_bound(self._schema, self._zero_threshold, key), count)
+                     for key, count in self._counts.items()], self._sum)
+
+
+class _SparseHistogramValues(object):
+    '''The populated bucket counts and sum of an ExponentialHistogram, each in its own value.
+
+    Used with any value backend other than the mutex one, for example in
+    multiprocess mode where every sample needs its own slot.
+    Values for buckets are created when they get their first observation.
+    '''
+    __slots__ = ('_name', '_labelnames', '_labelvalues', '_schema', '_zero_threshold', '_value_class',
+                 '_sum', '_counts', '_lock')
+
+    def __init__(self, name, labelnames, labelvalues, schema, zero_threshold, value_class):
+        self._name = name
+        self._labelnames = labelnames + ('le',)
+        self._labelvalues = labelvalues
+        self._schema = schema
+        self._zero_threshold = zero_threshold
+        self._value_class = value_class
+        self._sum = value_class('histogram', name, name + '_sum', labelnames, labelvalues)
+        self._counts = {}
+        self._lock = Lock()
+        # Always have a +Inf bucket, so that the count is exported.
+        self._bucket((2, 0))
+
+    def _bucket(self, key):
+        value = self._counts.get(key)
+        if value is None:
+            bound = _exponential_bucket_bound(self._schema, self._zero_threshold, key)
+            with self._lock:
+                if key not in self._counts:
+                    self._counts[key] = self._value_class('histogram', self._name, self._name + '_bucket',
+                        self._labelnames, self._labelvalues + (_floatToGoString(bound),))
+                value = self._counts[key]
+        return value
+
+    def observe(self, amount):
+        key = _exponential_bucket(self._schema, self._zero_threshold, amount)
+        if key is not None:
+            self._bucket(key).inc(1)
+        self._sum.inc(amount)
+
+    def observe_many(self, amounts):
+        for amount in amounts:
+            self.observe(amount)
+
+    def get(self):
+        '''Returns a list of (upper bound, count) pairs and the sum.'''
+        with self._lock:
+            counts = list(self._counts.items())
+        return ([(_exponential_bucket_bound(self._schema, self._zero_threshold, key), value.get())
+                 for key, value in counts], self._sum.get())
+
+
 class _HistogramTimer(object):
     def __init__(self, histogram):
         self._histogram = histogram
@@ -64,13 +64,10 @@ def generate_latest(registry=core.REGISTRY):
             metric.name, metric.documentation.replace('\\', r'\\').replace('\n', r'\n')))
         output.append('\n# TYPE {0} {1}\n'.format(metric.name, metric.type))
         for name, labels, value in metric.samples:
-            if labels:
-                labelstr = '{{{0}}}'.format(','.join(
-                    ['{0}="{1}"'.format(
-                     k, v.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"'))
-                     for k, v in sorted(labels.items())]))
+            if type(labels) is core._LabelDict:
+                labelstr = labels.rendered
             else:
-                labelstr = ''
+                labelstr = core._render_labels(labels)
             output.append('{0}{1} {2}\n'.format(name, labelstr, core._floatToGoString(value)))
     return ''.join(output).encode('utf-8')
 
@@ -4,91 +4,941 @@ from __future__ import unicode_literals
 
 import glob
 import json
+import logging
+import mmap
 import os
 import shelve
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from timeit import default_timer
 
 from . import core
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import fcntl
+except ImportError:
+    # Not Unix
+    fcntl = None
+
+# Taken shared while collecting, and exclusively while compacting files.
+_LOCK_FILENAME = 'compaction.lock'
+
+
+@contextmanager
+def _directory_lock(path, exclusive):
+    """Lock the directory, unless the lock file can't be opened or created.
+
+    An existing lock file is opened read-only, which is enough to lock it, so
+    that collecting doesn't write to the directory, and works where it's
+    mounted read-only.
+    """
+    if fcntl is None:
+        yield
+        return
+    filename = os.path.join(path, _LOCK_FILENAME)
+    try:
+        f = open(filename, 'rb')
+    except IOError:
+        try:
+            f = open(filename, 'ab')
+        except IOError:
+            # Nothing can be compacted in a directory we can't write to.
+            yield
+            return
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+    finally:
+        # Closing the file releases the lock.
+        f.close()
+
+
+class _FileState(object):
+    """What has been read so far from one file written by a _MmapedDict.
+
+    States are never modified once created, so they can be shared between
+    concurrent collections.
+    """
+    def __init__(self, inode, used=8, strings=(), keys=(), positions=()):
+        self.inode = inode
+        self.used = used
+        self.strings = strings
+        self.keys = keys
+        # Where the value of each key is.
+        self.positions = positions
+
+    def read_to(self, data, used):
+        """Returns a new state, with the entries up to used decoded."""
+        strings = list(self.strings)
+        keys = list(self.keys)
+        positions = list(self.positions)
+        for key, pos in core._read_mmaped_entries(data, self.used, used, strings):
+            keys.append(key)
+            positions.append(pos)
+        return _FileState(self.inode, used, strings, keys, positions)
+
+    def values(self, data):
+        """Returns the values of the keys."""
+        return [struct.unpack_from(b'd', data, pos)[0] for pos in self.positions]
+
+
+class _DenseFileState(object):
+    """What has been read so far from one file written by a _DenseMmapedDict.
+
+    States are never modified once created, so they can be shared between
+    concurrent collections.
+    """
+    def __init__(self, inode, chunks=(), strings=(), keys=()):
+        self.inode = inode
+        # (where the values start, how many there are, where the keys read end) per chunk.
+        self.chunks = chunks
+        self.strings = strings
+        self.keys = keys
+
+    def read_to(self, data, num_chunks):
+        """Returns the state with the entries of the first num_chunks chunks decoded.
+
+        Only the last chunk of a file gets new entries, so the keys of each
+        chunk are still in order after those of the chunks before it.
+        """
+        chunks = list(self.chunks)
+        strings = list(self.strings)
+        keys = list(self.keys)
+        changed = False
+        for n in range(num_chunks):
+            start = core._DenseMmapedDict._chunk_start(n)
+            keys_end = struct.unpack_from(b'q', data, start)[0]
+            if n == len(chunks):
+                chunks.append((start + 8, 0, core._DENSE_KEYS_START))
+            values_start, count, read_to = chunks[n]
+            if keys_end > read_to:
+                for key, _ in core._read_mmaped_entries(data, start + read_to, start + keys_end, strings, 0):
+                    keys.append(key)
+                    count += 1
+                chunks[n] = (values_start, count, keys_end)
+                changed = True
+        if not changed:
+            return self
+        return _DenseFileState(self.inode, chunks, strings, keys)
+
+    def values(self, data):
+        """Returns the values of the keys, reading those of each chunk at once."""
+        values = []
+        for values_start, count, _ in self.chunks:
+            values.extend(struct.unpack_from('{0}d'.format(count).encode(), data, values_start))
+        return values
+
+
+def _read_file_values(path, state):
+    """Returns the new state of a file, and a list of the values of its keys.
+
+    Only entries appended since the state was last updated are decoded,
+    the values of the others are read straight from their known positions.
+    The file is opened read-only, and files which have not been initialised
+    yet are treated as empty. Files of _MmapedDict and _DenseMmapedDict
+    are told apart by the magic at the start of the latter.
+    """
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        # The process was marked as dead after we listed the files.
+        return None, []
+    with f:
+        while True:
+            stat = os.fstat(f.fileno())
+            if stat.st_size == 0:
+                return None, []
+            m = mmap.mmap(f.fileno(), stat.st_size, access=mmap.ACCESS_READ)
+            dense = m[:8] == core._DENSE_MAGIC
+            if dense:
+                used = struct.unpack_from(b'q', m, 8)[0]
+                if core._DenseMmapedDict._chunk_start(used) <= stat.st_size:
+                    break
+            else:
+                used = struct.unpack_from(b'i', m, 0)[0]
+                if used <= stat.st_size:
+                    break
+            # The file was expanded after we looked at its size.
+            m.close()
+        try:
+            inode = (stat.st_dev, stat.st_ino)
+            if dense:
+                if not isinstance(state, _DenseFileState) or state.inode != inode:
+                    state = _DenseFileState(inode)
+                state = state.read_to(m, used)
+            else:
+                if not isinstance(state, _FileState) or state.inode != inode or used < state.used:
+                    state = _FileState(inode)
+                if used > state.used:
+                    state = state.read_to(m, used)
+            values = state.values(m)
+        finally:
+            m.close()
+    return state, values
+
+
+def _read_file(path, state):
+    """Returns the new state of a file, and a list of its (key, value) pairs."""
+    state, values = _read_file_values(path, state)
+    if state is None:
+        return state, values
+    return state, list(zip(state.keys, values))
+
+
+def _combine(samples, key, value, mode):
+    """Combine a value into samples, as the type and gauge mode of its metric require."""
+    if key not in samples:
+        samples[key] = value
+    elif mode == 'min':
+        samples[key] = min(samples[key], value)
+    elif mode == 'max':
+        samples[key] = max(samples[key], value)
+    elif mode in ('all', 'liveall'):
+        samples[key] = value
+    else:
+        # Counter, Summary, Histogram and livesum.
+        samples[key] += value
+
+
+def _parse_prefix(file_prefix):
+    """Returns the type and gauge mode of a file prefix, such as gauge_livesum."""
+    parts = file_prefix.split('_')
+    if parts[0] == 'gauge':
+        return parts[0], parts[1]
+    return parts[0], None
+
+
+def _parse_filename(path):
+    """Returns the type, gauge mode and pid of a file, such as gauge_all_123.db."""
+    parts = os.path.basename(path)[:-3].split('_')
+    typ, mode = _parse_prefix('_'.join(parts[:-1]))
+    return typ, mode, parts[-1]
+
+
+def _aggregate_file(metrics, path, values):
+    """Aggregate the (key, value) pairs read from a file into metrics."""
+    typ, mode, pid = _parse_filename(path)
+    _aggregate(metrics, typ, mode, pid, values)
+
+
+def _aggregate(metrics, typ, mode, pid, values):
+    """Aggregate the (key, value) pairs of one process and file prefix into metrics.
+
+    metrics maps metric names to [type, gauge mode, samples, buckets], where samples
+    maps (name, labels) to a value and buckets maps histogram labels to a dict of
+    upper bound to bucket value. This is picklable, so it can be sent back from a
+    worker process.
+    """
+    for key, value in values:
+        if not isinstance(key, tuple):
+            # Written by an older version of the client.
+            key = json.loads(key)
+        metric_name, name, labelnames, labelvalues = key
+        labels = tuple(zip(labelnames, labelvalues))
+        metric = metrics.get(metric_name)
+        if metric is None:
+            metric = metrics[metric_name] = [typ, mode, {}, {}]
+        if typ == 'gauge':
+            metric[1] = mode
+            if mode in ('all', 'liveall'):
+                labels += (('pid', pid), )
+            _combine(metric[2], (name, labels), value, mode)
+        elif typ == 'histogram' and name.endswith('_bucket'):
+            without_le = tuple([l for l in labels if l[0] != 'le'])
+            bucket = float(labelvalues[labelnames.index('le')])
+            _combine(metric[3].setdefault(without_le, {}), bucket, value, None)
+        else:
+            _combine(metric[2], (name, labels), value, None)
+
+
+def _read_arena(path):
+    """Returns a dict of (file prefix, pid, dead) to a list of (key, value) pairs,
+    for the values of all processes in the arena file at path.
+
+    Nothing is locked. Series and segments added while reading are left for
+    the next collection, as they are only counted once fully written.
+    """
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return {}
+    with f:
+        size = os.fstat(f.fileno()).st_size
+        if size < core._ARENA_SEGMENT_SIZE:
+            return {}
+        m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    try:
+        count = min(struct.unpack_from(b'q', m, 8)[0], size // core._ARENA_SEGMENT_SIZE)
+        keys = []
+        strings = []
+        segments = []
+        for n in range(1, count):
+            start = n * core._ARENA_SEGMENT_SIZE
+            kind, pid, first, used, dead = struct.unpack_from(b'5i', m, start)
+            if kind == core._ARENA_INDEX:
+                entries = core._read_mmaped_entries(m, start + core._ARENA_HEADER_SIZE, start + used, strings)
+                keys.extend(key for key, _ in entries)
+            elif kind == core._ARENA_VALUES:
+                segments.append((start, pid, first, dead))
+        result = {}
+        for start, pid, first, dead in segments:
+            pos = start + core._ARENA_HEADER_SIZE
+            for key in keys[first:first + core._ARENA_SLOTS]:
+                raw = m[pos:pos + 8]
+                pos += 8
+                if raw != core._ARENA_UNSET:
+                    values = result.setdefault((key[0], str(pid), bool(dead)), [])
+                    values.append((key[1:], struct.unpack(b'd', raw)[0]))
+    finally:
+        m.close()
+    return result
+
+
+def _aggregate_arena(metrics, path):
+    """Aggregate the values in an arena file into metrics."""
+    for (file_prefix, pid, dead), values in sorted(_read_arena(path).items()):
+        typ, mode = _parse_prefix(file_prefix)
+        if dead and mode in ('livesum', 'liveall'):
+            continue
+        _aggregate(metrics, typ, mode, pid, values)
+
+
+def _mark_ring_process_dead(pid, path):
+    """Flag the ring buffer of a process as dead."""
+    try:
+        f = open(os.path.join(path, 'ring_{0}.ring'.format(pid)), 'r+b')
+    except IOError:
+        return
+    with f:
+        m = mmap.mmap(f.fileno(), 0)
+        struct.pack_into(b'q', m, 40, 1)
+        m.close()
+
+
+def _mark_arena_process_dead(pid, path):
+    """Flag the values segments of a process in an arena as dead."""
+    try:
+        f = open(path, 'r+b')
+    except IOError:
+        return
+    with f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        size = os.fstat(f.fileno()).st_size
+        m = mmap.mmap(f.fileno(), size)
+        try:
+            count = struct.unpack_from(b'q', m, 8)[0]
+            for n in range(1, count):
+                start = n * core._ARENA_SEGMENT_SIZE
+                kind, segment_pid = struct.unpack_from(b'2i', m, start)
+                if kind == core._ARENA_VALUES and segment_pid == pid:
+                    struct.pack_into(b'i', m, start + 16, 1)
+        finally:
+            m.close()
+
+
+def _compact_arena_process(pid, path):
+    """Move the values of a dead process in an arena into aggregate segments, and free its segments.
+
+    Counter, summary and histogram values are added to those of the aggregate
+    segments, and min and max gauges are combined with them. Live gauges are
+    dropped. A segment holding gauges of the all mode is kept for them, as
+    they are reported per process, but its other values are moved all the same.
+    """
+    if not os.path.exists(path):
+        return
+    arena = core._Arena(path, core._ARENA_AGGREGATE_PID)
+    try:
+        with arena._file_lock():
+            arena._catch_up()
+            keys = [None] * len(arena._ids)
+            for key, series in arena._ids.items():
+                keys[series] = key
+            aggregates = {}
+            segments = []
+            for n in range(1, arena._known):
+                kind, segment_pid, first = struct.unpack_from(b'3i', arena._segment(n), 0)
+                if kind != core._ARENA_VALUES:
+                    continue
+                if segment_pid == core._ARENA_AGGREGATE_PID:
+                    aggregates[first] = n
+                elif segment_pid == pid:
+                    segments.append((n, first))
+            for n, first in segments:
+                m = arena._segment(n)
+                kept = False
+                for i, key in enumerate(keys[first:first + core._ARENA_SLOTS]):
+                    pos = core._ARENA_HEADER_SIZE + i * 8
+                    if m[pos:pos + 8] == core._ARENA_UNSET:
+                        continue
+                    typ, mode = _parse_prefix(key[0])
+                    if mode == 'all':
+                        kept = True
+                        continue
+                    if mode not in ('livesum', 'liveall'):
+                        if first not in aggregates:
+                            aggregates[first] = arena._allocate(core._ARENA_VALUES, first)
+                        aggregate = arena._segment(aggregates[first])
+                        value = struct.unpack_from(b'd', m, pos)[0]
+                        if aggregate[pos:pos + 8] != core._ARENA_UNSET:
+                            total = struct.unpack_from(b'd', aggregate, pos)[0]
+                            if mode == 'min':
+                                value = min(value, total)
+                            elif mode == 'max':
+                                value = max(value, total)
+                            else:
+                                value += total
+                        struct.pack_into(b'd', aggregate, pos, value)
+                    m[pos:pos + 8] = core._ARENA_UNSET
+                if not kept:
+                    struct.pack_into(b'i', m, 0, core._ARENA_FREE)
+    finally:
+        arena.close()
+
+
+class _RingReader(object):
+    """Drains the records of one _RingBuffer into the files of its process.
+
+    The latest value of each series is written to the file of its type and
+    process, as the files backend would write it, so that any process can
+    collect the values and they outlive the reader. When another process
+    starts writing to the ring, the counter, summary and histogram files of
+    the previous one are compacted and its gauge files are removed, as values
+    start again from 0.
+    """
+    def __init__(self, f, m):
+        self._f = f
+        self._m = m
+        stat = os.fstat(f.fileno())
+        self.inode = (stat.st_dev, stat.st_ino)
+        self._capacity = struct.unpack_from(b'q', self._m, 8)[0]
+        self._path = os.path.dirname(f.name)
+        self.pid = os.path.basename(f.name)[5:-5]
+        self._keys_filename = f.name[:-len('.ring')] + '.keys'
+        # How much of the keys file has been read.
+        self._keys_offset = 0
+        self._keys = {}
+        # File prefix to the _MmapedDict the values are written to.
+        self._files = {}
+
+    @classmethod
+    def open(cls, filename):
+        """Returns a reader for the ring, or None if it isn't initialised yet."""
+        f = open(filename, 'r+b')
+        if os.fstat(f.fileno()).st_size < core._RING_HEADER_SIZE:
+            f.close()
+            return None
+        m = mmap.mmap(f.fileno(), 0)
+        if m[:8] != core._RING_MAGIC:
+            m.close()
+            f.close()
+            return None
+        return cls(f, m)
+
+    def _close_files(self):
+        for d in self._files.values():
+            d.close()
+        self._files = {}
+
+    def close(self):
+        self._close_files()
+        self._m.close()
+        self._f.close()
+
+    def claim(self, token):
+        """Mark the ring as drained by the aggregator with the given token.
+
+        If another aggregator drained it since, the files may have had values
+        appended by it, so they are opened again rather than written over.
+        """
+        if struct.unpack_from(b'q', self._m, 48)[0] != token:
+            self._close_files()
+            struct.pack_into(b'q', self._m, 48, token)
+
+    def _read_keys(self):
+        """Read the keys added to the keys file since it was last read."""
+        try:
+            f = open(self._keys_filename, 'rb')
+        except IOError:
+            return
+        with f:
+            f.seek(self._keys_offset)
+            data = f.read()
+        # A line is only complete once it has its newline.
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].splitlines():
+            series, key = json.loads(line.decode('utf-8'))
+            self._keys[series] = core._ring_key(key)
+        self._keys_offset += end
+
+    def _record(self, index):
+        return core._RING_RECORD.unpack_from(
+            self._m, core._RING_HEADER_SIZE + index % self._capacity * core._RING_RECORD.size)
+
+    def drain(self):
+        """Read the records written since the last drain, freeing their space."""
+        dead = self.dead()
+        write, read = struct.unpack_from(b'qq', self._m, 16)
+        while read < write:
+            tag, value = self._record(read)
+            series, kind = tag >> 2, tag & 3
+            read += 1
+            if kind == core._RING_VALUE:
+                key = self._keys.get(series)
+                if key is None:
+                    self._read_keys()
+                    key = self._keys.get(series)
+                    if key is None:
+                        # The keys file is missing or damaged, so the value can't be reported.
+                        continue
+                file_prefix = key[0]
+                if dead and file_prefix in ('gauge_livesum', 'gauge_liveall'):
+                    continue
+                d = self._files.get(file_prefix)
+                if d is None:
+                    d = self._files[file_prefix] = core._MmapedDict(
+                        os.path.join(self._path, '{0}_{1}.db'.format(file_prefix, self.pid)))
+                d.write_value(key[1:], value)
+            elif kind == core._RING_START:
+                # Series ids carry on, but values start again from 0.
+                self._close_files()
+                with _directory_lock(self._path, True):
+                    _compact_files(self.pid, self._path)
+                    for f in glob.glob(os.path.join(self._path, 'gauge_*_{0}.db'.format(self.pid))):
+                        os.remove(f)
+                # The compaction mustn't be repeated if this drain doesn't finish.
+                struct.pack_into(b'q', self._m, 24, read)
+        struct.pack_into(b'q', self._m, 24, read)
+
+    def drained(self):
+        """Returns whether all records written so far have been read."""
+        write, read = struct.unpack_from(b'qq', self._m, 16)
+        return read == write
+
+    def dead(self):
+        return struct.unpack_from(b'q', self._m, 40)[0] != 0
+
+
+class _RingAggregator(object):
+    """Drains the ring buffers of a multiprocess directory into the files of their processes.
+
+    Any process may drain the rings, such as each one that collects. As
+    records are removed once read, drains are serialised with a lock on a
+    file. Each aggregator marks the rings it drains with a random token, so it
+    knows when another one has written to the files of a ring since.
+
+    Once the ring of a dead process has been drained, the files of the
+    process are compacted as by compact_dead_process, and the ring is removed,
+    so that rings don't pile up as processes are replaced.
+    """
+    def __init__(self, path):
+        if fcntl is None:
+            raise ValueError('The ring backend requires fcntl')
+        self._path = path
+        self._lock = threading.Lock()
+        self._readers = {}
+        # The process the readers were opened in, as they aren't shared with forked children.
+        self._pid = None
+        self._token = None
+
+    def close(self):
+        with self._lock:
+            self._close_readers()
+
+    def _close_readers(self):
+        """Lock must be held by caller."""
+        for reader in self._readers.values():
+            reader.close()
+        self._readers = {}
+
+    def drain(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._close_readers()
+                self._pid = os.getpid()
+                self._token = struct.unpack(b'q', os.urandom(8))[0] | 1
+            filenames = glob.glob(os.path.join(self._path, 'ring_*.ring'))
+            if not filenames:
+                self._close_readers()
+                return
+            with open(os.path.join(self._path, 'ring_aggregator.lock'), 'a') as lock_file:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                for filename in filenames:
+                    reader = self._readers.pop(filename, None)
+                    if reader is not None and reader.inode != _inode(filename):
+                        # Another aggregator removed the ring, and maybe a process with the same pid made a new one.
+                        reader.close()
+                        reader = None
+                    if reader is None:
+                        try:
+                            reader = _RingReader.open(filename)
+                        except IOError:
+                            continue
+                        if reader is None:
+                            continue
+                    self._readers[filename] = reader
+                    reader.claim(self._token)
+                    reader.drain()
+                    # A dead process writes no more, so once drained its ring can go.
+                    if reader.dead() and reader.drained():
+                        self._remove(filename, reader)
+                # Forget the rings removed by other aggregators.
+                for filename in set(self._readers) - set(filenames):
+                    self._readers.pop(filename).close()
+
+    def _remove(self, filename, reader):
+        """Compact the files of a drained ring's process, and remove the ring. Locks must be held by caller."""
+        reader.close()
+        del self._readers[filename]
+        with _directory_lock(self._path, True):
+            _compact_files(reader.pid, self._path)
+            for mode in ('livesum', 'liveall'):
+                _remove_file(os.path.join(self._path, 'gauge_{0}_{1}.db'.format(mode, reader.pid)))
+            _remove_file(filename)
+            _remove_file(reader._keys_filename)
+
+    def _run(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.drain()
+            except Exception:
+                logging.exception('Draining ring buffers failed')
+
+
+def _inode(filename):
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return (stat.st_dev, stat.st_ino)
+
+
+def _remove_file(filename):
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+
+
+# The _RingAggregator of each directory, in this process.
+_ring_aggregators = {}
+_ring_aggregators_lock = threading.Lock()
+
+
+def _ring_aggregator(path):
+    with _ring_aggregators_lock:
+        if path not in _ring_aggregators:
+            _ring_aggregators[path] = _RingAggregator(path)
+        return _ring_aggregators[path]
+
+
+def start_ring_aggregator(path=os.environ.get('prometheus_multiproc_dir'), interval=1.0):
+    """Drain the ring buffers of a directory every interval seconds, in a daemon thread.
+
+    Collections drain the ring buffers anyway, this keeps them from filling
+    up between collections.
+    """
+    t = threading.Thread(target=_ring_aggregator(path)._run, args=(interval, ))
+    t.daemon = True
+    t.start()
+
+
+def _merge(metrics, other):
+    """Merge metrics aggregated from other files into metrics."""
+    for metric_name, (typ, mode, samples, buckets) in other.items():
+        metric = metrics.get(metric_name)
+        if metric is None:
+            metrics[metric_name] = [typ, mode, samples, buckets]
+            continue
+        if mode is not None:
+            metric[1] = mode
+        for key, value in samples.items():
+            _combine(metric[2], key, value, mode)
+        for labels, values in buckets.items():
+            merged = metric[3].setdefault(labels, {})
+            for bucket, value in values.items():
+                _combine(merged, bucket, value, None)
+
+
+def _to_metrics(metrics):
+    """Convert aggregated metrics to a list of Metrics."""
+    result = []
+    for metric_name, (typ, mode, samples, buckets) in metrics.items():
+        metric = core.Metric(metric_name, 'Multiprocess metric', typ)
+        # Accumulate bucket values.
+        for labels, values in buckets.items():
+            acc = 0.0
+            for bucket, value in sorted(values.items()):
+                acc += value
+                samples[(metric_name + '_bucket', labels + (('le', core._floatToGoString(bucket)), ))] = acc
+            samples[(metric_name + '_count', labels)] = acc
+        # Convert to correct sample format. Sorting makes the output the same
+        # however the files were read.
+        metric.samples = [(name, dict(labels), value) for (name, labels), value in sorted(samples.items())]
+        result.append(metric)
+    result.sort(key=lambda metric: metric.name)
+    return result
+
+
+# How many keys MultiProcessCollector numbers before it first checks
+# for ones that are no longer in any file.
+_PRUNE_SERIES = 1024
+# How many files each task of a pool reads.
+_FILES_PER_TASK = 64
+# States of the files read by _aggregate_files in this process, with when each was last used.
+_worker_files = {}
+# How long an unused file state is kept by _aggregate_files.
+_WORKER_FILE_SECONDS = 600
+
+
+def _aggregate_files(paths):
+    """Read and aggregate the given files. This is run by the workers of a pool."""
+    now = default_timer()
+    metrics = {}
+    for path in paths:
+        cached = _worker_files.get(path)
+        state, values = _read_file(path, cached and cached[0])
+        if state is not None:
+            _worker_files[path] = (state, now)
+        _aggregate_file(metrics, path, values)
+    # Files that haven't been read in a while were most likely removed.
+    # With a thread pool, other workers may be updating the states, and
+    # copying is atomic where iterating isn't.
+    for path, (state, last_used) in _worker_files.copy().items():
+        if now - last_used > _WORKER_FILE_SECONDS:
+            _worker_files.pop(path, None)
+    return metrics
+
 
 class MultiProcessCollector(object):
-    """Collector for files for multi-process mode."""
-    def __init__(self, registry, path=os.environ.get('prometheus_multiproc_dir')):
+    """Collector for files for multi-process mode.
+
+    Keys decoded from each file are kept between calls to collect,
+    so that later calls only have to decode newly added entries.
+
+    If a pool is given, such as a multiprocessing.Pool, the files are split
+    between its workers. Each worker reads and aggregates its share of the
+    files, and the results are then merged. The pool must have a map method.
+    """
+    def __init__(self, registry, path=os.environ.get('prometheus_multiproc_dir'), pool=None):
         self._path = path
+        self._pool = pool
+        self._files = {}
+        # Every key seen, numbered, for summing values with numpy.
+        self._lock = threading.Lock()
+        self._series = {}
+        self._series_keys = []
+        # The state of each file, and the numbers of its keys.
+        self._series_ids = {}
+        # How many keys there can be before checking for ones that are in no file.
+        self._prune_at = _PRUNE_SERIES
         if registry:
           registry.register(self)
 
     def collect(self):
+        if glob.glob(os.path.join(self._path, 'ring_*.ring')):
+            # Draining may compact files, so it's done before the shared lock is taken.
+            _ring_aggregator(self._path).drain()
+        with _directory_lock(self._path, False):
+            metrics = self._read_files()
+        return _to_metrics(metrics)
+
+    def _read_files(self):
+        files = sorted(glob.glob(os.path.join(self._path, '*.db')))
         metrics = {}
-        for f in glob.glob(os.path.join(self._path, '*.db')):
-            parts = os.path.basename(f).split('_')
-            typ = parts[0]
-            d = core._MmapedDict(f)
-            for key, value in d.read_all_values():
-                metric_name, name, labelnames, labelvalues = json.loads(key)
-                metrics.setdefault(metric_name, core.Metric(metric_name, 'Multiprocess metric', typ))
-                metric = metrics[metric_name]
-                if typ == 'gauge':
-                    pid = parts[2][:-3]
-                    metric._multiprocess_mode = parts[1]
-                    metric.add_sample(name, tuple(zip(labelnames, labelvalues)) + (('pid', pid), ), value)
+        if self._pool is None:
+            states = {}
+            groups = {}
+            for f in files:
+                state, values = _read_file_values(f, self._files.get(f))
+                if state is None:
+                    continue
+                states[f] = state
+                typ, mode, pid = _parse_filename(f)
+                if mode in ('all', 'liveall'):
+                    _aggregate(metrics, typ, mode, pid, zip(state.keys, values))
                 else:
-                    # The duplicates and labels are fixed in the next for.
-                    metric.add_sample(name, tuple(zip(labelnames, labelvalues)), value)
-            d.close()
+                    groups.setdefault((typ, mode or ''), []).append((f, state, values))
+            self._files = states
+            # Combining the values of each series across files first means
+            # the rest of the aggregation happens once per series, not once per file.
+            for (typ, mode), group in sorted(groups.items()):
+                _aggregate(metrics, typ, mode or None, None, self._combine_files(mode or None, group))
+            if numpy is not None:
+                self._prune_series()
+        else:
+            tasks = [files[i:i + _FILES_PER_TASK] for i in range(0, len(files), _FILES_PER_TASK)]
+            # Merging in the order of the files keeps the output deterministic.
+            for result in self._pool.map(_aggregate_files, tasks):
+                _merge(metrics, result)
+        arena = os.path.join(self._path, core._ARENA_FILENAME)
+        if os.path.exists(arena):
+            _aggregate_arena(metrics, arena)
+        return metrics
 
-        for metric in metrics.values():
-            samples = {}
-            buckets = {}
-            for name, labels, value in metric.samples:
-                if metric.type == 'gauge':
-                    without_pid = tuple([l for l in labels if l[0] != 'pid'])
-                    if metric._multiprocess_mode == 'min':
-                        samples.setdefault((name, without_pid), value)
-                        if samples[(name, without_pid)] > value:
-                            samples[(name, without_pid)] = value
-                    elif metric._multiprocess_mode == 'max':
-                        samples.setdefault((name, without_pid), value)
-                        if samples[(name, without_pid)] < value:
-                            samples[(name, without_pid)] = value
-                    elif metric._multiprocess_mode == 'livesum':
-                        samples.setdefault((name, without_pid), 0.0)
-                        samples[(name, without_pid)] += value
-                    else:  # all/liveall
-                        samples[(name, labels)] = value
-                elif metric.type == 'histogram':
-                    bucket = [float(l[1]) for l in labels if l[0] == 'le']
-                    if bucket:
-                        # _bucket
-                        without_le = tuple([l for l in labels if l[0] != 'le'])
-                        buckets.setdefault(without_le, {})
-                        buckets[without_le].setdefault(bucket[0], 0.0)
-                        buckets[without_le][bucket[0]] += value
-                    else:
-                        # _sum/_count
-                        samples.setdefault((name, labels), 0.0)
-                        samples[(name, labels)] += value
-                else:
-                    # Counter and Summary.
-                    samples.setdefault((name, labels), 0.0)
-                    samples[(name, labels)] += value
 
+    def _ids(self, path, state):
+        """Returns a numpy array of the numbers of the keys of a file. Lock must be held by caller."""
+        cached = self._series_ids.get(path)
+        if cached is not None and cached[0] is state:
+            return cached[1]
+        ids = []
+        if cached is not None and cached[0].inode == state.inode and len(cached[1]) <= len(state.keys):
+            # Files only ever have keys appended.
+            ids = cached[1].tolist()
+        for key in state.keys[len(ids):]:
+            i = self._series.get(key)
+            if i is None:
+                i = self._series[key] = len(self._series_keys)
+                self._series_keys.append(key)
+            ids.append(i)
+        ids = numpy.array(ids, dtype=numpy.intp)
+        self._series_ids[path] = (state, ids)
+        return ids
+
+    def _prune_series(self):
+        """Renumber the keys if most of them are no longer in any file.
+
+        Otherwise the keys of removed files would be kept forever, and the
+        counts summed by numpy would grow with them.
+        """
+        with self._lock:
+            if len(self._series_keys) < self._prune_at:
+                return
+            ids = [ids for _, ids in self._series_ids.values()]
+            used = numpy.unique(numpy.concatenate(ids)) if ids else numpy.zeros(0, dtype=numpy.intp)
+            self._prune_at = max(_PRUNE_SERIES, 2 * len(used))
+            if len(self._series_keys) < self._prune_at:
+                return
+            renumbered = numpy.zeros(len(self._series_keys), dtype=numpy.intp)
+            renumbered[used] = numpy.arange(len(used))
+            self._series_keys = [self._series_keys[i] for i in used.tolist()]
+            self._series = dict((key, i) for i, key in enumerate(self._series_keys))
+            for path, (state, ids) in list(self._series_ids.items()):
+                self._series_ids[path] = (state, renumbered[ids])
 
-            # Accumulate bucket values.
-            if metric.type == 'histogram':
-                for labels, values in buckets.items():
-                    acc = 0.0
-                    for bucket, value in sorted(values.items()):
-                        acc += value
-                        samples[(metric.name + '_bucket', labels + (('le', core._floatToGoString(bucket)), ))] = acc
-                    samples[(metric.name + '_count', labels)] = acc
+    def _combine_files(self, mode, group):
+        """Returns (key, value) pairs with the values of each key in a group of files combined.
 
-            # Convert to correct sample format.
-            metric.samples = [(name, dict(labels), value) for (name, labels), value in samples.items()]
-        return metrics.values()
+        group is a list of (path, state, values). Sums are vectorised with
+        numpy if it's available.
+        """
+        if numpy is not None and mode in (None, 'livesum'):
+            values = numpy.concatenate([numpy.array(values, dtype=numpy.float64) for _, _, values in group])
+            with self._lock:
+                # Numbers and keys are taken together, as keys may be renumbered.
+                ids = numpy.concatenate([self._ids(path, state) for path, state, _ in group])
+                keys = self._series_keys[:]
+                # Forget files which are gone.
+                for path in list(self._series_ids):
+                    if path not in self._files:
+                        del self._series_ids[path]
+            sums = numpy.bincount(ids, weights=values, minlength=len(keys)).tolist()
+            return [(keys[i], sums[i]) for i in numpy.unique(ids).tolist()]
+        combined = {}
+        for _, state, values in group:
+            for key, value in zip(state.keys, values):
+                _combine(combined, key, value, mode)
+        return list(combined.items())
 
 
-def mark_process_dead(pid, path=os.environ.get('prometheus_multiproc_dir')):
-    """Do bookkeeping for when one process dies in a multi-process setup."""
+def mark_process_dead(pid, path=os.environ.get('prometheus_multiproc_dir'), compact=True):
+    """Do bookkeeping for when one process dies in a multi-process setup.
+
+    Unless compact is False, the counter, summary and histogram files of
+    the process are also merged into aggregate files. See compact_dead_process.
+    With the arena and ring backends, the live gauge values of the process are ignored
+    from then on.
+
+    This is meant to be called from another process, such as the Gunicorn master.
+    When called for the current process, values that are written behind are
+    flushed first, and compaction is skipped, as the process may still write
+    to its files until it exits.
+    """
+    if pid == os.getpid():
+        flush = getattr(core._ValueClass, 'flush', None)
+        if flush is not None:
+            flush()
+        compact = False
+    _mark_arena_process_dead(pid, os.path.join(path, core._ARENA_FILENAME))
+    _mark_ring_process_dead(pid, path)
     for f in glob.glob(os.path.join(path, 'gauge_livesum_{0}.db'.format(pid))):
         os.remove(f)
     for f in glob.glob(os.path.join(path, 'gauge_liveall_{0}.db'.format(pid))):
         os.remove(f)
+    if compact:
+        compact_dead_process(pid, path)
+
+
+def compact_dead_process(pid, path=os.environ.get('prometheus_multiproc_dir')):
+    """Merge the files of a dead process into aggregate files.
+
+    Otherwise there would be files from every process that ever existed,
+    making collection slower over time. The values in the counter, summary and
+    histogram files of the process are added to those in the matching
+    <type>_aggregate.db file, and then the files of the process are removed.
+
+    This must only be called once the process has exited. A collection in
+    progress delays the compaction, so that totals never appear to go down.
+    Gauge files are left alone, as their values are reported per process.
+
+    With the arena backend, the values segments of the process are compacted
+    the same way, and then reused by new processes. With the ring backend,
+    the files of the process are compacted once its ring has been drained.
+    """
+    with _directory_lock(path, True):
+        _compact_arena_process(pid, os.path.join(path, core._ARENA_FILENAME))
+        # Values may still be in the ring, they are compacted once it's drained.
+        if not os.path.exists(os.path.join(path, 'ring_{0}.ring'.format(pid))):
+            _compact_files(pid, path)
+
+
+def _compact_files(pid, path):
+    """Merge the counter, summary and histogram files of a process into aggregate files.
+
+    The directory must be locked exclusively by the caller.
+    """
+    for typ in ('counter', 'summary', 'histogram'):
+        filename = os.path.join(path, '{0}_{1}.db'.format(typ, pid))
+        if not os.path.exists(filename):
+            continue
+        aggregate = os.path.join(path, '{0}_aggregate.db'.format(typ))
+        totals = {}
+        for f in (aggregate, filename):
+            for key, value in _read_file(f, None)[1]:
+                if not isinstance(key, tuple):
+                    # Written by an older version of the client.
+                    metric_name, name, labelnames, labelvalues = json.loads(key)
+                    key = (metric_name, name, tuple(labelnames), tuple(labelvalues))
+                totals[key] = totals.get(key, 0.0) + value
+        # Write the new aggregate file under a name which isn't collected,
+        # and then atomically replace the old one.
+        tmp = aggregate + '.tmp'
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        d = core._MmapedDict(tmp)
+        for key, value in totals.items():
+            d.write_value(key, value)
+        d.close()
+        os.rename(tmp, aggregate)
+        os.remove(filename)
+
+
+def migrate_to_dense(path=os.environ.get('prometheus_multiproc_dir')):
+    """Convert the files of a multiprocess directory to the format of the dense backend.
+
+    Files which are already converted are left alone. This must only be
+    called while no process is writing to the files, such as before the
+    processes of a deployment using prometheus_multiproc_backend=dense start.
+    """
+    with _directory_lock(path, True):
+        for f in glob.glob(os.path.join(path, '*.db')):
+            with open(f, 'rb') as fh:
+                if fh.read(8) == core._DENSE_MAGIC:
+                    continue
+            core._DenseMmapedDict(f).close()
@@ -0,0 +1,142 @@
+#!/usr/bin/python
+"""Serves the metrics of a multiprocess directory from a separate process.
+
+Application processes only write to their files, and scrapes are answered
+from output that is rendered every interval, so they cost them nothing:
+
+    python -m prometheus_client.multiprocess_exporter --port 8000
+"""
+
+from __future__ import unicode_literals
+
+import logging
+import optparse
+import os
+import threading
+import time
+from timeit import default_timer
+
+from . import core
+from .exposition import CONTENT_TYPE_LATEST, generate_latest
+from .multiprocess import MultiProcessCollector
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+except ImportError:
+    # Python 3
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+
+
+class MultiProcessExporter(object):
+    """Renders the metrics of a multiprocess directory every interval seconds.
+
+    The latest output is kept in memory, and if output is given, also
+    atomically written to that file so it can be served with sendfile.
+    The pool is passed on to MultiProcessCollector.
+    """
+    def __init__(self, path=os.environ.get('prometheus_multiproc_dir'), interval=5.0, output=None, pool=None):
+        if not path:
+            raise ValueError('No multiprocess directory given')
+        self._registry = core.CollectorRegistry()
+        MultiProcessCollector(self._registry, path, pool=pool)
+        self._interval = interval
+        self.output = output
+        self.latest = None
+
+    def render(self):
+        """Render the metrics now."""
+        latest = generate_latest(self._registry)
+        if self.output:
+            tmppath = '{0}.{1}'.format(self.output, os.getpid())
+            with open(tmppath, 'wb') as f:
+                f.write(latest)
+            # rename(2) is atomic.
+            os.rename(tmppath, self.output)
+        self.latest = latest
+
+    def _run(self):
+        wait_until = default_timer()
+        while True:
+            wait_until += self._interval
+            now = default_timer()
+            if now < wait_until:
+                time.sleep(wait_until - now)
+            else:
+                # Rendering took longer than the interval, skip ahead.
+                wait_until = now
+            try:
+                self.render()
+            except Exception:
+                logging.exception('Rendering metrics failed')
+
+    def start(self):
+        """Render the metrics, and then keep rendering them in a daemon thread."""
+        self.render()
+        t = threading.Thread(target=self._run)
+        t.daemon = True
+        t.start()
+
+
+class ExporterHandler(BaseHTTPRequestHandler):
+    """Serves the latest output of the exporter of the server."""
+    def do_GET(self):
+        exporter = self.server.exporter
+        if exporter.output and hasattr(os, 'sendfile'):
+            self._send_file(exporter.output)
+            return
+        output = exporter.latest
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE_LATEST)
+        self.send_header('Content-Length', str(len(output)))
+        self.end_headers()
+        self.wfile.write(output)
+
+    def _send_file(self, path):
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE_LATEST)
+            self.send_header('Content-Length', str(size))
+            self.end_headers()
+            self.wfile.flush()
+            offset = 0
+            while offset < size:
+                sent = os.sendfile(self.connection.fileno(), f.fileno(), offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+
+    def log_message(self, format, *args):
+        return
+
+
+def make_server(exporter, port, addr=''):
+    """Returns a HTTPServer serving the output of exporter."""
+    httpd = HTTPServer((addr, port), ExporterHandler)
+    httpd.exporter = exporter
+    return httpd
+
+
+def main(args=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--port', type='int', default=8000,
+                      help='Port to serve metrics on [default: %default]')
+    parser.add_option('--addr', default='',
+                      help='Address to serve metrics on [default: all]')
+    parser.add_option('--path', default=os.environ.get('prometheus_multiproc_dir'),
+                      help='Multiprocess directory [default: $prometheus_multiproc_dir]')
+    parser.add_option('--interval', type='float', default=5.0,
+                      help='Seconds between renders of the metrics [default: %default]')
+    parser.add_option('--output',
+                      help='File to write the rendered metrics to, and serve them from')
+    options, _ = parser.parse_args(args)
+    if not options.path:
+        parser.error('--path or $prometheus_multiproc_dir must be set')
+    exporter = MultiProcessExporter(options.path, options.interval, options.output)
+    exporter.start()
+    make_server(exporter, options.port, options.addr).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,17 @@
 from __future__ import unicode_literals
 
+import copy
 import inspect
+import math
 import os
+import pickle
+import random
 import threading
 import time
 import unittest
+from multiprocessing.pool import ThreadPool
 
+from prometheus_client import core
 from prometheus_client.core import *
 
 class TestCounter(unittest.TestCase):
@@ -23,6 +29,21 @@ class TestCounter(unittest.TestCase):
     def test_negative_increment_raises(self):
         self.assertRaises(ValueError, self.counter.inc, -1)
 
+    def test_inc_many(self):
+        self.counter.inc_many([1, 2.5])
+        self.assertEqual(3.5, self.registry.get_sample_value('c'))
+        self.counter.inc_many(x for x in [1, 1])
+        self.assertEqual(5.5, self.registry.get_sample_value('c'))
+        self.assertRaises(ValueError, self.counter.inc_many, [1, -1])
+        self.assertEqual(5.5, self.registry.get_sample_value('c'))
+
+    def test_inc_many_without_numpy(self):
+        numpy, core.numpy = core.numpy, None
+        try:
+            self.test_inc_many()
+        finally:
+            core.numpy = numpy
+
     def test_function_decorator(self):
         @self.counter.count_exceptions(ValueError)
         def f(r):
@@ -60,6 +81,91 @@ class TestCounter(unittest.TestCase):
         self.assertEqual(1, self.registry.get_sample_value('c'))
 
 
+class TestShardedValue(unittest.TestCase):
+    def setUp(self):
+        self.value = core._ShardedValue('counter', 'c', 'c', (), ())
+
+    def test_inc_from_threads(self):
+        def f():
+            for i in range(1000):
+                self.value.inc(1)
+        threads = [threading.Thread(target=f) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(8000, self.value.get())
+
+    def test_set(self):
+        self.value.inc(5)
+        self.value.set(2)
+        self.assertEqual(2, self.value.get())
+        self.value.inc(1)
+        self.assertEqual(3, self.value.get())
+
+    def test_used_by_metrics(self):
+        core._ValueClass = core._ShardedValue
+        try:
+            registry = CollectorRegistry()
+            g = Gauge('g', 'help', registry=registry)
+            g.inc(3)
+            g.dec()
+            self.assertEqual(2, registry.get_sample_value('g'))
+        finally:
+            core._ValueClass = core._MutexValue
+
+
+class TestValueBackend(unittest.TestCase):
+    def test_by_name(self):
+        registry = CollectorRegistry()
+        c = Counter('c', 'help', ['l'], registry=registry, value_backend='sharded')
+        c.labels('a').inc(2)
+        self.assertTrue(isinstance(c.labels('a')._value, core._ShardedValue))
+        self.assertEqual(2, registry.get_sample_value('c', {'l': 'a'}))
+        h = Histogram('h', 'help', registry=registry, value_backend='mutex')
+        h.observe(1)
+        self.assertEqual(1, registry.get_sample_value('h_count'))
+
+    def test_histograms(self):
+        registry = CollectorRegistry(value_backend='sharded')
+        h = Histogram('h', 'help', registry=registry, buckets=(1, 2))
+        e = ExponentialHistogram('e', 'help', registry=registry, schema=0)
+        h.observe(1.5)
+        e.observe(1.5)
+        self.assertTrue(isinstance(h._values._sum, core._ShardedValue))
+        self.assertTrue(isinstance(e._values._sum, core._ShardedValue))
+        self.assertEqual(1, registry.get_sample_value('h_bucket', {'le': '2.0'}))
+        self.assertEqual(1.5, registry.get_sample_value('h_sum'))
+        self.assertEqual(1, registry.get_sample_value('e_bucket', {'le': '2.0'}))
+        self.assertEqual(1.5, registry.get_sample_value('e_sum'))
+        self.assertRaises(ValueError, ExponentialHistogram, 'e2', 'help', registry=registry, max_buckets=10)
+
+    def test_registry_default(self):
+        registry = CollectorRegistry(value_backend='sharded')
+        g = Gauge('g', 'help', registry=registry)
+        s = Summary('s', 'help', registry=registry, value_backend='mutex')
+        self.assertTrue(isinstance(g._value, core._ShardedValue))
+        self.assertTrue(isinstance(s._count, core._MutexValue))
+
+    def test_register(self):
+        class DoubleValue(core._MutexValue):
+            def inc(self, amount):
+                core._MutexValue.inc(self, amount * 2)
+        register_value_backend('double', DoubleValue)
+        try:
+            registry = CollectorRegistry()
+            Counter('c', 'help', registry=registry, value_backend='double').inc()
+            Gauge('g', 'help', registry=registry, value_backend=DoubleValue).inc()
+            self.assertEqual(2, registry.get_sample_value('c'))
+            self.assertEqual(2, registry.get_sample_value('g'))
+        finally:
+            del core._VALUE_BACKENDS['double']
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, Counter, 'c', 'help', registry=None, value_backend='nope')
+        self.assertRaises(ValueError, register_value_backend, 'nope', object)
+
+
 class TestGauge(unittest.TestCase):
     def setUp(self):
         self.registry = CollectorRegistry()
@@ -132,6 +238,20 @@ class TestSummary(unittest.TestCase):
         self.assertEqual(1, self.registry.get_sample_value('s_count'))
         self.assertEqual(10, self.registry.get_sample_value('s_sum'))
 
+    def test_observe_many(self):
+        self.summary.observe_many([1, 2, 3.5])
+        self.assertEqual(3, self.registry.get_sample_value('s_count'))
+        self.assertEqual(6.5, self.registry.get_sample_value('s_sum'))
+        self.summary.observe_many([])
+        self.assertEqual(3, self.registry.get_sample_value('s_count'))
+
+    def test_observe_many_without_numpy(self):
+        numpy, core.numpy = core.numpy, None
+        try:
+            self.test_observe_many()
+        finally:
+            core.numpy = numpy
+
     def test_function_decorator(self):
         self.assertEqual(0, self.registry.get_sample_value('s_count'))
 
@@ -151,6 +271,74 @@ class TestSummary(unittest.TestCase):
         self.assertEqual(1, self.registry.get_sample_value('s_count'))
 
 
+class TestSummaryQuantiles(unittest.TestCase):
+    def setUp(self):
+        self.registry = CollectorRegistry()
+        self.summary = Summary('s', 'help', registry=self.registry,
+                quantiles=((0.5, 0.05), (0.9, 0.01), (0.99, 0.001)))
+
+    def test_no_observations(self):
+        self.assertTrue(math.isnan(self.registry.get_sample_value('s', {'quantile': '0.5'})))
+        self.assertEqual(0, self.registry.get_sample_value('s_count'))
+
+    def test_quantiles(self):
+        values = list(range(1, 10001))
+        random.Random(42).shuffle(values)
+        for v in values:
+            self.summary.observe(v)
+        self.assertEqual(10000, self.registry.get_sample_value('s_count'))
+        self.assertAlmostEqual(5000, self.registry.get_sample_value('s', {'quantile': '0.5'}), delta=500)
+        self.assertAlmostEqual(9000, self.registry.get_sample_value('s', {'quantile': '0.9'}), delta=100)
+        self.assertAlmostEqual(9900, self.registry.get_sample_value('s', {'quantile': '0.99'}), delta=10)
+
+    def test_memory_is_bounded(self):
+        q = core._CKMSQuantiles([(0.5, 0.05), (0.99, 0.001)])
+        for v in range(100000):
+            q.insert(v)
+        self.assertAlmostEqual(99000, q.query(0.99), delta=100)
+        self.assertTrue(len(q._samples) < 5000)
+
+    def test_sorted_streams(self):
+        targets = [(0.5, 0.05), (0.9, 0.01), (0.99, 0.001)]
+        n = 40000
+        for values in (range(1, n + 1), range(n, 0, -1)):
+            q = core._CKMSQuantiles(targets)
+            for v in values:
+                q.insert(v)
+            # Values are their own ranks.
+            for quantile, error in targets:
+                self.assertAlmostEqual(quantile * n, q.query(quantile), delta=error * n)
+            self.assertTrue(len(q._samples) < 200)
+
+    def test_observe_many(self):
+        self.summary.observe_many(range(1, 1001))
+        self.assertEqual(1000, self.registry.get_sample_value('s_count'))
+        self.assertAlmostEqual(500, self.registry.get_sample_value('s', {'quantile': '0.5'}), delta=50)
+
+    def test_labels(self):
+        s = Summary('sl', 'help', ['l'], registry=self.registry, quantiles=((0.5, 0.05),))
+        s.labels('a').observe(3)
+        self.assertEqual(3, self.registry.get_sample_value('sl', {'l': 'a', 'quantile': '0.5'}))
+
+    def test_window_rotation(self):
+        now = [0.0]
+        q = core._TimeWindowQuantiles([(0.5, 0.05)], 10, 2, _timer=lambda: now[0])
+        q.insert(1)
+        now[0] = 6
+        q.insert(100)
+        self.assertEqual([(0.5, 1)], q.query())
+        now[0] = 11
+        self.assertEqual([(0.5, 100)], q.query())
+        now[0] = 100
+        self.assertTrue(math.isnan(q.query()[0][1]))
+
+    def test_invalid_quantiles_raise(self):
+        self.assertRaises(ValueError, Summary, 's2', 'help', registry=None, quantiles=((1, 0.01),))
+        self.assertRaises(ValueError, Summary, 's2', 'help', registry=None, quantiles=((0.5, 0),))
+        self.assertRaises(ValueError, Summary, 's2', 'help', registry=None, quantiles=((0.5, 0.01),), age_buckets=0)
+        self.assertRaises(ValueError, Summary, 's2', 'help', registry=None, quantiles=((0.5, 0.01),), max_age_seconds=0)
+
+
 class TestHistogram(unittest.TestCase):
     def setUp(self):
         self.registry = CollectorRegistry()
@@ -189,6 +377,44 @@ class TestHistogram(unittest.TestCase):
         self.assertEqual(3, self.registry.get_sample_value('h_count'))
         self.assertEqual(float("inf"), self.registry.get_sample_value('h_sum'))
 
+    def test_nan_is_not_bucketed(self):
+        self.histogram.observe(float("nan"))
+        self.assertEqual(0, self.registry.get_sample_value('h_bucket', {'le': '0.005'}))
+        self.assertEqual(0, self.registry.get_sample_value('h_bucket', {'le': '+Inf'}))
+        self.assertEqual(0, self.registry.get_sample_value('h_count'))
+        self.assertTrue(math.isnan(self.registry.get_sample_value('h_sum')))
+
+    def test_bucket_boundaries(self):
+        h = Histogram('hb', 'help', registry=self.registry, buckets=[0, 1, 2])
+        for amount in [-1, 0, 0.5, 1, 1.5, 2, 3]:
+            h.observe(amount)
+        self.assertEqual(2, self.registry.get_sample_value('hb_bucket', {'le': '0.0'}))
+        self.assertEqual(4, self.registry.get_sample_value('hb_bucket', {'le': '1.0'}))
+        self.assertEqual(6, self.registry.get_sample_value('hb_bucket', {'le': '2.0'}))
+        self.assertEqual(7, self.registry.get_sample_value('hb_bucket', {'le': '+Inf'}))
+        self.assertEqual(7, self.registry.get_sample_value('hb_sum'))
+
+    def test_observe_many(self):
+        h = Histogram('hb', 'help', registry=self.registry, buckets=[0, 1, 2])
+        h.observe_many([-1, 0, 0.5, 1, 1.5, 2, 3, float("nan")])
+        self.assertEqual(2, self.registry.get_sample_value('hb_bucket', {'le': '0.0'}))
+        self.assertEqual(4, self.registry.get_sample_value('hb_bucket', {'le': '1.0'}))
+        self.assertEqual(6, self.registry.get_sample_value('hb_bucket', {'le': '2.0'}))
+        self.assertEqual(7, self.registry.get_sample_value('hb_bucket', {'le': '+Inf'}))
+        self.assertEqual(7, self.registry.get_sample_value('hb_count'))
+        self.assertTrue(math.isnan(self.registry.get_sample_value('hb_sum')))
+
+        self.histogram.observe_many(x for x in [2, 2.5])
+        self.assertEqual(2, self.registry.get_sample_value('h_bucket', {'le': '2.5'}))
+        self.assertEqual(4.5, self.registry.get_sample_value('h_sum'))
+
+    def test_observe_many_without_numpy(self):
+        numpy, core.numpy = core.numpy, None
+        try:
+            self.test_observe_many()
+        finally:
+            core.numpy = numpy
+
     def test_setting_buckets(self):
         h = Histogram('h', 'help', registry=None, buckets=[0, 1, 2])
         self.assertEqual([0.0, 1.0, 2.0, float("inf")], h._upper_bounds)
@@ -232,6 +458,63 @@ class TestHistogram(unittest.TestCase):
         self.assertEqual(1, self.registry.get_sample_value('h_bucket', {'le': '+Inf'}))
 
 
+class TestExponentialHistogram(unittest.TestCase):
+    def setUp(self):
+        self.registry = CollectorRegistry()
+        self.histogram = ExponentialHistogram('h', 'help', registry=self.registry, schema=0)
+
+    def test_bucket_index(self):
+        for schema in [-4, -1, 0, 1, 3, 8]:
+            for amount in [1e-10, 0.3, 0.5, 1, 1.5, 2, 3, 4, 1000, 1e30]:
+                for sign in [1, -1]:
+                    key = core._exponential_bucket(schema, 0, sign * amount)
+                    self.assertEqual(sign, key[0])
+                    upper = core._exponential_bucket_bound(schema, 0, key)
+                    lower = core._exponential_bucket_bound(schema, 0, (sign, key[1] - sign))
+                    self.assertTrue(lower < sign * amount <= upper, (schema, sign * amount, key))
+
+    def test_negative_powers_of_two(self):
+        self.histogram.observe(-1.0)
+        self.histogram.observe(-0.5)
+        self.assertEqual(1, self.registry.get_sample_value('h_bucket', {'le': '-1.0'}))
+        self.assertEqual(2, self.registry.get_sample_value('h_bucket', {'le': '-0.5'}))
+
+    def test_histogram(self):
+        self.assertEqual(0, self.registry.get_sample_value('h_bucket', {'le': '+Inf'}))
+        self.assertEqual(0, self.registry.get_sample_value('h_count'))
+        for amount in [-3, 0, 1, 1.5, 2, 3, 5, float("inf")]:
+            self.histogram.observe(amount)
+        self.assertEqual(1, self.registry.get_sample_value('h_bucket', {'le': '-2.0'}))
+        self.assertEqual(2, self.registry.get_sample_value('h_bucket', {'le': '2.938735877055719e-39'}))
+        self.assertEqual(3, self.registry.get_sample_value('h_bucket', {'le': '1.0'}))
+        self.assertEqual(5, self.registry.get_sample_value('h_bucket', {'le': '2.0'}))
+        self.assertEqual(6, self.registry.get_sample_value('h_bucket', {'le': '4.0'}))
+        self.assertEqual(7, self.registry.get_sample_value('h_bucket', {'le': '8.0'}))
+        self.assertEqual(None, self.registry.get_sample_value('h_bucket', {'le': '16.0'}))
+        self.assertEqual(8, self.registry.get_sample_value('h_bucket', {'le': '+Inf'}))
+        self.assertEqual(8, self.registry.get_sample_value('h_count'))
+        self.assertEqual(float("inf"), self.registry.get_sample_value('h_sum'))
+
+    def test_max_buckets(self):
+        h = ExponentialHistogram('hm', 'help', registry=self.registry, schema=1, max_buckets=2)
+        h.observe_many([1, 1.5, 2, 3, 4])
+        # Buckets were merged twice, to schema -1 with powers of 4 as boundaries.
+        self.assertEqual(1, self.registry.get_sample_value('hm_bucket', {'le': '1.0'}))
+        self.assertEqual(5, self.registry.get_sample_value('hm_bucket', {'le': '4.0'}))
+        self.assertEqual(5, self.registry.get_sample_value('hm_count'))
+        self.assertEqual(None, self.registry.get_sample_value('hm_bucket', {'le': '2.0'}))
+
+    def test_labels(self):
+        h = ExponentialHistogram('hl', 'help', ['l'], registry=self.registry)
+        h.labels('a').observe(1)
+        self.assertEqual(1, self.registry.get_sample_value('hl_bucket', {'l': 'a', 'le': '1.0'}))
+        self.assertRaises(ValueError, ExponentialHistogram, 'hl', 'help', ['le'], registry=None)
+
+    def test_invalid_schema_raises(self):
+        self.assertRaises(ValueError, ExponentialHistogram, 'h2', 'help', registry=None, schema=9)
+        self.assertRaises(ValueError, ExponentialHistogram, 'h2', 'help', registry=None, zero_threshold=-1)
+
+
 class TestMetricWrapper(unittest.TestCase):
     def setUp(self):
         self.registry = CollectorRegistry()
@@ -273,6 +556,131 @@ class TestMetricWrapper(unittest.TestCase):
         self.assertRaises(TypeError, self.counter.labels, Test())
         self.assertRaises(TypeError, self.counter.labels, l=Test())
 
+    def test_labels_cached(self):
+        child = self.two_labels.labels('x', 'y')
+        self.assertTrue(child is self.two_labels.labels('x', 'y'))
+        self.assertTrue(child is self.two_labels.labels(b='y', a='x'))
+        self.assertTrue(self.counter.labels(1) is self.counter.labels('1'))
+        self.assertTrue(self.counter.labels(['a']) is self.counter.labels("['a']"))
+
+    def test_prepare_labels(self):
+        children = self.two_labels.prepare_labels([('x', 'y'), {'a': 'x', 'b': 'z'}])
+        self.assertEqual(0, self.registry.get_sample_value('two', {'a': 'x', 'b': 'z'}))
+        children[0].inc()
+        self.assertTrue(children[0] is self.two_labels.labels('x', 'y'))
+        self.assertEqual(1, self.registry.get_sample_value('two', {'a': 'x', 'b': 'y'}))
+        self.assertRaises(ValueError, self.two_labels.prepare_labels, [('x', )])
+
+    def test_labels_from_threads(self):
+        children = []
+        def f():
+            for i in range(100):
+                children.append(self.counter.labels(str(i)))
+        threads = [threading.Thread(target=f) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(100, len(set([id(c) for c in children])))
+
+    def test_expire_after(self):
+        now = [0.0]
+        c = Counter('e', 'help', ['l'], registry=self.registry, expire_after=10)
+        c._timer = lambda: now[0]
+        c.labels('idle').inc()
+        c.labels('touched').inc()
+        counted = c.labels('counted')
+        self.assertEqual(1, self.registry.get_sample_value('e', {'l': 'idle'}))
+        now[0] = 5
+        c.labels('touched')
+        counted.inc()
+        self.assertEqual(1, self.registry.get_sample_value('e', {'l': 'idle'}))
+        now[0] = 12
+        self.assertEqual(None, self.registry.get_sample_value('e', {'l': 'idle'}))
+        self.assertEqual(1, self.registry.get_sample_value('e', {'l': 'touched'}))
+        self.assertEqual(1, self.registry.get_sample_value('e', {'l': 'counted'}))
+        self.assertEqual(2, len(c._metrics))
+        # A removed child starts again when it is next used.
+        c.labels('idle').inc()
+        self.assertEqual(1, self.registry.get_sample_value('e', {'l': 'idle'}))
+        now[0] = 30
+        self.assertEqual([], list(c._samples()))
+        self.assertEqual({}, c._activity)
+
+    def test_expire_on_create(self):
+        now = [0.0]
+        g = Gauge('e', 'help', ['l'], registry=None, expire_after=10)
+        g._timer = lambda: now[0]
+        g.labels('a').set(1)
+        g.labels('b')
+        now[0] = 12
+        # The change of a is only seen now.
+        g.labels('c')
+        self.assertEqual(set([('a',), ('b',), ('c',)]), set(g._metrics))
+        now[0] = 23
+        g.labels('d')
+        self.assertEqual(set([('c',), ('d',)]), set(g._metrics))
+
+    def test_expire_after_invalid(self):
+        self.assertRaises(ValueError, Counter, 'e', 'help', registry=None, expire_after=10)
+        self.assertRaises(ValueError, Counter, 'e', 'help', ['l'], registry=None, expire_after=0)
+
+    def test_max_series(self):
+        c = Counter('m', 'help', ['a', 'b'], namespace='ns', registry=self.registry, max_series=2)
+        c.labels('1', '1').inc()
+        c.labels('2', '2').inc()
+        c.labels('3', '3').inc()
+        c.labels(a='4', b='4').inc(2)
+        c.labels('1', '1').inc()
+        self.assertEqual(2, self.registry.get_sample_value('ns_m', {'a': '1', 'b': '1'}))
+        self.assertEqual(None, self.registry.get_sample_value('ns_m', {'a': '3', 'b': '3'}))
+        self.assertEqual(3, self.registry.get_sample_value('ns_m', {'a': '__overflow__', 'b': '__overflow__'}))
+        self.assertEqual(3, len(c._metrics))
+        self.assertEqual(2, self.registry.get_sample_value('prometheus_client_label_sets_rejected_total',
+                                                           {'metric': 'ns_m'}))
+        # Removing a child makes room for another.
+        c.remove('2', '2')
+        c.labels('5', '5').inc()
+        self.assertEqual(1, self.registry.get_sample_value('ns_m', {'a': '5', 'b': '5'}))
+        # The rejections counter is only registered once.
+        Gauge('m2', 'help', ['a'], registry=self.registry, max_series=1)
+
+    def test_max_series_invalid(self):
+        self.assertRaises(ValueError, Counter, 'm', 'help', registry=None, max_series=10)
+        self.assertRaises(ValueError, Counter, 'm', 'help', ['l'], registry=None, max_series=0)
+
+    def test_sample_labels_cached(self):
+        h = Histogram('hc', 'help', ['l'], registry=self.registry, buckets=[1])
+        h.labels('a"\n').observe(2)
+        first = list(h.collect()[0].samples)
+        second = list(h.collect()[0].samples)
+        self.assertEqual(first, second)
+        for (_, labels1, _), (_, labels2, _) in zip(first, second):
+            self.assertTrue(labels1 is labels2)
+        self.assertEqual({'l': 'a"\n', 'le': '1.0'}, first[0][1])
+        self.assertEqual('{l="a\\"\\n",le="1.0"}', first[0][1].rendered)
+        self.assertRaises(TypeError, first[0][1].__setitem__, 'l', 'b')
+        self.assertRaises(TypeError, first[0][1].update, {'l': 'b'})
+        self.assertEqual(first[0][1], copy.deepcopy(first[0][1]))
+        self.assertEqual(first[0][1], pickle.loads(pickle.dumps(first[0][1])))
+        # Removed children don't keep their labels.
+        h.remove('a"\n')
+        self.assertEqual({}, h._sample_labels)
+
+    def test_children_are_compact(self):
+        c = Counter('cc', 'help', ['a', 'b'], registry=None)
+        h = Histogram('hh', 'help', ['a'], registry=None)
+        for child in (c.labels('x', 'y'), c.labels('x', 'y')._value, h.labels('x'), h.labels('x')._values):
+            self.assertFalse(hasattr(child, '__dict__'))
+        self.assertFalse(hasattr(Metric('m', 'help', 'gauge'), '__dict__'))
+        # Label values and bounds are shared between children.
+        c.labels('tenant-1', 'y')
+        c.labels('tenant-' + str(1), 'z')
+        values = [k[0] for k in c._metrics if k[0] != 'x']
+        self.assertEqual(2, len(values))
+        self.assertTrue(values[0] is values[1])
+        self.assertTrue(h.labels('x')._upper_bounds is h.labels('y')._upper_bounds)
+
     def test_namespace_subsystem_concatenated(self):
         c = Counter('c', 'help', namespace='a', subsystem='b', registry=self.registry)
         c.inc()
@@ -440,6 +848,200 @@ class TestCollectorRegistry(unittest.TestCase):
         m.samples = [('s_sum', {}, 7)]
         self.assertEquals([m], registry.restricted_registry(['s_sum']).collect())
 
+    def test_restricted_registry_labels(self):
+        registry = CollectorRegistry()
+        h = Histogram('h', 'help', ['l'], registry=registry, buckets=[1])
+        h.labels('a').observe(2)
+        h.labels('b').observe(0.5)
+        restricted = registry.restricted_registry(['h_sum', 'h_count'])
+        # Metrics are collected when collect() is called.
+        h.labels('c').observe(3)
+        metrics = restricted.collect()
+        self.assertEquals(['h'], [m.name for m in metrics])
+        self.assertEquals(sorted([('h_count', 'a', 1.0), ('h_sum', 'a', 2.0),
+                                  ('h_count', 'b', 1.0), ('h_sum', 'b', 0.5),
+                                  ('h_count', 'c', 1.0), ('h_sum', 'c', 3.0)]),
+                          sorted([(n, l['l'], v) for n, l, v in metrics[0].samples]))
+
+    def test_restricted_registry_custom_collector(self):
+        registry = CollectorRegistry()
+        class CustomCollector(object):
+            def describe(self):
+                return [GaugeMetricFamily('g', 'help'), GaugeMetricFamily('other', 'help')]
+            def collect(self):
+                return [GaugeMetricFamily('g', 'help', value=1), GaugeMetricFamily('other', 'help', value=2)]
+        registry.register(CustomCollector())
+        Counter('c', 'help', registry=registry)
+        self.assertEquals([GaugeMetricFamily('g', 'help', value=1)],
+                          registry.restricted_registry(['g']).collect())
+
+    def test_parallel_collect(self):
+        pool = ThreadPool(4)
+        try:
+            registry = CollectorRegistry(pool=pool)
+            sequential = CollectorRegistry()
+            for r in (registry, sequential):
+                for name in ('a', 'b', 'c'):
+                    Counter(name, 'help', registry=r).inc(2)
+            self.assertEqual(list(sequential.collect()), list(registry.collect()))
+            self.assertEqual(set(['a', 'b', 'c']),
+                             set(c.describe()[0].name for c in registry.collector_durations()))
+        finally:
+            pool.close()
+
+    def test_parallel_collect_timeout(self):
+        pool = ThreadPool(4)
+        release = threading.Event()
+        try:
+            registry = CollectorRegistry(pool=pool, timeout=0.1)
+            Counter('c', 'help', registry=registry).inc()
+            class SlowCollector(object):
+                calls = 0
+                def collect(self):
+                    self.calls += 1
+                    if self.calls > 1:
+                        release.wait()
+                    return [GaugeMetricFamily('slow', 'help', value=self.calls)]
+            slow = SlowCollector()
+            registry.register(slow)
+            self.assertEqual(1, registry.get_sample_value('slow'))
+            # The second run is slow, so the metrics of the first are returned.
+            self.assertEqual(1, registry.get_sample_value('slow'))
+            self.assertEqual(1, registry.get_sample_value('c'))
+            # It isn't started again while it is still running.
+            self.assertEqual(1, registry.get_sample_value('slow'))
+            self.assertEqual(2, slow.calls)
+            release.set()
+            registry._running[slow].wait()
+            self.assertEqual(3, registry.get_sample_value('slow'))
+        finally:
+            release.set()
+            pool.close()
+
+    def test_parallel_collect_timeout_skips(self):
+        pool = ThreadPool(2)
+        release = threading.Event()
+        try:
+            registry = CollectorRegistry(pool=pool, timeout=0.05)
+            class SlowCollector(object):
+                def collect(self):
+                    release.wait()
+                    return [GaugeMetricFamily('slow', 'help', value=1)]
+            registry.register(SlowCollector())
+            Gauge('g', 'help', registry=registry).set(3)
+            self.assertEqual(['g'], [m.name for m in registry.collect()])
+        finally:
+            release.set()
+            pool.close()
+
+
+class TestRegistrySnapshot(unittest.TestCase):
+    def setUp(self):
+        self.registry = CollectorRegistry()
+        c = Counter('c', 'help', ['method', 'code'], registry=self.registry)
+        c.labels('get', '200').inc(1)
+        c.labels('get', '500').inc(2)
+        c.labels('post', '200').inc(3)
+        Gauge('cg', 'help', registry=self.registry).set(4)
+        Summary('s', 'help', registry=self.registry).observe(5)
+        self.snapshot = self.registry.snapshot()
+
+    def test_get(self):
+        self.assertEqual(2, self.snapshot.get('c', {'code': '500', 'method': 'get'}))
+        self.assertEqual(4, self.snapshot.get('cg'))
+        self.assertEqual(5, self.snapshot.get('s_sum'))
+        self.assertEqual(None, self.snapshot.get('c'))
+        self.assertEqual(None, self.snapshot.get('c', {'code': '404', 'method': 'get'}))
+        for name, labels, value in self.snapshot.select():
+            self.assertEqual(self.registry.get_sample_value(name, labels), self.snapshot.get(name, labels))
+
+    def test_select(self):
+        self.assertEqual(['c', 'c', 'c', 'cg'], [s[0] for s in self.snapshot.select('c')])
+        self.assertEqual([('s_count', {}, 1), ('s_sum', {}, 5)], self.snapshot.select('s_'))
+        self.assertEqual([1, 3], [s[2] for s in self.snapshot.select(labels={'code': '200'})])
+        self.assertEqual([('c', {'method': 'get', 'code': '200'}, 1)],
+                         self.snapshot.select('c', {'code': '200', 'method': 'get'}))
+        self.assertEqual([], self.snapshot.select('c', {'code': '404'}))
+        self.assertEqual([], self.snapshot.select('d'))
+        self.assertEqual(6, len(self.snapshot.select()))
+
+    def test_is_a_snapshot(self):
+        Gauge('g', 'help', registry=self.registry).set(1)
+        self.assertEqual(None, self.snapshot.get('g'))
+
+
+class TestCachedCollector(unittest.TestCase):
+    def setUp(self):
+        self.calls = 0
+        self.release = threading.Event()
+        self.release.set()
+        test = self
+
+        class CountingCollector(object):
+            def collect(self):
+                test.release.wait()
+                test.calls += 1
+                return [GaugeMetricFamily('g', 'help', value=test.calls)]
+        self.collector = CountingCollector()
+        self.registry = CollectorRegistry()
+
+    def test_caches(self):
+        cached = CachedCollector(self.collector, 60)
+        self.registry.register(cached)
+        self.assertEqual(1, self.registry.get_sample_value('g'))
+        self.assertEqual(1, self.registry.get_sample_value('g'))
+        cached._expires = 0
+        self.assertEqual(2, self.registry.get_sample_value('g'))
+
+    def test_single_flight(self):
+        self.registry.register(CachedCollector(self.collector, 60))
+        self.release.clear()
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.registry.get_sample_value('g')))
+                   for _ in range(4)]
+        for t in threads:
+            t.start()
+        time.sleep(0.05)
+        self.release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual([1, 1, 1, 1], results)
+        self.assertEqual(1, self.calls)
+
+    def test_stale_while_revalidate(self):
+        cached = CachedCollector(self.collector, 60, stale_while_revalidate=True)
+        self.registry.register(cached)
+        self.assertEqual(1, self.registry.get_sample_value('g'))
+        self.release.clear()
+        cached._expires = 0
+        # The refresh is blocked, but the previous metrics are returned.
+        self.assertEqual(1, self.registry.get_sample_value('g'))
+        self.assertEqual(1, self.registry.get_sample_value('g'))
+        self.release.set()
+        with cached._condition:
+            while cached._refreshing:
+                cached._condition.wait()
+        self.assertEqual(2, self.registry.get_sample_value('g'))
+        self.assertEqual(2, self.calls)
+
+    def test_error_not_cached(self):
+        class FailingCollector(object):
+            calls = 0
+            def collect(self):
+                self.calls += 1
+                raise ValueError('failed')
+        failing = FailingCollector()
+        cached = CachedCollector(failing, 60)
+        self.assertRaises(ValueError, cached.collect)
+        self.assertRaises(ValueError, cached.collect)
+        self.assertEqual(2, failing.calls)
+
+    def test_describe(self):
+        registry = CollectorRegistry()
+        c = Counter('c', 'help', registry=None)
+        registry.register(CachedCollector(c, 60))
+        self.assertRaises(ValueError, Counter, 'c', 'help', registry=registry)
+
 
 if __name__ == '__main__':
     unittest.main()
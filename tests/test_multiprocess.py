@@ -1,19 +1,46 @@
 from __future__ import unicode_literals
+import gc
+import json
+import multiprocessing
 import os
 import shutil
+import struct
+import sys
 import tempfile
 import time
-import unittest
+from multiprocessing.pool import ThreadPool
+
+if sys.version_info < (2, 7):
+    # We need the skip decorators from unittest2 on Python 2.6.
+    import unittest2 as unittest
+else:
+    import unittest
 
 import prometheus_client
 from prometheus_client.core import *
 from prometheus_client.multiprocess import *
 
+def _check_expire_after(test):
+    now = [0.0]
+    c = Counter('c', 'help', ['l'], registry=None, expire_after=10)
+    c._timer = lambda: now[0]
+    c.labels('a').inc(2)
+    list(c._samples())
+    now[0] = 20
+    list(c._samples())
+    test.assertEqual({}, c._metrics)
+    # The value stays in the file, is still exported, and carries on
+    # when the child is recreated.
+    test.assertEqual(2, test.registry.get_sample_value('c', {'l': 'a'}))
+    c.labels('a').inc(1)
+    test.assertEqual(3, test.registry.get_sample_value('c', {'l': 'a'}))
+
+
 class TestMultiProcess(unittest.TestCase):
     def setUp(self):
         self.tempdir = tempfile.mkdtemp()
         os.environ['prometheus_multiproc_dir'] = self.tempdir
-        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(123)
+        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda: 123)
         self.registry = CollectorRegistry()
         MultiProcessCollector(self.registry, self.tempdir)
 
@@ -24,16 +51,23 @@ class TestMultiProcess(unittest.TestCase):
 
     def test_counter_adds(self):
         c1 = Counter('c', 'help', registry=None)
-        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(456)
+        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda: 456)
         c2 = Counter('c', 'help', registry=None)
         self.assertEqual(0, self.registry.get_sample_value('c'))
         c1.inc(1)
         c2.inc(2)
         self.assertEqual(3, self.registry.get_sample_value('c'))
 
+    def test_lock_file_cant_be_created(self):
+        # As if the directory were mounted read-only.
+        os.symlink(os.path.join(self.tempdir, 'missing', 'compaction.lock'),
+                   os.path.join(self.tempdir, 'compaction.lock'))
+        Counter('c', 'help', registry=None).inc(1)
+        self.assertEqual(1, self.registry.get_sample_value('c'))
+
     def test_summary_adds(self):
         s1 = Summary('s', 'help', registry=None)
-        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(456)
+        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda: 456)
         s2 = Summary('s', 'help', registry=None)
         self.assertEqual(0, self.registry.get_sample_value('s_count'))
         self.assertEqual(0, self.registry.get_sample_value('s_sum'))
@@ -42,9 +76,22 @@ class TestMultiProcess(unittest.TestCase):
         self.assertEqual(2, self.registry.get_sample_value('s_count'))
         self.assertEqual(3, self.registry.get_sample_value('s_sum'))
 
+    def test_local_value_backend(self):
+        c = Counter('c', 'help', registry=None, value_backend='mutex')
+        c.inc()
+        Summary('s', 'help', registry=None, value_backend='mutex', quantiles=((0.5, 0.05),))
+        self.assertEqual(None, self.registry.get_sample_value('c'))
+        self.assertEqual([], [f for f in os.listdir(self.tempdir) if f.endswith('.db')])
+
+    def test_expire_after(self):
+        _check_expire_after(self)
+
+    def test_summary_quantiles_raise(self):
+        self.assertRaises(ValueError, Summary, 's', 'help', registry=None, quantiles=((0.5, 0.05),))
+
     def test_histogram_adds(self):
         h1 = Histogram('h', 'help', registry=None)
-        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(456)
+        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda: 456)
         h2 = Histogram('h', 'help', registry=None)
         self.assertEqual(0, self.registry.get_sample_value('h_count'))
         self.assertEqual(0, self.registry.get_sample_value('h_sum'))
@@ -55,9 +102,71 @@ class TestMultiProcess(unittest.TestCase):
         self.assertEqual(3, self.registry.get_sample_value('h_sum'))
         self.assertEqual(2, self.registry.get_sample_value('h_bucket', {'le': '5.0'}))
 
+    def test_histogram_observe_many(self):
+        h = Histogram('h', 'help', registry=None)
+        h.observe_many([1, 2, 20])
+        self.assertEqual(3, self.registry.get_sample_value('h_count'))
+        self.assertEqual(23, self.registry.get_sample_value('h_sum'))
+        self.assertEqual(1, self.registry.get_sample_value('h_bucket', {'le': '1.0'}))
+        self.assertEqual(2, self.registry.get_sample_value('h_bucket', {'le': '10.0'}))
+
+    def test_exponential_histogram_adds(self):
+        h1 = ExponentialHistogram('h', 'help', registry=None, schema=0)
+        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda: 456)
+        h2 = ExponentialHistogram('h', 'help', registry=None, schema=0)
+        self.assertEqual(0, self.registry.get_sample_value('h_count'))
+        self.assertEqual(0, self.registry.get_sample_value('h_bucket', {'le': '+Inf'}))
+        h1.observe(1)
+        h2.observe(3)
+        h2.observe(0.7)
+        self.assertEqual(3, self.registry.get_sample_value('h_count'))
+        self.assertEqual(4.7, self.registry.get_sample_value('h_sum'))
+        self.assertEqual(2, self.registry.get_sample_value('h_bucket', {'le': '1.0'}))
+        self.assertEqual(3, self.registry.get_sample_value('h_bucket', {'le': '4.0'}))
+        self.assertEqual(3, self.registry.get_sample_value('h_bucket', {'le': '+Inf'}))
+        self.assertRaises(ValueError, ExponentialHistogram, 'h', 'help', registry=None, max_buckets=10)
+
+    def test_new_series_after_collect(self):
+        c = Counter('c', 'help', ['l'], registry=None)
+        c.labels('a').inc()
+        self.assertEqual(1, self.registry.get_sample_value('c', {'l': 'a'}))
+        c.labels('b').inc(2)
+        c.labels('a').inc()
+        self.assertEqual(2, self.registry.get_sample_value('c', {'l': 'a'}))
+        self.assertEqual(2, self.registry.get_sample_value('c', {'l': 'b'}))
+
+    def test_empty_file_ignored(self):
+        path = os.path.join(self.tempdir, 'counter_789.db')
+        open(path, 'wb').close()
+        c = Counter('c', 'help', registry=None)
+        c.inc()
+        self.assertEqual(1, self.registry.get_sample_value('c'))
+        self.assertEqual(0, os.path.getsize(path))
+
+    def test_replaced_file(self):
+        c = Counter('c', 'help', registry=None)
+        c.inc()
+        self.assertEqual(1, self.registry.get_sample_value('c'))
+        path = os.path.join(self.tempdir, 'counter_123.db')
+        replacement = os.path.join(self.tempdir, 'replacement')
+        d = core._MmapedDict(replacement)
+        d.write_value(('c2', 'c2', (), ()), 5.0)
+        d.close()
+        os.rename(replacement, path)
+        self.assertEqual(None, self.registry.get_sample_value('c'))
+        self.assertEqual(5, self.registry.get_sample_value('c2'))
+
+    def test_legacy_json_keys(self):
+        d = core._MmapedDict(os.path.join(self.tempdir, 'counter_789.db'))
+        d.write_value(json.dumps(('c', 'c', ['l'], ['a'])), 5.0)
+        d.close()
+        c = Counter('c', 'help', ['l'], registry=None)
+        c.labels('a').inc(2)
+        self.assertEqual(7, self.registry.get_sample_value('c', {'l': 'a'}))
+
     def test_gauge_all(self):
         g1 = Gauge('g', 'help', registry=None)
-        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(456)
+        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda: 456)
         g2 = Gauge('g', 'help', registry=None)
         self.assertEqual(0, self.registry.get_sample_value('g', {'pid': '123'}))
         self.assertEqual(0, self.registry.get_sample_value('g', {'pid': '456'}))
@@ -69,7 +178,7 @@ class TestMultiProcess(unittest.TestCase):
 
     def test_gauge_liveall(self):
         g1 = Gauge('g', 'help', registry=None, multiprocess_mode='liveall')
-        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(456)
+        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda: 456)
         g2 = Gauge('g', 'help', registry=None, multiprocess_mode='liveall')
         self.assertEqual(0, self.registry.get_sample_value('g', {'pid': '123'}))
         self.assertEqual(0, self.registry.get_sample_value('g', {'pid': '456'}))
@@ -83,7 +192,7 @@ class TestMultiProcess(unittest.TestCase):
 
     def test_gauge_min(self):
         g1 = Gauge('g', 'help', registry=None, multiprocess_mode='min')
-        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(456)
+        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda: 456)
         g2 = Gauge('g', 'help', registry=None, multiprocess_mode='min')
         self.assertEqual(0, self.registry.get_sample_value('g'))
         g1.set(1)
@@ -92,7 +201,7 @@ class TestMultiProcess(unittest.TestCase):
 
     def test_gauge_max(self):
         g1 = Gauge('g', 'help', registry=None, multiprocess_mode='max')
-        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(456)
+        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda: 456)
         g2 = Gauge('g', 'help', registry=None, multiprocess_mode='max')
         self.assertEqual(0, self.registry.get_sample_value('g'))
         g1.set(1)
@@ -101,7 +210,7 @@ class TestMultiProcess(unittest.TestCase):
 
     def test_gauge_livesum(self):
         g1 = Gauge('g', 'help', registry=None, multiprocess_mode='livesum')
-        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(456)
+        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda: 456)
         g2 = Gauge('g', 'help', registry=None, multiprocess_mode='livesum')
         self.assertEqual(0, self.registry.get_sample_value('g'))
         g1.set(1)
@@ -110,6 +219,556 @@ class TestMultiProcess(unittest.TestCase):
         mark_process_dead(123, os.environ['prometheus_multiproc_dir'])
         self.assertEqual(2, self.registry.get_sample_value('g'))
 
+    def test_compaction(self):
+        c1 = Counter('c', 'help', registry=None)
+        h1 = Histogram('h', 'help', registry=None)
+        g1 = Gauge('g', 'help', registry=None)
+        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda: 456)
+        c2 = Counter('c', 'help', registry=None)
+        h2 = Histogram('h', 'help', registry=None)
+        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda: 789)
+        c3 = Counter('c', 'help', registry=None)
+        c1.inc(1)
+        c2.inc(2)
+        c3.inc(4)
+        h1.observe(1)
+        h2.observe(2)
+        g1.set(5)
+
+        mark_process_dead(123, self.tempdir)
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir, 'counter_123.db')))
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir, 'histogram_123.db')))
+        self.assertTrue(os.path.exists(os.path.join(self.tempdir, 'gauge_all_123.db')))
+        self.assertEqual(7, self.registry.get_sample_value('c'))
+        self.assertEqual(2, self.registry.get_sample_value('h_count'))
+        self.assertEqual(1, self.registry.get_sample_value('h_bucket', {'le': '1.0'}))
+        self.assertEqual(5, self.registry.get_sample_value('g', {'pid': '123'}))
+
+        compact_dead_process(456, self.tempdir)
+        self.assertEqual(7, self.registry.get_sample_value('c'))
+        self.assertEqual(2, self.registry.get_sample_value('h_count'))
+        self.assertEqual(3, self.registry.get_sample_value('h_sum'))
+        c3.inc(1)
+        self.assertEqual(8, self.registry.get_sample_value('c'))
+        self.assertEqual(['counter_789.db', 'counter_aggregate.db', 'gauge_all_123.db', 'histogram_aggregate.db'],
+                sorted([f for f in os.listdir(self.tempdir) if f.endswith('.db')]))
+
+    def test_mark_current_process_dead(self):
+        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(flush_interval=60)
+        c = Counter('c', 'help', registry=None)
+        c.inc(5)
+        mark_process_dead(os.getpid(), self.tempdir)
+        self.assertEqual(5, self.registry.get_sample_value('c'))
+        self.assertTrue(os.path.exists(os.path.join(self.tempdir, 'counter_{0}.db'.format(os.getpid()))))
+
+    def test_pid_change(self):
+        pid = {'value': 123}
+        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda: pid['value'])
+        c = Counter('c', 'help', registry=None)
+        g = Gauge('g', 'help', registry=None)
+        c.inc(1)
+        g.set(1)
+        pid['value'] = 456
+        c.inc(2)
+        self.assertEqual(3, self.registry.get_sample_value('c'))
+        self.assertEqual(1, self.registry.get_sample_value('g', {'pid': '123'}))
+        # The gauge starts from zero in the new process.
+        self.assertEqual(0, g._value.get())
+        g.set(5)
+        self.assertEqual(5, self.registry.get_sample_value('g', {'pid': '456'}))
+        self.assertTrue(os.path.exists(os.path.join(self.tempdir, 'counter_456.db')))
+
+    @unittest.skipIf(not hasattr(os, 'fork'), 'Requires fork')
+    def test_fork(self):
+        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue()
+        c = Counter('c', 'help', registry=None)
+        c.inc(1)
+        child = os.fork()
+        if child == 0:
+            try:
+                c.inc(2)
+            finally:
+                os._exit(0)
+        os.waitpid(child, 0)
+        self.assertEqual(3, self.registry.get_sample_value('c'))
+        self.assertTrue(os.path.exists(os.path.join(self.tempdir, 'counter_{0}.db'.format(child))))
+
+    @unittest.skipIf(not hasattr(os, 'register_at_fork'), 'Requires os.register_at_fork')
+    def test_unused_value_class_not_kept_for_forks(self):
+        value_class = prometheus_client.core._MultiProcessValue()
+        Counter('c', 'help', registry=None, value_backend=value_class).inc(1)
+        self.assertTrue(value_class in prometheus_client.core._fork_value_classes)
+        count = len(prometheus_client.core._fork_value_classes)
+        del value_class
+        gc.collect()
+        self.assertEqual(count - 1, len(prometheus_client.core._fork_value_classes))
+
+    def test_write_behind(self):
+        ValueClass = prometheus_client.core._MultiProcessValue(lambda: 123, flush_interval=1000, flush_batch=3)
+        prometheus_client.core._ValueClass = ValueClass
+        c = Counter('c', 'help', registry=None)
+        c.inc()
+        self.assertEqual(0, self.registry.get_sample_value('c'))
+        c.inc()
+        c.inc()
+        self.assertEqual(3, self.registry.get_sample_value('c'))
+        c.inc()
+        self.assertEqual(3, self.registry.get_sample_value('c'))
+        ValueClass.flush()
+        self.assertEqual(4, self.registry.get_sample_value('c'))
+
+    def test_write_behind_interval(self):
+        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda: 123, flush_interval=0.01)
+        g = Gauge('g', 'help', registry=None)
+        g.set(5)
+        for _ in range(100):
+            if self.registry.get_sample_value('g', {'pid': '123'}) == 5:
+                break
+            time.sleep(0.01)
+        self.assertEqual(5, self.registry.get_sample_value('g', {'pid': '123'}))
+
+    def test_pool(self):
+        for pid in range(200):
+            prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda pid=pid: pid)
+            Counter('c', 'help', ['l'], registry=None).labels(str(pid % 3)).inc(pid)
+            Histogram('h', 'help', registry=None).observe(pid)
+            Gauge('gmax', 'help', registry=None, multiprocess_mode='max').set(pid)
+            Gauge('gall', 'help', registry=None).set(pid)
+        expected = list(self.registry.collect())
+
+        for pool in [ThreadPool(4), multiprocessing.Pool(2)]:
+            try:
+                registry = CollectorRegistry()
+                MultiProcessCollector(registry, self.tempdir, pool=pool)
+                self.assertEqual(expected, list(registry.collect()))
+                # Results come from cached file states the second time.
+                self.assertEqual(expected, list(registry.collect()))
+            finally:
+                pool.terminate()
+        self.assertEqual(sum(range(200)), self.registry.get_sample_value('h_sum'))
+        self.assertEqual(199, self.registry.get_sample_value('gmax'))
+
+
+def _backend_worker(backend, n):
+    prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(backend=backend)
+    c = Counter('c', 'help', ['l'], registry=None)
+    for i in range(n):
+        c.labels(str(i)).inc()
+
+
+def _ring_collector(path, queue):
+    registry = CollectorRegistry()
+    MultiProcessCollector(registry, path)
+    queue.put(sum(s[2] for s in list(registry.collect())[0].samples))
+
+
+class TestArena(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        os.environ['prometheus_multiproc_dir'] = self.tempdir
+        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda: 123, backend='arena')
+        self.registry = CollectorRegistry()
+        MultiProcessCollector(self.registry, self.tempdir)
+
+    def tearDown(self):
+        del os.environ['prometheus_multiproc_dir']
+        shutil.rmtree(self.tempdir)
+        prometheus_client.core._ValueClass = prometheus_client.core._MutexValue
+
+    def test_expire_after(self):
+        _check_expire_after(self)
+
+    def test_counter_adds(self):
+        c1 = Counter('c', 'help', registry=None)
+        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda: 456, backend='arena')
+        c2 = Counter('c', 'help', registry=None)
+        self.assertEqual(0, self.registry.get_sample_value('c'))
+        c1.inc(1)
+        c2.inc(2)
+        self.assertEqual(3, self.registry.get_sample_value('c'))
+        self.assertEqual(['metrics.arena'], [f for f in os.listdir(self.tempdir) if f != 'compaction.lock'])
+
+    def test_histogram_adds(self):
+        h1 = Histogram('h', 'help', registry=None)
+        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda: 456, backend='arena')
+        h2 = Histogram('h', 'help', registry=None)
+        h1.observe(1)
+        h2.observe(2)
+        self.assertEqual(2, self.registry.get_sample_value('h_count'))
+        self.assertEqual(3, self.registry.get_sample_value('h_sum'))
+        self.assertEqual(1, self.registry.get_sample_value('h_bucket', {'le': '1.0'}))
+        self.assertEqual(2, self.registry.get_sample_value('h_bucket', {'le': '2.5'}))
+
+    def test_gauge_liveall(self):
+        g1 = Gauge('g', 'help', registry=None, multiprocess_mode='liveall')
+        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda: 456, backend='arena')
+        g2 = Gauge('g', 'help', registry=None, multiprocess_mode='liveall')
+        g1.set(1)
+        g2.set(2)
+        self.assertEqual(1, self.registry.get_sample_value('g', {'pid': '123'}))
+        self.assertEqual(2, self.registry.get_sample_value('g', {'pid': '456'}))
+        mark_process_dead(123, self.tempdir)
+        self.assertEqual(None, self.registry.get_sample_value('g', {'pid': '123'}))
+        self.assertEqual(2, self.registry.get_sample_value('g', {'pid': '456'}))
+
+    def test_gauge_livesum(self):
+        g1 = Gauge('g', 'help', registry=None, multiprocess_mode='livesum')
+        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda: 456, backend='arena')
+        g2 = Gauge('g', 'help', registry=None, multiprocess_mode='livesum')
+        g1.set(1)
+        g2.set(2)
+        self.assertEqual(3, self.registry.get_sample_value('g'))
+        mark_process_dead(123, self.tempdir)
+        self.assertEqual(2, self.registry.get_sample_value('g'))
+
+    def test_compaction(self):
+        c1 = Counter('c', 'help', registry=None)
+        h1 = Histogram('h', 'help', registry=None)
+        g1 = Gauge('g', 'help', registry=None, multiprocess_mode='max')
+        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda: 456, backend='arena')
+        c2 = Counter('c', 'help', registry=None)
+        g2 = Gauge('g', 'help', registry=None, multiprocess_mode='max')
+        a2 = Gauge('a', 'help', registry=None)
+        c1.inc(1)
+        h1.observe(1)
+        g1.set(5)
+        c2.inc(2)
+        g2.set(3)
+        a2.set(4)
+        mark_process_dead(123, self.tempdir)
+        mark_process_dead(456, self.tempdir)
+        arena = os.path.join(self.tempdir, 'metrics.arena')
+        size = os.path.getsize(arena)
+        self.assertEqual(3, self.registry.get_sample_value('c'))
+        self.assertEqual(1, self.registry.get_sample_value('h_count'))
+        self.assertEqual(5, self.registry.get_sample_value('g'))
+        # Gauges of the all mode are kept per process.
+        self.assertEqual(4, self.registry.get_sample_value('a', {'pid': '456'}))
+
+        # The segment freed by the first process is reused.
+        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda: 789, backend='arena')
+        c3 = Counter('c', 'help', registry=None)
+        c3.inc(4)
+        self.assertEqual(7, self.registry.get_sample_value('c'))
+        self.assertEqual(size, os.path.getsize(arena))
+        mark_process_dead(789, self.tempdir)
+        self.assertEqual(7, self.registry.get_sample_value('c'))
+
+    def test_unused_series_not_reported(self):
+        Gauge('g1', 'help', registry=None)
+        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda: 456, backend='arena')
+        Gauge('g2', 'help', registry=None)
+        self.assertEqual(0, self.registry.get_sample_value('g1', {'pid': '123'}))
+        self.assertEqual(None, self.registry.get_sample_value('g1', {'pid': '456'}))
+        self.assertEqual(0, self.registry.get_sample_value('g2', {'pid': '456'}))
+
+    def test_many_series_match_files(self):
+        n = prometheus_client.core._ARENA_SLOTS + 100
+        filedir = tempfile.mkdtemp()
+        try:
+            for backend, path in [('arena', self.tempdir), ('files', filedir)]:
+                os.environ['prometheus_multiproc_dir'] = path
+                for pid in (1, 2):
+                    prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda pid=pid: pid, backend=backend)
+                    c = Counter('c', 'help', ['l'], registry=None)
+                    for i in range(0, n, pid):
+                        c.labels('value {0}'.format(i)).inc(pid)
+                    Gauge('g', 'help', registry=None).set(pid)
+            registry = CollectorRegistry()
+            MultiProcessCollector(registry, filedir)
+            samples = lambda r: dict(((s[0], tuple(sorted(s[1].items()))), s[2]) for m in r.collect() for s in m.samples)
+            self.assertEqual(samples(registry), samples(self.registry))
+        finally:
+            shutil.rmtree(filedir)
+        self.assertEqual(3, self.registry.get_sample_value('c', {'l': 'value 0'}))
+        self.assertEqual(1, self.registry.get_sample_value('c', {'l': 'value {0}'.format(n - 1)}))
+
+    def test_processes(self):
+        processes = [multiprocessing.Process(target=_backend_worker, args=('arena', 300)) for _ in range(4)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        self.assertEqual(4, self.registry.get_sample_value('c', {'l': '0'}))
+        self.assertEqual(4, self.registry.get_sample_value('c', {'l': '299'}))
+        self.assertEqual(1200, sum(s[2] for s in list(self.registry.collect())[0].samples))
+
+
+class TestRing(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        os.environ['prometheus_multiproc_dir'] = self.tempdir
+        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda: 123, backend='ring')
+        self.registry = CollectorRegistry()
+        MultiProcessCollector(self.registry, self.tempdir)
+
+    def tearDown(self):
+        del os.environ['prometheus_multiproc_dir']
+        shutil.rmtree(self.tempdir)
+        prometheus_client.core._ValueClass = prometheus_client.core._MutexValue
+
+    def test_expire_after(self):
+        _check_expire_after(self)
+
+    def test_counter_adds(self):
+        c1 = Counter('c', 'help', registry=None)
+        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda: 456, backend='ring')
+        c2 = Counter('c', 'help', registry=None)
+        self.assertEqual(0, self.registry.get_sample_value('c'))
+        c1.inc(1)
+        c2.inc(2)
+        self.assertEqual(3, self.registry.get_sample_value('c'))
+        c1.inc(1)
+        self.assertEqual(4, self.registry.get_sample_value('c'))
+
+    def test_histogram_adds(self):
+        h1 = Histogram('h', 'help', registry=None)
+        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda: 456, backend='ring')
+        h2 = Histogram('h', 'help', registry=None)
+        h1.observe(1)
+        h2.observe(2)
+        self.assertEqual(2, self.registry.get_sample_value('h_count'))
+        self.assertEqual(3, self.registry.get_sample_value('h_sum'))
+        self.assertEqual(1, self.registry.get_sample_value('h_bucket', {'le': '1.0'}))
+
+    def test_gauge_liveall(self):
+        g1 = Gauge('g', 'help', registry=None, multiprocess_mode='liveall')
+        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda: 456, backend='ring')
+        g2 = Gauge('g', 'help', registry=None, multiprocess_mode='liveall')
+        g1.set(1)
+        g2.set(2)
+        self.assertEqual(1, self.registry.get_sample_value('g', {'pid': '123'}))
+        self.assertEqual(2, self.registry.get_sample_value('g', {'pid': '456'}))
+        mark_process_dead(123, self.tempdir)
+        self.assertEqual(None, self.registry.get_sample_value('g', {'pid': '123'}))
+        self.assertEqual(2, self.registry.get_sample_value('g', {'pid': '456'}))
+
+    def test_pid_reused(self):
+        c1 = Counter('c', 'help', registry=None)
+        g1 = Gauge('g', 'help', registry=None)
+        c1.inc(5)
+        g1.set(5)
+        self.assertEqual(5, self.registry.get_sample_value('c'))
+        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda: 123, backend='ring')
+        c2 = Counter('c', 'help', registry=None)
+        g2 = Gauge('g', 'help', registry=None)
+        c2.inc(1)
+        g2.set(1)
+        self.assertEqual(6, self.registry.get_sample_value('c'))
+        self.assertEqual(1, self.registry.get_sample_value('g', {'pid': '123'}))
+
+    def test_full(self):
+        ring = core._RingBuffer(os.path.join(self.tempdir, 'ring_1.ring'), capacity=8)
+        reader = prometheus_client.multiprocess._RingReader.open(os.path.join(self.tempdir, 'ring_1.ring'))
+        slots = [ring.slot(('counter', 'c', 'c', ('l', ), (str(i), ))) for i in range(3)]
+        for i in range(20):
+            slots[i % 3][0] = i
+        reader.drain()
+        values = lambda: sorted(prometheus_client.multiprocess._read_file(
+            os.path.join(self.tempdir, 'counter_1.db'), None)[1])
+        # Only what fitted was written, the rest is queued.
+        self.assertEqual([(('c', 'c', ('l', ), ('0', )), 3), (('c', 'c', ('l', ), ('1', )), 1),
+                          (('c', 'c', ('l', ), ('2', )), 2)], values())
+        slots[0][0] = 100
+        reader.drain()
+        slots[0][0] = 101
+        reader.drain()
+        self.assertEqual([(('c', 'c', ('l', ), ('0', )), 101), (('c', 'c', ('l', ), ('1', )), 19),
+                          (('c', 'c', ('l', ), ('2', )), 17)], values())
+        self.assertTrue(struct.unpack_from(b'q', reader._m, 32)[0] > 0)
+        reader.close()
+
+    def test_aggregator_restart(self):
+        c = Counter('c', 'help', ['l'], registry=None)
+        c.labels('a').inc(1)
+        self.assertEqual(1, self.registry.get_sample_value('c', {'l': 'a'}))
+        prometheus_client.multiprocess._ring_aggregators.pop(self.tempdir).close()
+        # The new aggregator finds the key of the series in the keys file.
+        c.labels('a').inc(1)
+        c.labels('b').inc(3)
+        self.assertEqual(2, self.registry.get_sample_value('c', {'l': 'a'}))
+        self.assertEqual(3, self.registry.get_sample_value('c', {'l': 'b'}))
+
+    def test_unknown_series(self):
+        ring = core._RingBuffer(os.path.join(self.tempdir, 'ring_1.ring'))
+        ring.slot(('counter', 'c', 'c', (), ()))[0] = 1
+        os.remove(os.path.join(self.tempdir, 'ring_1.keys'))
+        reader = prometheus_client.multiprocess._RingReader.open(os.path.join(self.tempdir, 'ring_1.ring'))
+        reader.drain()
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir, 'counter_1.db')))
+        self.assertTrue(reader.drained())
+        reader.close()
+
+    def test_dead_rings_removed(self):
+        c1 = Counter('c', 'help', registry=None)
+        g1 = Gauge('g', 'help', registry=None)
+        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda: 456, backend='ring')
+        c2 = Counter('c', 'help', registry=None)
+        c1.inc(1)
+        c2.inc(2)
+        g1.set(5)
+        self.assertEqual(3, self.registry.get_sample_value('c'))
+        mark_process_dead(123, self.tempdir)
+        self.assertEqual(3, self.registry.get_sample_value('c'))
+        self.assertEqual(5, self.registry.get_sample_value('g', {'pid': '123'}))
+        self.assertEqual(['ring_456.keys', 'ring_456.ring'],
+                         sorted(f for f in os.listdir(self.tempdir) if f.endswith(('.keys', '.ring'))))
+        c2.inc(1)
+        self.assertEqual(4, self.registry.get_sample_value('c'))
+        # The values of the removed ring were compacted into files, so a new aggregator has them.
+        prometheus_client.multiprocess._ring_aggregators.pop(self.tempdir).close()
+        self.assertEqual(4, self.registry.get_sample_value('c'))
+        self.assertEqual(5, self.registry.get_sample_value('g', {'pid': '123'}))
+
+    def test_other_aggregator(self):
+        c = Counter('c', 'help', ['l'], registry=None)
+        c.labels('a').inc(1)
+        self.assertEqual(1, self.registry.get_sample_value('c', {'l': 'a'}))
+        other = prometheus_client.multiprocess._RingAggregator(self.tempdir)
+        try:
+            c.labels('b').inc(2)
+            other.drain()
+            # This aggregator appends to the file after the series added by the other one.
+            c.labels('c').inc(3)
+            c.labels('a').inc(1)
+            self.assertEqual(2, self.registry.get_sample_value('c', {'l': 'a'}))
+            self.assertEqual(2, self.registry.get_sample_value('c', {'l': 'b'}))
+            self.assertEqual(3, self.registry.get_sample_value('c', {'l': 'c'}))
+        finally:
+            other.close()
+
+    def test_processes(self):
+        start_ring_aggregator(self.tempdir, 0.01)
+        processes = [multiprocessing.Process(target=_backend_worker, args=('ring', 300)) for _ in range(4)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        self.assertEqual(4, self.registry.get_sample_value('c', {'l': '0'}))
+        self.assertEqual(1200, sum(s[2] for s in list(self.registry.collect())[0].samples))
+        # Another process can collect too.
+        queue = multiprocessing.Queue()
+        p = multiprocessing.Process(target=_ring_collector, args=(self.tempdir, queue))
+        p.start()
+        self.assertEqual(1200, queue.get(timeout=10))
+        p.join()
+
+
+class TestDense(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        os.environ['prometheus_multiproc_dir'] = self.tempdir
+        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda: 123, backend='dense')
+        self.registry = CollectorRegistry()
+        MultiProcessCollector(self.registry, self.tempdir)
+
+    def tearDown(self):
+        del os.environ['prometheus_multiproc_dir']
+        shutil.rmtree(self.tempdir)
+        prometheus_client.core._ValueClass = prometheus_client.core._MutexValue
+
+    def test_expire_after(self):
+        _check_expire_after(self)
+
+    def test_counter_adds(self):
+        c1 = Counter('c', 'help', registry=None)
+        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda: 456, backend='dense')
+        c2 = Counter('c', 'help', registry=None)
+        self.assertEqual(0, self.registry.get_sample_value('c'))
+        c1.inc(1)
+        c2.inc(2)
+        self.assertEqual(3, self.registry.get_sample_value('c'))
+        # New series are picked up by later collections.
+        c3 = Counter('c3', 'help', registry=None)
+        c3.inc(4)
+        self.assertEqual(4, self.registry.get_sample_value('c3'))
+        self.assertEqual(3, self.registry.get_sample_value('c'))
+
+    def test_gauge_modes(self):
+        g1 = Gauge('g', 'help', registry=None, multiprocess_mode='max')
+        a1 = Gauge('a', 'help', registry=None)
+        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda: 456, backend='dense')
+        g2 = Gauge('g', 'help', registry=None, multiprocess_mode='max')
+        a2 = Gauge('a', 'help', registry=None)
+        g1.set(1)
+        g2.set(2)
+        a1.set(3)
+        a2.set(4)
+        self.assertEqual(2, self.registry.get_sample_value('g'))
+        self.assertEqual(3, self.registry.get_sample_value('a', {'pid': '123'}))
+        self.assertEqual(4, self.registry.get_sample_value('a', {'pid': '456'}))
+
+    def test_many_series_match_files(self):
+        n = prometheus_client.core._DENSE_SLOTS + 100
+        filedir = tempfile.mkdtemp()
+        try:
+            for backend, path in [('dense', self.tempdir), ('files', filedir)]:
+                os.environ['prometheus_multiproc_dir'] = path
+                for pid in (1, 2):
+                    prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda pid=pid: pid, backend=backend)
+                    c = Counter('c', 'help', ['l'], registry=None)
+                    for i in range(0, n, pid):
+                        c.labels('value {0}'.format(i)).inc(pid)
+                    h = Histogram('h', 'help', registry=None)
+                    h.observe(pid)
+                    Gauge('g', 'help', registry=None, multiprocess_mode='livesum').set(pid)
+            registry = CollectorRegistry()
+            MultiProcessCollector(registry, filedir)
+            self.assertEqual(list(registry.collect()), list(self.registry.collect()))
+            pool = ThreadPool(2)
+            try:
+                registry = CollectorRegistry()
+                MultiProcessCollector(registry, self.tempdir, pool=pool)
+                self.assertEqual(list(registry.collect()), list(self.registry.collect()))
+            finally:
+                pool.close()
+        finally:
+            shutil.rmtree(filedir)
+        self.assertEqual(3, self.registry.get_sample_value('c', {'l': 'value 0'}))
+        self.assertEqual(1, self.registry.get_sample_value('c', {'l': 'value {0}'.format(n - 1)}))
+        self.assertEqual(3, self.registry.get_sample_value('g'))
+
+    def test_mark_process_dead(self):
+        c1 = Counter('c', 'help', registry=None)
+        c1.inc(1)
+        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda: 456, backend='dense')
+        c2 = Counter('c', 'help', registry=None)
+        c2.inc(2)
+        mark_process_dead(123, self.tempdir)
+        self.assertEqual(3, self.registry.get_sample_value('c'))
+
+    @unittest.skipIf(prometheus_client.multiprocess.numpy is None, 'Requires numpy')
+    def test_series_pruned(self):
+        collector = MultiProcessCollector(None, self.tempdir)
+        n = prometheus_client.multiprocess._PRUNE_SERIES
+        for pid in range(6):
+            prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda pid=pid: pid, backend='dense')
+            g = Gauge('g', 'help', ['l'], registry=None, multiprocess_mode='livesum')
+            for i in range(n):
+                g.labels('{0} {1}'.format(pid, i)).set(1)
+            self.assertEqual(n, len(list(collector.collect())[0].samples))
+            mark_process_dead(pid, self.tempdir)
+        # Keys of the removed files were dropped along the way.
+        self.assertTrue(len(collector._series_keys) <= 2 * n)
+        self.assertEqual([], list(collector.collect()))
+
+    def test_migrate_to_dense(self):
+        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda: 123)
+        c = Counter('c', 'help', ['l'], registry=None)
+        c.labels('a').inc(1)
+        c.labels('b').inc(2)
+        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda: 123, backend='dense')
+        # Migrating twice is harmless.
+        migrate_to_dense(self.tempdir)
+        migrate_to_dense(self.tempdir)
+        with open(os.path.join(self.tempdir, 'counter_123.db'), 'rb') as f:
+            self.assertEqual(prometheus_client.core._DENSE_MAGIC, f.read(8))
+        c = Counter('c', 'help', ['l'], registry=None)
+        c.labels('a').inc(3)
+        self.assertEqual(4, self.registry.get_sample_value('c', {'l': 'a'}))
+        self.assertEqual(2, self.registry.get_sample_value('c', {'l': 'b'}))
+
+
 class TestMmapedDict(unittest.TestCase):
     def setUp(self):
         fd, self.tempfile = tempfile.mkstemp()
@@ -128,6 +787,36 @@ class TestMmapedDict(unittest.TestCase):
         self.d.write_value(key, 123.0)
         self.assertEqual([(key, 123.0)], list(self.d.read_all_values()))
 
+    def test_compact_keys(self):
+        key1 = ('h', 'h_bucket', ('l', 'le'), ('a', '1.0'))
+        key2 = ('h', 'h_bucket', ('l', 'le'), ('a', '+Inf'))
+        self.d.write_value(key1, 1.0)
+        self.d.write_value(key2, 2.0)
+        self.d.write_value('abc', 3.0)
+        self.assertEqual([(key1, 1.0), (key2, 2.0), ('abc', 3.0)], list(self.d.read_all_values()))
+        self.d.close()
+        self.d = core._MmapedDict(self.tempfile)
+        self.assertEqual(2.0, self.d.read_value(key2))
+        key3 = ('h', 'h_sum', ('l',), ('a',))
+        self.d.write_value(key3, 4.0)
+        self.assertEqual([(key1, 1.0), (key2, 2.0), ('abc', 3.0), (key3, 4.0)], list(self.d.read_all_values()))
+
+    def test_slot(self):
+        slot = self.d.slot('abc')
+        slot[0] = 1.0
+        self.assertEqual(1.0, self.d.read_value('abc'))
+        # Slots stay valid after the file is expanded.
+        self.d.write_value('a' * core._INITIAL_MMAP_SIZE, 2.0)
+        slot[0] = 3.0
+        self.assertEqual(3.0, self.d.read_value('abc'))
+        self.assertEqual(3.0, self.d.slot('abc')[0])
+
+    def test_varint(self):
+        for n in [0, 1, 127, 128, 300, 2 ** 32]:
+            encoded = bytearray()
+            core._encode_varint(n, encoded)
+            self.assertEqual((n, len(encoded)), core._decode_varint(encoded, 0))
+
     def test_multi_expansion(self):
         key = 'a' * core._INITIAL_MMAP_SIZE * 4
         self.d.write_value('abc', 42.0)
@@ -138,3 +827,53 @@ class TestMmapedDict(unittest.TestCase):
 
     def tearDown(self):
         os.unlink(self.tempfile)
+
+
+class TestDenseMmapedDict(unittest.TestCase):
+    def setUp(self):
+        fd, self.tempfile = tempfile.mkstemp()
+        os.close(fd)
+        self.d = core._DenseMmapedDict(self.tempfile)
+
+    def tearDown(self):
+        self.d.close()
+        os.unlink(self.tempfile)
+
+    def test_process_restart(self):
+        key = ('h', 'h_bucket', ('l', 'le'), ('a', '1.0'))
+        self.d.write_value(key, 123.0)
+        self.d.write_value('abc', 4.0)
+        self.d.close()
+        self.d = core._DenseMmapedDict(self.tempfile)
+        self.assertEqual(123, self.d.read_value(key))
+        self.assertEqual(4, self.d.read_value('abc'))
+
+    def test_chunks(self):
+        n = core._DENSE_SLOTS * 2 + 1
+        for i in range(n):
+            self.d.write_value('key {0}'.format(i), float(i))
+        slot = self.d.slot('key 0')
+        # Keys which don't fit in what is left of a chunk go in a new one.
+        long_key = 'a' * (core._DENSE_CHUNK_SIZE - core._DENSE_KEYS_START - 100)
+        self.d.write_value(long_key, 1.0)
+        slot[0] = 42.0
+        self.assertRaises(ValueError, self.d.write_value, 'a' * core._DENSE_CHUNK_SIZE, 1.0)
+        self.d.close()
+        self.d = core._DenseMmapedDict(self.tempfile)
+        self.assertEqual(42.0, self.d.read_value('key 0'))
+        self.assertEqual(float(n - 1), self.d.read_value('key {0}'.format(n - 1)))
+        self.assertEqual(1.0, self.d.read_value(long_key))
+
+    def test_migrate(self):
+        self.d.close()
+        os.unlink(self.tempfile)
+        d = core._MmapedDict(self.tempfile)
+        key = ('c', 'c', ('l',), ('a',))
+        d.write_value(key, 1.0)
+        d.write_value('abc', 2.0)
+        d.close()
+        self.d = core._DenseMmapedDict(self.tempfile)
+        self.assertEqual(1.0, self.d.read_value(key))
+        self.assertEqual(2.0, self.d.read_value('abc'))
+        self.assertFalse(os.path.exists(self.tempfile + '.migrating'))
+        self.assertRaises(ValueError, core._MmapedDict, self.tempfile)
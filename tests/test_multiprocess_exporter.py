@@ -0,0 +1,69 @@
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import prometheus_client
+from prometheus_client import CollectorRegistry, Counter, generate_latest
+from prometheus_client.multiprocess import MultiProcessCollector
+from prometheus_client.multiprocess_exporter import MultiProcessExporter, main, make_server
+
+try:
+    from urllib2 import urlopen
+except ImportError:
+    # Python 3
+    from urllib.request import urlopen
+
+
+class TestMultiProcessExporter(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        os.environ['prometheus_multiproc_dir'] = self.tempdir
+        prometheus_client.core._ValueClass = prometheus_client.core._MultiProcessValue(lambda: 123)
+        self.counter = Counter('c', 'help', registry=None)
+        self.counter.inc(3)
+
+    def tearDown(self):
+        del os.environ['prometheus_multiproc_dir']
+        shutil.rmtree(self.tempdir)
+        prometheus_client.core._ValueClass = prometheus_client.core._MutexValue
+
+    def expected(self):
+        registry = CollectorRegistry()
+        MultiProcessCollector(registry, self.tempdir)
+        return generate_latest(registry)
+
+    def test_render(self):
+        output = os.path.join(self.tempdir, 'metrics.prom')
+        exporter = MultiProcessExporter(self.tempdir, output=output)
+        exporter.render()
+        self.assertEqual(self.expected(), exporter.latest)
+        with open(output, 'rb') as f:
+            self.assertEqual(exporter.latest, f.read())
+        self.assertTrue(b'c 3.0' in exporter.latest)
+        self.counter.inc()
+        exporter.render()
+        self.assertTrue(b'c 4.0' in exporter.latest)
+
+    def test_serve(self):
+        for output in [None, os.path.join(self.tempdir, 'metrics.prom')]:
+            exporter = MultiProcessExporter(self.tempdir, output=output)
+            exporter.render()
+            httpd = make_server(exporter, 0, 'localhost')
+            t = threading.Thread(target=httpd.handle_request)
+            t.start()
+            body = urlopen('http://localhost:{0}/metrics'.format(httpd.server_address[1])).read()
+            t.join()
+            httpd.server_close()
+            self.assertEqual(self.expected(), body)
+
+    def test_no_path(self):
+        self.assertRaises(ValueError, MultiProcessExporter, '')
+        self.assertRaises(SystemExit, main, ['--path', ''])
+
+
+if __name__ == '__main__':
+    unittest.main()